@@ -1,6 +1,7 @@
-from flask import Flask, session, redirect, url_for, g
-from controllers.database import init_db
+from flask import Flask, session, redirect, url_for, g, request
+from controllers.database import init_db, init_app as init_db_app
 from services import auth_service  # Importar el servicio
+from controllers import metrics
 import os
 from dotenv import load_dotenv
 
@@ -16,6 +17,12 @@ def create_app():
     app = Flask(__name__)
     app.secret_key = os.urandom(24) # Clave secreta segura
 
+    # Conexión por solicitud: se devuelve al pool al terminar cada request
+    init_db_app(app)
+
+    # Latencia por ruta y GET /metrics (formato Prometheus)
+    metrics.init_app(app)
+
     # Inicializar la base de datos
     with app.app_context():
         init_db()
@@ -31,6 +38,11 @@ def create_app():
         Carga los datos del usuario en g.user en cada solicitud
         si está en la sesión.
         """
+        # Los archivos estáticos no necesitan al usuario
+        if request.endpoint == 'static' or (request.endpoint or '').endswith('.static'):
+            g.user = None
+            auth_service.registrar_solicitud_estatica()
+            return
         user_id = session.get('user_id')
         if user_id is None:
             g.user = None
@@ -0,0 +1,370 @@
+"""
+Modo ASGI: sirve MedAgend con un servidor ASGI para que las llamadas
+lentas a Gemini no ocupen un hilo por cada chat en curso.
+
+    pip install uvicorn a2wsgi
+    uvicorn asgi:app --host 0.0.0.0 --port 8000
+
+- POST /chat/api/chat se atiende de forma asíncrona: el turno espera a
+  Gemini con await (AiController.handle_message_async) y solo lo que toca
+  SQLite corre en un pool acotado de hilos (ASGI_HILOS_DB).
+- POST /chat/api/chat/stream envía los eventos según llegan; el iterador
+  del SDK es bloqueante, así que cada stream ocupa un hilo del pool de
+  Gemini (AI_LLM_WORKERS), no uno de los que atienden el resto de la app.
+- Todo lo demás (login, portal, panel de admin, /metrics) pasa por la app
+  de Flask sin cambios, con a2wsgi.WSGIMiddleware y su propio pool de hilos.
+
+Chat y resto de la app tienen límites de concurrencia separados
+(ASGI_MAX_CHAT, ASGI_MAX_GENERAL): muchos chats lentos no dejan sin
+capacidad al login ni al portal. Una solicitud que espera más de
+ASGI_ESPERA_S por un lugar recibe 503 con Retry-After.
+"""
+import asyncio
+import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from a2wsgi import WSGIMiddleware
+from a2wsgi.wsgi import build_environ
+from flask import g, session
+
+from app import create_app
+from controllers import ai_controller, metrics
+from controllers.chat_sessions import registro as chat_sessions
+from routes import chat_routes
+
+# --- Configuración ---
+# Turnos de chat atendidos a la vez (esperan a Gemini, casi no usan CPU)
+MAX_CHAT = int(os.environ.get("ASGI_MAX_CHAT", "64"))
+# Solicitudes al resto de la app a la vez (= hilos de WSGIMiddleware)
+MAX_GENERAL = int(os.environ.get("ASGI_MAX_GENERAL", "16"))
+# Hilos para las llamadas a SQLite del chat asíncrono
+HILOS_DB = int(os.environ.get("ASGI_HILOS_DB", "8"))
+# Segundos que una solicitud espera un lugar antes de responder 503
+ESPERA_S = float(os.environ.get("ASGI_ESPERA_S", "10"))
+
+RUTA_CHAT = "/chat/api/chat"
+RUTA_CHAT_STREAM = "/chat/api/chat/stream"
+
+log = metrics.get_logger(__name__)
+
+ASGI_RECHAZADAS = metrics.contador(
+    "medagend_asgi_rechazadas_total", "Solicitudes rechazadas con 503 por falta de capacidad", ("grupo",)
+)
+
+flask_app = create_app()
+
+_ejecutor_db = ThreadPoolExecutor(max_workers=HILOS_DB, thread_name_prefix="asgi-db")
+# El resto de la app: a2wsgi traduce ASGI <-> WSGI (environ, cuerpo, streaming)
+_wsgi = WSGIMiddleware(flask_app, workers=MAX_GENERAL)
+
+
+class _Limite:
+    """Semáforo con nombre que cuenta cuántas solicitudes lo ocupan."""
+
+    def __init__(self, grupo, maximo):
+        self.grupo = grupo
+        self.maximo = maximo
+        self.en_curso = 0
+        self._semaforo = asyncio.Semaphore(maximo)
+
+    async def entrar(self):
+        try:
+            await asyncio.wait_for(self._semaforo.acquire(), ESPERA_S)
+        except asyncio.TimeoutError:
+            ASGI_RECHAZADAS.inc(self.grupo)
+            return False
+        self.en_curso += 1
+        return True
+
+    def salir(self):
+        self.en_curso -= 1
+        self._semaforo.release()
+
+
+_limite_chat = _Limite("chat", MAX_CHAT)
+_limite_general = _Limite("general", MAX_GENERAL)
+
+
+@metrics.registrar_colector
+def _metricas_asgi():
+    return [
+        ("medagend_asgi_en_curso", "Solicitudes en curso por grupo de concurrencia", limite.en_curso,
+         {"grupo": limite.grupo})
+        for limite in (_limite_chat, _limite_general)
+    ] + [
+        ("medagend_asgi_limite", "Máximo de solicitudes a la vez por grupo", limite.maximo,
+         {"grupo": limite.grupo})
+        for limite in (_limite_chat, _limite_general)
+    ]
+
+
+# --- Utilidades ASGI ---
+
+async def _leer_cuerpo(receive):
+    partes = []
+    while True:
+        mensaje = await receive()
+        if mensaje["type"] == "http.disconnect":
+            return None
+        partes.append(mensaje.get("body", b""))
+        if not mensaje.get("more_body"):
+            return b"".join(partes)
+
+
+def _con_cuerpo(cuerpo, receive):
+    """
+    'receive' que entrega primero el cuerpo ya leído: el chat lo lee para
+    decidir y, si no es un turno válido, pasa la solicitud a Flask tal cual.
+    """
+    pendiente = [{"type": "http.request", "body": cuerpo, "more_body": False}]
+
+    async def recibir():
+        if pendiente:
+            return pendiente.pop()
+        return await receive()
+    return recibir
+
+
+async def _responder(send, estado, encabezados, cuerpo=b""):
+    await send({"type": "http.response.start", "status": estado, "headers": encabezados})
+    await send({"type": "http.response.body", "body": cuerpo})
+
+
+def _encabezados(pares):
+    return [(nombre.lower().encode("latin-1"), valor.encode("latin-1")) for nombre, valor in pares]
+
+
+async def _sin_capacidad(send):
+    await _responder(send, 503, _encabezados([
+        ("Content-Type", "text/plain; charset=utf-8"), ("Retry-After", str(max(1, int(ESPERA_S))))
+    ]), "Servidor ocupado, intenta de nuevo en unos segundos.\n".encode("utf-8"))
+
+
+_FIN = object()
+
+
+async def _en_hilo(ejecutor, generador):
+    """
+    Recorre un generador bloqueante en un solo hilo de 'ejecutor' y entrega
+    sus elementos al event loop. Todo el recorrido ocurre en el mismo hilo
+    (el stream del SDK de Gemini no debe cambiar de hilo a mitad de camino);
+    la cola acotada frena al generador si el cliente lee despacio.
+    Si el consumidor se va antes, espera a que el hilo cierre el generador:
+    quien llama puede soltar lo que el generador usaba (ej. el lock de la
+    sesión de chat) sabiendo que ya nadie lo toca.
+    """
+    loop = asyncio.get_running_loop()
+    cola = asyncio.Queue(maxsize=8)
+    detener = threading.Event()
+
+    def poner(elemento):
+        # Ya sin consumidor no se encola nada más (la cola no se volvería a vaciar)
+        if not detener.is_set():
+            asyncio.run_coroutine_threadsafe(cola.put(elemento), loop).result()
+
+    def recorrer():
+        iterador = None
+        try:
+            iterador = generador()
+            for elemento in iterador:
+                if detener.is_set():
+                    break
+                poner((elemento, None))
+            poner((_FIN, None))
+        except BaseException as e:
+            poner((_FIN, e))
+        finally:
+            if iterador is not None:
+                iterador.close()
+
+    tarea = loop.run_in_executor(ejecutor, recorrer)
+    try:
+        while True:
+            elemento, error = await cola.get()
+            if error is not None:
+                raise error
+            if elemento is _FIN:
+                break
+            yield elemento
+    finally:
+        if not tarea.done():
+            # El consumidor se fue antes de tiempo: liberar al hilo (a lo más
+            # le queda un put en curso, que cabe en la cola vacía) y esperarlo
+            detener.set()
+            while not cola.empty():
+                cola.get_nowait()
+            await tarea
+
+
+async def _esperar_desconexion(receive, desconectado):
+    while True:
+        mensaje = await receive()
+        if mensaje["type"] == "http.disconnect":
+            desconectado.set()
+            return
+
+
+# --- Chat asíncrono ---
+
+def _preparar_turno(environ):
+    """
+    Lo que el chat hace antes de llamar a la IA, dentro de una solicitud de
+    Flask: hooks (carga g.user), validación y conversación actual. Devuelve
+    (user, conversacion_id, mensaje, cookies) o None si la solicitud no es
+    un turno válido; en ese caso Flask la atiende y responde el error.
+    """
+    with flask_app.request_context(environ):
+        try:
+            if flask_app.preprocess_request() is not None:
+                return None
+            if not g.user or g.user['role'] != 'paciente':
+                return None
+            mensaje = chat_routes.mensaje_recibido()
+            if not mensaje:
+                return None
+            conversacion_id = chat_routes.conversacion_actual()
+            # La cookie de sesión puede cambiar (conversación nueva)
+            respuesta = flask_app.response_class()
+            flask_app.session_interface.save_session(flask_app, session, respuesta)
+            return g.user, conversacion_id, mensaje, respuesta.headers.getlist("Set-Cookie")
+        except Exception:
+            # JSON inválido, etc.: que Flask lo reporte como siempre
+            return None
+
+
+def _observar_http(endpoint, inicio, estado):
+    metrics.HTTP_SEGUNDOS.observar(time.perf_counter() - inicio, endpoint, "POST")
+    metrics.HTTP_SOLICITUDES.inc(endpoint, "POST", str(estado))
+
+
+async def _chat(scope, receive, send, cuerpo, stream):
+    inicio = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    turno = await loop.run_in_executor(_ejecutor_db, _preparar_turno, build_environ(scope, io.BytesIO(cuerpo)))
+    if turno is None:
+        await _wsgi(scope, _con_cuerpo(cuerpo, receive), send)
+        return
+
+    user, conversacion_id, mensaje, cookies = turno
+    cargar_historial = chat_routes.cargador_historial(conversacion_id, user['id'])
+    extra = [("Set-Cookie", cookie) for cookie in cookies]
+    if stream:
+        await _chat_stream(receive, send, user, conversacion_id, mensaje, cargar_historial, extra)
+        _observar_http("chat.api_chat_stream", inicio, 200)
+        return
+
+    estado = 200
+    try:
+        async with chat_sessions.sesion_async(user, cargar_historial, _ejecutor_db) as controlador:
+            respuesta = await controlador.handle_message_async(mensaje, _ejecutor_db)
+    except Exception:
+        log.exception("Error en api_chat_message (asgi)")
+        respuesta = chat_routes.ERROR_CONEXION
+        estado = 500
+    await loop.run_in_executor(
+        _ejecutor_db, chat_routes.guardar_turno, conversacion_id, user['id'], mensaje, respuesta
+    )
+
+    cuerpo_json = flask_app.json.dumps({"response": respuesta}).encode("utf-8")
+    await _responder(send, estado, _encabezados(
+        [("Content-Type", "application/json"), ("Content-Length", str(len(cuerpo_json)))] + extra
+    ), cuerpo_json)
+    _observar_http("chat.api_chat_message", inicio, estado)
+
+
+async def _chat_stream(receive, send, user, conversacion_id, mensaje, cargar_historial, extra):
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": _encabezados([
+            ("Content-Type", "text/event-stream; charset=utf-8"),
+            ("Cache-Control", "no-cache"),
+            ("X-Accel-Buffering", "no"),
+        ] + extra),
+    })
+
+    desconectado = asyncio.Event()
+    vigilante = asyncio.ensure_future(_esperar_desconexion(receive, desconectado))
+    respuesta = None
+    fallo = False
+    try:
+        async with chat_sessions.sesion_async(user, cargar_historial, _ejecutor_db) as controlador:
+            eventos = _en_hilo(ai_controller.llm_executor, lambda: controlador.handle_message_stream(mensaje))
+            try:
+                async for evento in eventos:
+                    if desconectado.is_set():
+                        break
+                    if evento['tipo'] in ('fin', 'error'):
+                        respuesta = evento['texto']
+                        fallo = evento['tipo'] == 'error'
+                    await send({
+                        "type": "http.response.body",
+                        "body": chat_routes.evento_sse(evento).encode("utf-8"),
+                        "more_body": True,
+                    })
+            finally:
+                await eventos.aclose()
+    except Exception:
+        log.exception("Error en api_chat_stream (asgi)")
+        respuesta = chat_routes.ERROR_CONEXION
+        fallo = True
+        if not desconectado.is_set():
+            await send({
+                "type": "http.response.body",
+                "body": chat_routes.evento_sse({"tipo": "error", "texto": respuesta}).encode("utf-8"),
+                "more_body": True,
+            })
+    finally:
+        vigilante.cancel()
+
+    if desconectado.is_set() or fallo:
+        # Turno cortado: el chat de Gemini pudo quedar a medias
+        chat_sessions.descartar(user['id'])
+    if respuesta is not None:
+        await asyncio.get_running_loop().run_in_executor(
+            _ejecutor_db, chat_routes.guardar_turno, conversacion_id, user['id'], mensaje, respuesta
+        )
+    if not desconectado.is_set():
+        await send({"type": "http.response.body", "body": b""})
+
+
+# --- Aplicación ASGI ---
+
+async def _lifespan(receive, send):
+    while True:
+        mensaje = await receive()
+        if mensaje["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif mensaje["type"] == "lifespan.shutdown":
+            _ejecutor_db.shutdown(wait=False)
+            _wsgi.executor.shutdown(wait=False)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    ruta = scope["path"]
+    es_chat = scope["method"] == "POST" and ruta in (RUTA_CHAT, RUTA_CHAT_STREAM)
+    limite = _limite_chat if es_chat else _limite_general
+    if not await limite.entrar():
+        await _sin_capacidad(send)
+        return
+    try:
+        if not es_chat:
+            await _wsgi(scope, receive, send)
+            return
+        cuerpo = await _leer_cuerpo(receive)
+        if cuerpo is None:
+            return
+        await _chat(scope, receive, send, cuerpo, stream=ruta == RUTA_CHAT_STREAM)
+    finally:
+        limite.salir()
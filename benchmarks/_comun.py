@@ -0,0 +1,53 @@
+"""
+Utilidades compartidas por los benchmarks.
+
+Cada benchmark trabaja sobre una base de datos temporal: hay que llamar a
+`usar_db_temporal()` ANTES de importar cualquier servicio, porque
+controllers.database lee MEDAGEND_DB al importarse.
+"""
+import os
+import statistics
+import tempfile
+import time
+
+
+def usar_db_temporal(nombre="bench.db"):
+    """Apunta la aplicación a una base de datos nueva en un directorio temporal."""
+    directorio = tempfile.mkdtemp(prefix="medagend_bench_")
+    ruta = os.path.join(directorio, nombre)
+    os.environ["MEDAGEND_DB"] = ruta
+    return ruta
+
+
+def percentiles(muestras):
+    """Resumen de latencias en milisegundos (p50/p95/p99/promedio/máx)."""
+    if not muestras:
+        return {"n": 0}
+    ordenadas = sorted(muestras)
+
+    def p(q):
+        idx = min(len(ordenadas) - 1, int(round(q * (len(ordenadas) - 1))))
+        return ordenadas[idx] * 1000
+
+    return {
+        "n": len(ordenadas),
+        "p50_ms": round(p(0.50), 3),
+        "p95_ms": round(p(0.95), 3),
+        "p99_ms": round(p(0.99), 3),
+        "prom_ms": round(statistics.fmean(ordenadas) * 1000, 3),
+        "max_ms": round(ordenadas[-1] * 1000, 3),
+    }
+
+
+def cronometrar(funcion, repeticiones):
+    """Ejecuta `funcion(i)` varias veces y devuelve las duraciones en segundos."""
+    muestras = []
+    for i in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion(i)
+        muestras.append(time.perf_counter() - inicio)
+    return muestras
+
+
+def imprimir_resultado(titulo, datos):
+    print(f"{titulo:<40} " + "  ".join(f"{k}={v}" for k, v in datos.items()))
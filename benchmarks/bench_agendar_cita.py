@@ -0,0 +1,149 @@
+"""
+Benchmark: latencia de agendar_nueva_cita con un historial grande.
+
+Carga N citas históricas (por defecto 1,000,000) repartidas entre los
+médicos de una clínica y compara el chequeo de traslapes anterior
+(datetime() sobre la columna, sin índice) contra el probe por índice
+sobre fecha_hora_fin.
+
+Uso:
+    python -m benchmarks.bench_agendar_cita [--citas 1000000] [--medicos 50] [--reservas 500]
+"""
+import argparse
+import json
+import random
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+from benchmarks._comun import usar_db_temporal, percentiles, cronometrar, imprimir_resultado
+
+CONSULTA_ANTERIOR = """
+    SELECT * FROM citas
+    WHERE medico_id = ?
+    AND estado = 'programada'
+    AND (
+        (fecha_hora_inicio < ? AND datetime(fecha_hora_inicio, '+' || duracion_minutos || ' minutes') > ?) OR
+        (fecha_hora_inicio >= ? AND fecha_hora_inicio < ?)
+    )
+"""
+
+CONSULTA_NUEVA = """
+    SELECT id FROM (
+        SELECT id, fecha_hora_fin FROM citas
+        WHERE medico_id = ?
+        AND estado = 'programada'
+        AND fecha_hora_inicio < ?
+        ORDER BY fecha_hora_inicio DESC
+        LIMIT 1
+    )
+    WHERE fecha_hora_fin > ?
+"""
+
+
+def _horario_todo_el_dia():
+    dias = ("lunes", "martes", "miercoles", "jueves", "viernes", "sabado", "domingo")
+    return json.dumps({dia: ["00:00-23:59"] for dia in dias})
+
+
+def poblar(ruta_db, total_citas, total_medicos):
+    conn = sqlite3.connect(ruta_db)
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute(
+        "INSERT INTO usuarios (username, password_hash, role) VALUES ('bench', 'x', 'paciente')"
+    )
+    conn.execute(
+        "INSERT INTO pacientes (usuario_id, nombre_completo, email) VALUES (last_insert_rowid(), 'Paciente Bench', 'bench@example.com')"
+    )
+    paciente_id = conn.execute("SELECT id FROM pacientes WHERE email = 'bench@example.com'").fetchone()[0]
+
+    horario = _horario_todo_el_dia()
+    conn.executemany(
+        "INSERT INTO medicos (nombre_completo, especialidad, horario_trabajo, ubicacion) VALUES (?, ?, ?, ?)",
+        ((f"Dr. Bench {i}", "Medicina General", horario, f"Consultorio {i}") for i in range(total_medicos)),
+    )
+    medicos = [row[0] for row in conn.execute("SELECT id FROM medicos WHERE nombre_completo LIKE 'Dr. Bench %' ORDER BY id")]
+
+    # Historial: citas de 30 minutos hacia atrás desde ayer
+    base = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=1)
+    rnd = random.Random(42)
+
+    def filas():
+        for i in range(total_citas):
+            medico_id = medicos[i % len(medicos)]
+            inicio = base - timedelta(minutes=30 * (i // len(medicos) + 1))
+            r = rnd.random()
+            estado = 'completada' if r < 0.90 else ('cancelada' if r < 0.95 else 'programada')
+            yield (paciente_id, medico_id, inicio, 30, inicio + timedelta(minutes=30), estado)
+
+    conn.executemany(
+        """
+        INSERT INTO citas (paciente_id, medico_id, fecha_hora_inicio, duracion_minutos, fecha_hora_fin, estado)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """,
+        filas(),
+    )
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+    return paciente_id, medicos
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--citas", type=int, default=1_000_000)
+    parser.add_argument("--medicos", type=int, default=50)
+    parser.add_argument("--reservas", type=int, default=500)
+    args = parser.parse_args()
+
+    ruta_db = usar_db_temporal()
+    from controllers.database import init_db, get_db_connection
+    from services import cita_service
+
+    init_db()
+    t0 = time.perf_counter()
+    paciente_id, medicos = poblar(ruta_db, args.citas, args.medicos)
+    print(f"Cargadas {args.citas:,} citas para {len(medicos)} médicos en {time.perf_counter() - t0:.1f}s ({ruta_db})")
+
+    manana = datetime.now().replace(hour=8, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    objetivos = [
+        (medicos[i % len(medicos)], manana + timedelta(minutes=30 * (i // len(medicos))))
+        for i in range(args.reservas)
+    ]
+
+    conn = get_db_connection()
+    for titulo, consulta in (("anterior", CONSULTA_ANTERIOR), ("indice", CONSULTA_NUEVA)):
+        plan = conn.execute("EXPLAIN QUERY PLAN " + consulta, _params(titulo, medicos[0], manana)).fetchall()
+        print(f"Plan ({titulo}): " + " | ".join(row['detail'] for row in plan))
+
+    def chequeo(titulo):
+        def _run(i):
+            medico_id, inicio = objetivos[i]
+            conn.execute(
+                CONSULTA_ANTERIOR if titulo == "anterior" else CONSULTA_NUEVA,
+                _params(titulo, medico_id, inicio),
+            ).fetchone()
+        return _run
+
+    imprimir_resultado("chequeo traslape (anterior)", percentiles(cronometrar(chequeo("anterior"), min(args.reservas, 50))))
+    imprimir_resultado("chequeo traslape (indice)", percentiles(cronometrar(chequeo("indice"), args.reservas)))
+    conn.close()
+
+    def reservar(i):
+        medico_id, inicio = objetivos[i]
+        resultado = cita_service.agendar_nueva_cita(paciente_id, medico_id, inicio.strftime('%Y-%m-%dT%H:%M'))
+        if not resultado.get('success'):
+            raise RuntimeError(resultado)
+
+    imprimir_resultado("agendar_nueva_cita (extremo a extremo)", percentiles(cronometrar(reservar, args.reservas)))
+
+
+def _params(titulo, medico_id, inicio):
+    fin = inicio + timedelta(minutes=30)
+    if titulo == "anterior":
+        return (medico_id, fin, inicio, inicio, fin)
+    return (medico_id, fin, inicio)
+
+
+if __name__ == "__main__":
+    main()
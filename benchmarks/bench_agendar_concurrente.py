@@ -0,0 +1,199 @@
+"""
+Benchmark: reservas concurrentes sobre los mismos médicos.
+
+Varios hilos intentan agendar al mismo tiempo citas de 30 minutos que
+empiezan cada 15 minutos (se traslapan sin tener la misma hora de inicio,
+así que el UNIQUE(medico_id, fecha_hora_inicio) no las detiene). Al final
+se cuentan los pares de citas 'programada' traslapadas: con el camino
+atómico (BEGIN IMMEDIATE) debe ser 0.
+
+--modo anterior reproduce el flujo previo (SELECT y luego INSERT en una
+transacción diferida) para comparar. Bajo el GIL el hueco entre el
+chequeo y el INSERT es tan corto que casi nunca se pierde la carrera, así
+que --ventana-ms agrega una pausa después de buscar_conflicto en ambos
+modos: el anterior debe terminar con traslapes y el atómico con 0. En el
+atómico la pausa ocurre con el lock tomado, así que para medir solo el
+rendimiento usar --ventana-ms 0.
+
+Uso:
+    python -m benchmarks.bench_agendar_concurrente [--hilos 16] [--medicos 4] [--intentos 2000] [--dias 5] [--modo ambos] [--ventana-ms 5]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+from benchmarks._comun import usar_db_temporal, percentiles, imprimir_resultado
+from benchmarks.bench_agendar_cita import _horario_todo_el_dia
+
+TRASLAPES = """
+    SELECT COUNT(*) FROM citas a
+    JOIN citas b ON a.medico_id = b.medico_id AND a.id < b.id
+    WHERE a.estado = 'programada' AND b.estado = 'programada'
+    AND a.fecha_hora_inicio < b.fecha_hora_fin
+    AND b.fecha_hora_inicio < a.fecha_hora_fin
+    AND a.medico_id IN ({marcas})
+"""
+
+
+def poblar(ruta_db, total_medicos, modo):
+    conn = sqlite3.connect(ruta_db)
+    conn.execute(
+        "INSERT OR IGNORE INTO usuarios (username, password_hash, role) VALUES ('bench', 'x', 'paciente')"
+    )
+    conn.execute("""
+        INSERT OR IGNORE INTO pacientes (usuario_id, nombre_completo, email)
+        SELECT id, 'Paciente Bench', 'bench@example.com' FROM usuarios WHERE username = 'bench'
+    """)
+    paciente_id = conn.execute("SELECT id FROM pacientes WHERE email = 'bench@example.com'").fetchone()[0]
+    conn.executemany(
+        "INSERT INTO medicos (nombre_completo, especialidad, horario_trabajo, ubicacion) VALUES (?, ?, ?, ?)",
+        ((f"Dr. Bench {modo} {i}", "Medicina General", _horario_todo_el_dia(), f"Consultorio {i}")
+         for i in range(total_medicos)),
+    )
+    medicos = [row[0] for row in conn.execute(
+        "SELECT id FROM medicos WHERE nombre_completo LIKE ? ORDER BY id", (f"Dr. Bench {modo} %",)
+    )]
+    conn.commit()
+    conn.close()
+    return paciente_id, medicos
+
+
+def _con_ventana(buscar_conflicto, segundos):
+    """buscar_conflicto con una pausa después del chequeo (ensancha la carrera)."""
+    def buscar_lento(*args, **kwargs):
+        conflicto = buscar_conflicto(*args, **kwargs)
+        time.sleep(segundos)
+        return conflicto
+    return buscar_lento
+
+
+def agendar_anterior(paciente_id, medico_id, inicio_str, duracion_minutos=30):
+    """El flujo previo: chequeo y INSERT sin tomar el lock de escritura antes de leer."""
+    from controllers.database import get_db_connection
+    from services import cita_service
+
+    inicio = datetime.fromisoformat(inicio_str)
+    fin = inicio + timedelta(minutes=duracion_minutos)
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        if cita_service.buscar_conflicto(cursor, medico_id, inicio, fin) is not None:
+            return {"error": "ocupado", "codigo": cita_service.CODIGO_HORARIO_OCUPADO}
+        cursor.execute("""
+            INSERT INTO citas (paciente_id, medico_id, fecha_hora_inicio, duracion_minutos, fecha_hora_fin)
+            VALUES (?, ?, ?, ?, ?)
+        """, (paciente_id, medico_id, inicio, duracion_minutos, fin))
+        conn.commit()
+        return {"success": True}
+    except sqlite3.IntegrityError:
+        conn.rollback()
+        return {"error": "ocupado", "codigo": cita_service.CODIGO_HORARIO_OCUPADO}
+    except sqlite3.OperationalError as e:
+        conn.rollback()
+        return {"error": str(e)}
+    finally:
+        conn.close()
+
+
+def correr(modo, agendar, paciente_id, medicos, hilos, intentos, dias):
+    from controllers.database import get_db_connection
+
+    manana = datetime.now().replace(hour=8, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    # 10 horas por día en pasos de 15 minutos: muchas citas compiten por los mismos huecos
+    objetivos = [
+        (random.choice(medicos),
+         (manana + timedelta(days=random.randrange(dias), minutes=15 * random.randrange(40))).strftime('%Y-%m-%dT%H:%M'))
+        for _ in range(intentos)
+    ]
+    siguiente = iter(range(intentos))
+    lock = threading.Lock()
+    conteo = {"exitos": 0, "horario_ocupado": 0, "reintentar": 0, "otros_errores": 0}
+    latencias = []
+    barrera = threading.Barrier(hilos)
+
+    def trabajador():
+        barrera.wait()
+        while True:
+            with lock:
+                i = next(siguiente, None)
+            if i is None:
+                return
+            medico_id, inicio = objetivos[i]
+            t0 = time.perf_counter()
+            resultado = agendar(paciente_id, medico_id, inicio)
+            duracion = time.perf_counter() - t0
+            if resultado.get('success'):
+                clave = "exitos"
+            else:
+                clave = resultado.get('codigo') if resultado.get('codigo') in conteo else "otros_errores"
+            with lock:
+                conteo[clave] += 1
+                latencias.append(duracion)
+
+    trabajadores = [threading.Thread(target=trabajador) for _ in range(hilos)]
+    t0 = time.perf_counter()
+    for t in trabajadores:
+        t.start()
+    for t in trabajadores:
+        t.join()
+    segundos = time.perf_counter() - t0
+
+    conn = get_db_connection()
+    marcas = ",".join("?" * len(medicos))
+    traslapes = conn.execute(TRASLAPES.format(marcas=marcas), medicos).fetchone()[0]
+    conn.close()
+
+    imprimir_resultado(f"reservas concurrentes ({modo})", {
+        "hilos": hilos,
+        "intentos_por_s": round(intentos / segundos, 1),
+        "reservas_por_s": round(conteo["exitos"] / segundos, 1),
+        **conteo,
+        "dobles_reservas": traslapes,
+    })
+    imprimir_resultado(f"latencia por intento ({modo})", percentiles(latencias))
+    return traslapes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hilos", type=int, default=16)
+    parser.add_argument("--medicos", type=int, default=4)
+    parser.add_argument("--intentos", type=int, default=2000)
+    parser.add_argument("--dias", type=int, default=5, help="Días sobre los que se reparten los intentos")
+    parser.add_argument("--modo", choices=("nuevo", "anterior", "ambos"), default="ambos")
+    parser.add_argument("--ventana-ms", type=float, default=5.0,
+                        help="Pausa entre el chequeo de traslapes y el INSERT (0 = sin pausa)")
+    args = parser.parse_args()
+
+    # Una conexión por hilo: el pool no debe ser el cuello de botella
+    os.environ.setdefault("DB_POOL_SIZE", str(args.hilos))
+    ruta_db = usar_db_temporal()
+    from controllers.database import init_db
+    from services import cita_service
+
+    init_db()
+    print(f"Base de datos: {ruta_db} | ventana entre chequeo e INSERT: {args.ventana_ms} ms")
+    if args.ventana_ms > 0:
+        # _reservar y agendar_anterior buscan la función en el módulo en cada llamada
+        cita_service.buscar_conflicto = _con_ventana(cita_service.buscar_conflicto, args.ventana_ms / 1000)
+
+    modos = ("anterior", "nuevo") if args.modo == "ambos" else (args.modo,)
+    traslapes_por_modo = {}
+    for modo in modos:
+        paciente_id, medicos = poblar(ruta_db, args.medicos, modo)
+        agendar = cita_service.agendar_nueva_cita if modo == "nuevo" else agendar_anterior
+        traslapes_por_modo[modo] = correr(modo, agendar, paciente_id, medicos, args.hilos, args.intentos, args.dias)
+
+    if traslapes_por_modo.get("nuevo"):
+        raise SystemExit(f"ERROR: {traslapes_por_modo['nuevo']} pares de citas traslapadas con el camino atómico")
+    if traslapes_por_modo.get("anterior") == 0 and args.ventana_ms > 0:
+        # Sin traslapes en el flujo previo la comparación no demuestra nada
+        raise SystemExit("ERROR: el modo anterior no reprodujo la doble reserva; suba --ventana-ms o --hilos")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Benchmark: tiempo de arranque de la aplicación (create_app()).
+
+Cada medición corre en un intérprete nuevo (como un worker recién creado)
+y separa el tiempo de importar app.py del de create_app(). Se mide con
+una base de datos nueva (se aplican todas las migraciones) y con una ya
+al día (el caso normal en cada reinicio). También reporta si el SDK de
+Gemini se importó durante el arranque.
+
+Uso:
+    python -m benchmarks.bench_arranque [--repeticiones 10]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+from benchmarks._comun import usar_db_temporal, imprimir_resultado
+
+# Se ejecuta en el proceso hijo: imprime una línea JSON con los tiempos
+HIJO = """
+import json, sys, time
+inicio = time.perf_counter()
+from app import create_app
+importado = time.perf_counter()
+create_app()
+fin = time.perf_counter()
+print(json.dumps({
+    "import_s": importado - inicio,
+    "create_app_s": fin - importado,
+    "total_s": fin - inicio,
+    "sdk_gemini": "google.generativeai" in sys.modules,
+}))
+"""
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def arrancar():
+    resultado = subprocess.run(
+        [sys.executable, "-c", HIJO], cwd=RAIZ, env=os.environ.copy(),
+        capture_output=True, text=True, check=True
+    )
+    return json.loads(resultado.stdout.strip().splitlines()[-1])
+
+
+def resumen(titulo, mediciones):
+    def mediana(clave):
+        valores = sorted(m[clave] for m in mediciones)
+        return round(valores[len(valores) // 2] * 1000, 1)
+
+    imprimir_resultado(titulo, {
+        "n": len(mediciones),
+        "import_ms": mediana("import_s"),
+        "create_app_ms": mediana("create_app_s"),
+        "total_ms": mediana("total_s"),
+        "sdk_gemini": mediciones[-1]["sdk_gemini"],
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeticiones", type=int, default=10)
+    args = parser.parse_args()
+
+    os.environ.setdefault("GEMINI_API_KEY", "falsa")
+
+    # Base nueva en cada corrida: incluye crear el esquema y el seed
+    nuevas = []
+    for _ in range(max(1, args.repeticiones // 2)):
+        usar_db_temporal()
+        nuevas.append(arrancar())
+    resumen("arranque con base nueva", nuevas)
+
+    # Misma base, ya inicializada: el caso de cada reinicio o worker nuevo
+    ruta_db = usar_db_temporal()
+    arrancar()
+    resumen("arranque con base existente", [arrancar() for _ in range(args.repeticiones)])
+    print(f"Base de datos: {ruta_db}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Benchmark: tamaño del prompt y latencia a lo largo de una conversación larga.
+
+Una conversación de N turnos (por defecto 50) con el Gemini falso, que
+pide herramientas con resultados grandes (la lista completa de médicos,
+las citas del paciente) y tarda más cuanto más largo es el prompt
+(--ms-por-1k-tokens, como el modelo real). Se compara el historial sin
+acotar (AI_CONTEXTO_TOKENS=0) contra el acotado (controllers/contexto.py)
+y se reportan los tokens de entrada y la latencia de cada turno.
+
+Uso:
+    python -m benchmarks.bench_contexto [--turnos 50] [--medicos 150] [--presupuesto 4000] [--ms-por-1k-tokens 40]
+                                        [--modo ambos|acotado|sin_acotar] [--detalle]
+"""
+import argparse
+import os
+import sqlite3
+import statistics
+import time
+
+from benchmarks._comun import usar_db_temporal, imprimir_resultado
+from benchmarks.bench_agendar_cita import _horario_todo_el_dia
+
+MENSAJES = [
+    "Hola, ¿qué médicos hay en la clínica?",
+    "Quisiera revisar mis citas pendientes",
+    "¿Cuáles son los horarios libres de esta semana?",
+    "Gracias. ¿Me explicas cómo me preparo para una consulta de rutina? (pregunta {i})",
+    "¿Hay algún especialista en cardiología disponible?",
+]
+
+
+def poblar(ruta_db, total_medicos):
+    conn = sqlite3.connect(ruta_db)
+    especialidades = ["Cardiología", "Pediatría", "Dermatología", "Neurología", "Medicina General"]
+    conn.executemany(
+        "INSERT INTO medicos (nombre_completo, especialidad, horario_trabajo, ubicacion) VALUES (?, ?, ?, ?)",
+        ((f"Dr. Contexto {i}", especialidades[i % len(especialidades)], _horario_todo_el_dia(), f"Consultorio {i}")
+         for i in range(total_medicos)),
+    )
+    conn.commit()
+    conn.close()
+
+
+def conversar(user, turnos):
+    from controllers.ai_controller import AiController
+
+    controller = AiController(user=user)
+    filas = []
+    for i in range(turnos):
+        mensaje = MENSAJES[i % len(MENSAJES)].format(i=i)
+        inicio = time.perf_counter()
+        controller.handle_message(mensaje)
+        filas.append((i + 1, controller.tokens_turno, time.perf_counter() - inicio, len(controller.chat.history)))
+    return filas
+
+
+def resumen(titulo, filas):
+    # Promedios por bloques de 10 turnos: con el historial acotado deben dejar de crecer
+    for inicio in range(0, len(filas), 10):
+        bloque = filas[inicio:inicio + 10]
+        imprimir_resultado(f"{titulo} (turnos {bloque[0][0]}-{bloque[-1][0]})", {
+            "tokens_entrada_prom": round(statistics.fmean(f[1] for f in bloque)),
+            "tokens_entrada_max": max(f[1] for f in bloque),
+            "ms_prom": round(statistics.fmean(f[2] for f in bloque) * 1000, 1),
+            "mensajes_historial": bloque[-1][3],
+        })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turnos", type=int, default=50)
+    parser.add_argument("--medicos", type=int, default=150, help="Médicos en la base (tamaño del resultado de get_medicos)")
+    parser.add_argument("--presupuesto", type=int, default=4000, help="AI_CONTEXTO_TOKENS del modo acotado")
+    parser.add_argument("--modo", choices=("ambos", "acotado", "sin_acotar"), default="ambos")
+    parser.add_argument("--latencia-ms", type=float, default=50)
+    parser.add_argument("--ms-por-1k-tokens", type=float, default=40, help="Latencia del Gemini falso por cada 1000 tokens")
+    parser.add_argument("--detalle", action="store_true", help="Imprimir tokens y latencia de cada turno")
+    args = parser.parse_args()
+
+    ruta_db = usar_db_temporal()
+    from benchmarks.fake_gemini import FakeGemini
+    fake = FakeGemini(latencia_ms=args.latencia_ms, ms_por_1k_tokens=args.ms_por_1k_tokens).iniciar()
+    os.environ["GEMINI_API_KEY"] = "falsa"
+    os.environ["GEMINI_API_ENDPOINT"] = fake.url
+    # Todo va a Gemini: sin atajos ni caché de herramientas
+    os.environ["CHAT_INTENT_ROUTER"] = "0"
+    os.environ["AI_CACHE"] = "0"
+
+    from controllers.database import init_db
+    from controllers import contexto
+    from services import auth_service
+
+    init_db()
+    poblar(ruta_db, args.medicos)
+    auth_service.crear_paciente("contexto", "bench123", "Paciente Contexto", "contexto@example.com", "5550000000")
+    user_id = auth_service.validar_usuario("contexto", "bench123")["id"]
+    user = auth_service.get_user_data_for_session(user_id)
+    print(f"Base de datos: {ruta_db} | Gemini falso en {fake.url}")
+
+    try:
+        modos = {"sin_acotar": ("historial sin acotar", 0), "acotado": ("historial acotado", args.presupuesto)}
+        elegidos = ("sin_acotar", "acotado") if args.modo == "ambos" else (args.modo,)
+        for titulo, presupuesto in (modos[modo] for modo in elegidos):
+            contexto.CONTEXTO_TOKENS = presupuesto
+            filas = conversar(user, args.turnos)
+            if args.detalle:
+                print(f"--- {titulo} ---")
+                for turno, tokens, segundos, mensajes in filas:
+                    print(f"turno {turno:>3}  tokens_entrada={tokens:>7}  ms={segundos * 1000:>8.1f}  mensajes={mensajes}")
+            resumen(titulo, filas)
+    finally:
+        fake.detener()
+
+
+if __name__ == "__main__":
+    main()
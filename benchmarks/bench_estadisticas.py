@@ -0,0 +1,112 @@
+"""
+Benchmark: estadísticas del dashboard con muchas citas.
+
+Llena la base con N citas (por defecto 1 millón, repartidas en --medicos
+médicos y --dias días; los triggers mantienen estadisticas_citas mientras
+se insertan) y compara, para el rango por defecto del dashboard:
+  - la consulta directa sobre citas (lo que habría que hacer sin la tabla)
+  - estadisticas_service.get_estadisticas (lee estadisticas_citas)
+También mide reconstruir_estadisticas (backfill completo).
+
+Uso:
+    python -m benchmarks.bench_estadisticas [--citas 1000000] [--medicos 200] [--dias 730] [--repeticiones 20]
+"""
+import argparse
+import random
+import sqlite3
+import time
+from datetime import date, datetime, timedelta
+
+from benchmarks._comun import usar_db_temporal, cronometrar, percentiles, imprimir_resultado
+from benchmarks.bench_agendar_cita import _horario_todo_el_dia
+
+ESTADOS = ("programada", "completada", "completada", "completada", "cancelada")
+
+# Lo mismo que get_estadisticas, pero agregando la tabla citas
+CONSULTA_DIRECTA = """
+    SELECT medico_id, date(fecha_hora_inicio) AS dia,
+           SUM(estado = 'programada'), SUM(estado = 'completada'), SUM(estado = 'cancelada'),
+           SUM(CASE WHEN estado = 'cancelada' THEN 0 ELSE duracion_minutos END)
+    FROM citas
+    WHERE fecha_hora_inicio >= ? AND fecha_hora_inicio < ?
+    GROUP BY medico_id, dia
+"""
+
+
+def poblar(ruta_db, total_citas, total_medicos, dias, lote=50_000):
+    conn = sqlite3.connect(ruta_db)
+    conn.executemany(
+        "INSERT INTO medicos (nombre_completo, especialidad, horario_trabajo, ubicacion) VALUES (?, ?, ?, ?)",
+        ((f"Dr. Estadística {i}", "Medicina General", _horario_todo_el_dia(), f"Consultorio {i}")
+         for i in range(total_medicos)),
+    )
+    conn.execute("INSERT INTO usuarios (username, password_hash) VALUES ('bench', 'x')")
+    conn.execute("INSERT INTO pacientes (usuario_id, nombre_completo, email) VALUES (1, 'Paciente', 'b@example.com')")
+    conn.commit()
+
+    # Citas de 30 minutos, sin repetir (médico, hora): el último año y el siguiente
+    rng = random.Random(42)
+    primer_dia = datetime.combine(date.today() - timedelta(days=dias // 2), datetime.min.time())
+    huecos_por_dia = 48
+    inicio = time.perf_counter()
+    insertadas = 0
+    while insertadas < total_citas:
+        filas = []
+        for n in range(insertadas, min(total_citas, insertadas + lote)):
+            medico = n % total_medicos + 1
+            hueco = n // total_medicos
+            inicio_cita = primer_dia + timedelta(days=hueco % dias, minutes=30 * (hueco // dias % huecos_por_dia))
+            filas.append((1, medico, inicio_cita, 30, inicio_cita + timedelta(minutes=30), rng.choice(ESTADOS)))
+        conn.executemany(
+            "INSERT OR IGNORE INTO citas (paciente_id, medico_id, fecha_hora_inicio, duracion_minutos, fecha_hora_fin, estado) "
+            "VALUES (?, ?, ?, ?, ?, ?)", filas
+        )
+        conn.commit()
+        insertadas += len(filas)
+    segundos = time.perf_counter() - inicio
+    conn.close()
+    return segundos
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--citas", type=int, default=1_000_000)
+    parser.add_argument("--medicos", type=int, default=200)
+    parser.add_argument("--dias", type=int, default=730, help="Días que abarcan las citas (la mitad en el pasado)")
+    parser.add_argument("--repeticiones", type=int, default=20)
+    args = parser.parse_args()
+
+    ruta_db = usar_db_temporal()
+    from controllers.database import init_db, get_db_connection
+    from services import estadisticas_service
+
+    init_db()
+    segundos = poblar(ruta_db, args.citas, args.medicos, args.dias)
+    imprimir_resultado("poblar (con triggers)", {
+        "citas": args.citas, "segundos": round(segundos, 1), "citas_por_s": round(args.citas / segundos)
+    })
+
+    hasta = date.today()
+    desde = hasta - timedelta(days=estadisticas_service.DIAS_POR_DEFECTO - 1)
+    rango = (desde.isoformat(), (hasta + timedelta(days=1)).isoformat())
+
+    def directa(_):
+        conn = get_db_connection()
+        try:
+            conn.execute(CONSULTA_DIRECTA, rango).fetchall()
+        finally:
+            conn.close()
+
+    def tabla(_):
+        resultado = estadisticas_service.get_estadisticas(desde=desde, hasta=hasta)
+        assert "error" not in resultado, resultado
+
+    imprimir_resultado("consulta directa sobre citas", percentiles(cronometrar(directa, args.repeticiones)))
+    imprimir_resultado("get_estadisticas (tabla agregada)", percentiles(cronometrar(tabla, args.repeticiones)))
+
+    resultado = estadisticas_service.reconstruir()
+    imprimir_resultado("reconstruir_estadisticas", resultado)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Benchmark: exportar 1 millón de citas a CSV e iCalendar.
+
+Llena la base como bench_estadisticas y recorre completas las
+exportaciones de exportacion_service (lo que haría la respuesta en
+streaming), midiendo tiempo, filas/s y tamaño del archivo. Una segunda
+pasada con tracemalloc (que la hace varias veces más lenta) mide el pico
+de memoria de Python; --sin-memoria la omite. Con --comparar también se
+mide el patrón anterior: fetchall() a una lista de dicts.
+
+Uso:
+    python -m benchmarks.bench_exportacion [--citas 1000000] [--medicos 200] [--lote 1000] [--comparar] [--sin-memoria]
+"""
+import argparse
+import time
+import tracemalloc
+
+from benchmarks._comun import usar_db_temporal, imprimir_resultado
+from benchmarks.bench_estadisticas import poblar
+
+
+def medir(titulo, funcion, memoria=True):
+    inicio = time.perf_counter()
+    filas, tamano = funcion()
+    segundos = time.perf_counter() - inicio
+    datos = {
+        "filas": filas,
+        "segundos": round(segundos, 2),
+        "filas_por_s": round(filas / segundos) if segundos else 0,
+        "mb_archivo": round(tamano / 1e6, 1),
+    }
+    if memoria:
+        tracemalloc.start()
+        funcion()
+        datos["mb_pico_memoria"] = round(tracemalloc.get_traced_memory()[1] / 1e6, 2)
+        tracemalloc.stop()
+    imprimir_resultado(titulo, datos)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--citas", type=int, default=1_000_000)
+    parser.add_argument("--medicos", type=int, default=200)
+    parser.add_argument("--dias", type=int, default=730)
+    parser.add_argument("--lote", type=int, default=None, help="Filas por fetchmany (default: EXPORTACION_LOTE)")
+    parser.add_argument("--comparar", action="store_true", help="Medir también fetchall() a una lista de dicts")
+    parser.add_argument("--sin-memoria", action="store_true", help="No hacer la pasada con tracemalloc")
+    args = parser.parse_args()
+
+    ruta_db = usar_db_temporal()
+    from controllers.database import init_db, get_db_connection
+    from services import exportacion_service
+
+    init_db()
+    segundos = poblar(ruta_db, args.citas, args.medicos, args.dias)
+    conn = get_db_connection()
+    total = conn.execute("SELECT COUNT(*) FROM citas").fetchone()[0]
+    conn.close()
+    print(f"Base de datos: {ruta_db} | {total} citas en {segundos:.1f} s")
+
+    def exportar(formato):
+        def recorrer():
+            resultado = exportacion_service.exportar_citas(formato, tamano_lote=args.lote)
+            tamano = sum(len(trozo.encode("utf-8")) for trozo in resultado["contenido"])
+            return total, tamano
+        return recorrer
+
+    medir("exportar_citas csv", exportar("csv"), memoria=not args.sin_memoria)
+    medir("exportar_citas ics", exportar("ics"), memoria=not args.sin_memoria)
+
+    if args.comparar:
+        def fetchall():
+            conn = get_db_connection()
+            try:
+                sql, params = exportacion_service._consulta_citas()
+                citas = [dict(fila) for fila in conn.execute(sql, params).fetchall()]
+            finally:
+                conn.close()
+            return len(citas), 0
+        medir("fetchall a lista de dicts", fetchall)
+
+
+if __name__ == "__main__":
+    main()
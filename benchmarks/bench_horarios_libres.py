@@ -0,0 +1,120 @@
+"""
+Benchmark: buscar_horarios_libres sobre 200 médicos y un horizonte de 3 meses.
+
+Crea médicos con horario L-V (09:00-13:00, 14:00-17:00) repartidos en
+varias especialidades y ocupa al azar una fracción de sus slots durante
+los próximos 3 meses. Mide la latencia de obtener los primeros N horarios
+libres: de cualquier médico, por especialidad, por médico, y el peor caso
+de un médico saturado hasta el final del horizonte.
+
+Uso:
+    python -m benchmarks.bench_horarios_libres [--medicos 200] [--ocupacion 0.8] [--limite 10]
+"""
+import argparse
+import json
+import random
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+from benchmarks._comun import usar_db_temporal, percentiles, cronometrar, imprimir_resultado
+
+ESPECIALIDADES = [
+    "Cardiología", "Dermatología", "Pediatría", "Neurología", "Ginecología",
+    "Oftalmología", "Traumatología", "Psiquiatría", "Medicina General", "Endocrinología",
+]
+TURNOS = ((9 * 60, 13 * 60), (14 * 60, 17 * 60))
+HORARIO = json.dumps({dia: ["09:00-13:00", "14:00-17:00"] for dia in ("lunes", "martes", "miercoles", "jueves", "viernes")})
+
+
+def poblar(ruta_db, total_medicos, ocupacion, dias):
+    conn = sqlite3.connect(ruta_db)
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("INSERT INTO usuarios (username, password_hash, role) VALUES ('bench', 'x', 'paciente')")
+    conn.execute(
+        "INSERT INTO pacientes (usuario_id, nombre_completo, email) VALUES (last_insert_rowid(), 'Paciente Bench', 'bench@example.com')"
+    )
+    paciente_id = conn.execute("SELECT id FROM pacientes").fetchone()[0]
+    conn.executemany(
+        "INSERT INTO medicos (nombre_completo, especialidad, horario_trabajo, ubicacion) VALUES (?, ?, ?, ?)",
+        ((f"Dr. Bench {i}", ESPECIALIDADES[i % len(ESPECIALIDADES)], HORARIO, f"Consultorio {i}") for i in range(total_medicos)),
+    )
+    medicos = [row[0] for row in conn.execute("SELECT id FROM medicos WHERE nombre_completo LIKE 'Dr. Bench %' ORDER BY id")]
+    saturado = medicos[0]
+
+    hoy = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    rnd = random.Random(7)
+
+    def filas():
+        for medico_id in medicos:
+            for d in range(dias + 1):
+                dia = hoy + timedelta(days=d)
+                if dia.weekday() >= 5:
+                    continue
+                for inicio_turno, fin_turno in TURNOS:
+                    for minuto in range(inicio_turno, fin_turno, 30):
+                        # El médico "saturado" tiene todo ocupado menos el último día
+                        lleno = medico_id == saturado and d < dias - 1
+                        if lleno or rnd.random() < ocupacion:
+                            inicio = dia + timedelta(minutes=minuto)
+                            yield (paciente_id, medico_id, inicio, 30, inicio + timedelta(minutes=30))
+
+    conn.executemany(
+        """
+        INSERT INTO citas (paciente_id, medico_id, fecha_hora_inicio, duracion_minutos, fecha_hora_fin)
+        VALUES (?, ?, ?, ?, ?)
+        """,
+        filas(),
+    )
+    total = conn.execute("SELECT COUNT(*) FROM citas").fetchone()[0]
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+    return medicos, saturado, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--medicos", type=int, default=200)
+    parser.add_argument("--ocupacion", type=float, default=0.8)
+    parser.add_argument("--dias", type=int, default=90)
+    parser.add_argument("--limite", type=int, default=10)
+    parser.add_argument("--repeticiones", type=int, default=50)
+    args = parser.parse_args()
+
+    ruta_db = usar_db_temporal()
+    from controllers.database import init_db
+    from services import cita_service
+
+    init_db()
+    t0 = time.perf_counter()
+    medicos, saturado, total = poblar(ruta_db, args.medicos, args.ocupacion, args.dias)
+    print(f"{len(medicos)} médicos, {total:,} citas programadas en {args.dias} días "
+          f"(ocupación {args.ocupacion:.0%}), carga en {time.perf_counter() - t0:.1f}s")
+
+    hasta = (datetime.now() + timedelta(days=args.dias)).strftime('%Y-%m-%dT%H:%M')
+
+    def caso(**kwargs):
+        def _run(i):
+            resultado = cita_service.buscar_horarios_libres(hasta=hasta, limite=args.limite, **kwargs)
+            if "error" in resultado:
+                raise RuntimeError(resultado)
+        return _run
+
+    rnd = random.Random(1)
+    casos = [
+        ("todos los médicos", caso()),
+        ("por especialidad", lambda i: caso(especialidad=ESPECIALIDADES[i % len(ESPECIALIDADES)])(i)),
+        ("por médico", lambda i: caso(medico_id=rnd.choice(medicos))(i)),
+        ("médico saturado (peor caso)", caso(medico_id=saturado)),
+    ]
+    for titulo, funcion in casos:
+        funcion(0)   # calentar el caché de horarios
+        imprimir_resultado(f"primeros {args.limite}: {titulo}", percentiles(cronometrar(funcion, args.repeticiones)))
+
+    ejemplo = cita_service.buscar_horarios_libres(medico_id=saturado, hasta=hasta, limite=3)
+    print("Ejemplo (médico saturado):", [h["inicio"] for h in ejemplo["horarios"]])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+"""
+Prueba de carga extremo a extremo: login, portal, dashboard de admin,
+agendado y chat (normal y en streaming) contra la app real por HTTP.
+
+Por defecto levanta todo en el proceso: una base de datos temporal, el
+servidor falso de Gemini (benchmarks/fake_gemini.py) y la app Flask en un
+servidor con hilos. Con --url se prueba una app ya levantada (que debe
+apuntar a un Gemini falso o real por su cuenta).
+
+Reporta por ruta: peticiones, errores, throughput y latencia p50/p95/p99.
+Con --json se guarda el resultado para compararlo entre versiones.
+
+Uso:
+    python -m benchmarks.carga [--usuarios 8] [--duracion 30] [--medicos 5]
+                               [--latencia-ms 300] [--errores-gemini 0.1] [--sin-atajos] [--json resultado.json]
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime, timedelta
+
+from benchmarks._comun import usar_db_temporal, percentiles
+from benchmarks.bench_agendar_cita import _horario_todo_el_dia
+
+# Escenarios de un paciente: (nombre, peso)
+ESCENARIOS = (
+    ("portal", 30),
+    ("chat_medicos", 15),
+    ("chat_agendar", 15),
+    ("chat_mis_citas", 10),
+    ("chat_stream", 15),
+    ("chat_historial", 10),
+    ("buscar_medicos", 5),
+)
+
+
+class _SinRedirecciones(urllib.request.HTTPRedirectHandler):
+    # Se mide cada ruta por separado: no seguir los 302
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class Metricas:
+    """Latencias y errores por ruta, compartidas entre hilos."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencias = {}
+        self.errores = {}
+
+    def registrar(self, ruta, segundos, ok):
+        with self._lock:
+            self.latencias.setdefault(ruta, []).append(segundos)
+            if not ok:
+                self.errores[ruta] = self.errores.get(ruta, 0) + 1
+
+    def reporte(self, duracion):
+        filas = {}
+        for ruta, muestras in sorted(self.latencias.items()):
+            filas[ruta] = {
+                **percentiles(muestras),
+                "errores": self.errores.get(ruta, 0),
+                "req_por_s": round(len(muestras) / duracion, 2),
+            }
+        return filas
+
+
+class Cliente:
+    """Un navegador: cookies propias y métricas por ruta."""
+
+    def __init__(self, base, metricas):
+        self.base = base.rstrip("/")
+        self.metricas = metricas
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+            _SinRedirecciones(),
+        )
+
+    def pedir(self, metodo, ruta, nombre=None, form=None, json_=None, stream=False):
+        """
+        Hace una petición y registra su latencia bajo 'nombre' (o "METODO ruta").
+        Devuelve (estado, cuerpo). Los 3xx cuentan como éxito.
+        """
+        datos, cabeceras = None, {}
+        if form is not None:
+            datos = urllib.parse.urlencode(form).encode()
+            cabeceras["Content-Type"] = "application/x-www-form-urlencoded"
+        elif json_ is not None:
+            datos = json.dumps(json_).encode()
+            cabeceras["Content-Type"] = "application/json"
+        peticion = urllib.request.Request(self.base + ruta, data=datos, headers=cabeceras, method=metodo)
+        nombre = nombre or f"{metodo} {ruta.split('?')[0]}"
+
+        inicio = time.perf_counter()
+        try:
+            with self.opener.open(peticion, timeout=120) as respuesta:
+                if stream:
+                    # Tiempo hasta el primer evento y hasta el final del stream
+                    primera = respuesta.readline()
+                    self.metricas.registrar(nombre + " (primer evento)", time.perf_counter() - inicio, bool(primera))
+                    cuerpo = primera + respuesta.read()
+                else:
+                    cuerpo = respuesta.read()
+                estado = respuesta.status
+        except urllib.error.HTTPError as e:
+            estado, cuerpo = e.code, e.read()
+        except Exception as e:
+            # Cualquier otro fallo (red, URL inválida, respuesta cortada) cuenta como error
+            # de esta petición; no debe terminar el hilo del usuario virtual
+            estado, cuerpo = 0, f"{type(e).__name__}: {e}".encode()
+        ok = 200 <= estado < 400
+        if stream and b"event: error" in cuerpo:
+            ok = False
+        self.metricas.registrar(nombre, time.perf_counter() - inicio, ok)
+        return estado, cuerpo
+
+    def login(self, username, password):
+        return self.pedir("POST", "/auth/login", form={"username": username, "password": password})
+
+
+def _levantar_en_proceso(args):
+    """Base de datos temporal + Gemini falso + app Flask en hilos. Devuelve (url, fake)."""
+    from benchmarks.fake_gemini import FakeGemini
+    from werkzeug.serving import make_server
+
+    ruta_db = usar_db_temporal()
+    fake = FakeGemini(latencia_ms=args.latencia_ms, jitter_ms=args.latencia_ms * 0.2,
+                      tasa_errores=args.errores_gemini).iniciar()
+    os.environ["GEMINI_API_KEY"] = "falsa"
+    os.environ["GEMINI_API_ENDPOINT"] = fake.url
+    # Un hilo por usuario virtual + admin: que el pool no sea el cuello de botella
+    os.environ.setdefault("DB_POOL_SIZE", str(args.usuarios + 4))
+    if args.sin_atajos:
+        os.environ["CHAT_INTENT_ROUTER"] = "0"
+
+    import logging
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+    from app import create_app
+    app = create_app()
+    servidor = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    print(f"App en http://127.0.0.1:{servidor.server_port} | Gemini falso en {fake.url} | BD {ruta_db}")
+    return f"http://127.0.0.1:{servidor.server_port}", fake
+
+
+def preparar_datos(url, args, metricas):
+    """Crea médicos (como admin) y pacientes (por el formulario de registro)."""
+    admin = Cliente(url, metricas)
+    admin.login(args.admin_usuario, args.admin_password)
+    for i in range(args.medicos):
+        admin.pedir("POST", "/views/admin/dashboard", nombre="preparar: registrar médico", form={
+            "registrar_medico": "true",
+            "nombre_completo": f"Dr. Carga {i}",
+            "especialidad": random.choice(["Cardiología", "Pediatría", "Dermatología", "Neurología"]),
+            "ubicacion": f"Consultorio {100 + i}",
+            "horario_trabajo": _horario_todo_el_dia(),
+        })
+    estado, cuerpo = admin.pedir("GET", "/views/admin/api/medicos?q=Dr.%20Carga&limite=200", nombre="preparar: listar médicos")
+    medicos = [m["id"] for m in json.loads(cuerpo).get("medicos", [])] if estado == 200 else []
+
+    sufijo = int(time.time())
+    pacientes = []
+    for i in range(args.usuarios):
+        username = f"carga_{sufijo}_{i}"
+        Cliente(url, metricas).pedir("POST", "/auth/register", nombre="preparar: registro", form={
+            "username": username, "password": "carga123",
+            "nombre_completo": f"Paciente Carga {i}",
+            "email": f"{username}@example.com", "telefono": "5550000000",
+        })
+        pacientes.append(username)
+    return medicos, pacientes
+
+
+def paciente_virtual(url, username, medicos, metricas, hasta, semilla):
+    rnd = random.Random(semilla)
+    cliente = Cliente(url, metricas)
+    cliente.login(username, "carga123")
+    nombres, pesos = zip(*ESCENARIOS)
+    manana = datetime.now().replace(hour=8, minute=0, second=0, microsecond=0) + timedelta(days=1)
+
+    while time.perf_counter() < hasta:
+        escenario = rnd.choices(nombres, pesos)[0]
+        if escenario == "portal":
+            cliente.pedir("GET", "/views/portal")
+        elif escenario == "buscar_medicos":
+            busqueda = urllib.parse.urlencode({"q": rnd.choice(["cardio", "pediatria", "consultorio 10"])})
+            cliente.pedir("GET", "/views/portal?" + busqueda, nombre="GET /views/portal?q=")
+        elif escenario == "chat_historial":
+            cliente.pedir("GET", "/chat/api/chat/historial")
+        elif escenario == "chat_medicos":
+            cliente.pedir("POST", "/chat/api/chat", nombre="POST /chat/api/chat (médicos)",
+                          json_={"message": "Me podrías decir qué doctores de cardiología atienden en la clínica?"})
+        elif escenario == "chat_mis_citas":
+            cliente.pedir("POST", "/chat/api/chat", nombre="POST /chat/api/chat (mis citas)",
+                          json_={"message": "Quisiera revisar mis citas pendientes por favor"})
+        elif escenario == "chat_agendar" and medicos:
+            inicio = manana + timedelta(days=rnd.randrange(30), minutes=30 * rnd.randrange(20))
+            mensaje = f"Agenda una cita con el medico {rnd.choice(medicos)} el {inicio:%Y-%m-%dT%H:%M} por favor"
+            cliente.pedir("POST", "/chat/api/chat", nombre="POST /chat/api/chat (agendar)", json_={"message": mensaje})
+        elif escenario == "chat_stream":
+            cliente.pedir("POST", "/chat/api/chat/stream", stream=True,
+                          json_={"message": "Hola, ¿me cuentas cómo funciona la clínica y sus servicios?"})
+
+
+def admin_virtual(url, args, metricas, hasta):
+    cliente = Cliente(url, metricas)
+    cliente.login(args.admin_usuario, args.admin_password)
+    while time.perf_counter() < hasta:
+        cliente.pedir("GET", "/views/admin/dashboard")
+        cliente.pedir("GET", "/views/admin/api/pacientes?limite=50")
+        time.sleep(args.pausa_admin)
+
+
+def imprimir_reporte(reporte, duracion):
+    print("=" * 110)
+    print(f"{'ruta':<45}{'n':>7}{'err':>6}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    print("-" * 110)
+    total = 0
+    for ruta, fila in reporte.items():
+        if ruta.startswith("preparar"):
+            continue
+        total += fila["n"]
+        print(f"{ruta:<45}{fila['n']:>7}{fila['errores']:>6}{fila['req_por_s']:>9}"
+              f"{fila['p50_ms']:>10}{fila['p95_ms']:>10}{fila['p99_ms']:>10}{fila['max_ms']:>10}")
+    print("-" * 110)
+    print(f"Total: {total} peticiones en {duracion:.1f}s ({total / duracion:.1f} req/s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="App ya levantada (si no, se levanta en el proceso)")
+    parser.add_argument("--usuarios", type=int, default=8, help="Pacientes virtuales concurrentes")
+    parser.add_argument("--admins", type=int, default=1, help="Administradores virtuales concurrentes")
+    parser.add_argument("--duracion", type=float, default=30, help="Segundos de carga")
+    parser.add_argument("--medicos", type=int, default=5, help="Médicos a registrar antes de empezar")
+    parser.add_argument("--latencia-ms", type=float, default=300, help="Latencia del Gemini falso")
+    parser.add_argument("--errores-gemini", type=float, default=0.0,
+                        help="Fracción de llamadas al Gemini falso que responden 429/503")
+    parser.add_argument("--sin-atajos", action="store_true", help="Desactiva el atajo de intenciones (todo va al LLM)")
+    parser.add_argument("--pausa-admin", type=float, default=0.5)
+    parser.add_argument("--admin-usuario", default="admin")
+    parser.add_argument("--admin-password", default="admin123")
+    parser.add_argument("--json", help="Guardar el reporte en este archivo")
+    args = parser.parse_args()
+
+    fake = None
+    url = args.url
+    if not url:
+        url, fake = _levantar_en_proceso(args)
+
+    metricas = Metricas()
+    medicos, pacientes = preparar_datos(url, args, metricas)
+    print(f"Preparados {len(medicos)} médicos y {len(pacientes)} pacientes. Carga por {args.duracion:.0f}s...")
+
+    inicio = time.perf_counter()
+    hasta = inicio + args.duracion
+    hilos = [
+        threading.Thread(target=paciente_virtual, args=(url, username, medicos, metricas, hasta, i))
+        for i, username in enumerate(pacientes)
+    ] + [
+        threading.Thread(target=admin_virtual, args=(url, args, metricas, hasta))
+        for _ in range(args.admins)
+    ]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+    duracion = time.perf_counter() - inicio
+
+    reporte = metricas.reporte(duracion)
+    imprimir_reporte(reporte, duracion)
+    if fake:
+        print(f"Llamadas al Gemini falso: {fake.stats()}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as archivo:
+            json.dump({
+                "fecha": datetime.now().isoformat(timespec="seconds"),
+                "parametros": {k: v for k, v in vars(args).items() if k not in ("json", "admin_password")},
+                "duracion_s": round(duracion, 2),
+                "rutas": reporte,
+            }, archivo, indent=2, ensure_ascii=False)
+        print(f"Reporte guardado en {args.json}")
+
+
+if __name__ == "__main__":
+    main()
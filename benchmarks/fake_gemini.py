@@ -0,0 +1,313 @@
+"""
+Servidor falso de la API REST de Gemini para pruebas de carga.
+
+Implementa generateContent, streamGenerateContent y countTokens de
+/v1beta/models/{modelo}. Responde con llamadas a herramientas según
+reglas (expresiones regulares, sin distinguir acentos ni mayúsculas,
+sobre el último mensaje del usuario) y con texto cuando recibe el
+resultado de una herramienta. La latencia es configurable para simular
+el tiempo del modelo real.
+
+La app se conecta a él con:
+    GEMINI_API_KEY=falsa GEMINI_API_ENDPOINT=http://127.0.0.1:8765 python app.py
+
+Uso:
+    python -m benchmarks.fake_gemini [--puerto 8765] [--latencia-ms 400] [--jitter-ms 100] [--reglas reglas.json] [--errores 0.1]
+
+--ms-por-1k-tokens suma latencia según el tamaño del prompt (como el
+modelo real, que tarda más con más contexto).
+
+--errores es la fracción de llamadas de generación que responden 429 o
+503 (como cuando se agota la cuota), para probar los reintentos.
+
+Formato de --reglas (lista JSON, se usa la primera que coincide):
+    [{"patron": "agenda .* medico (?P<medico_id>\\d+)", "latencia_ms": 600,
+      "llamadas": [{"name": "agendar_cita", "args": {"medico_id": "{medico_id}"}}]}]
+Los "{grupo}" en los argumentos se reemplazan por los grupos con nombre
+del patrón; los que parecen números se envían como números (igual que Gemini).
+
+GET /stats devuelve cuántas llamadas recibió por método y herramienta.
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import unicodedata
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Reglas por defecto: cubren las herramientas de AiController
+REGLAS_POR_DEFECTO = [
+    {"patron": r"mis citas|mis proximas citas|citas tengo",
+     "llamadas": [{"name": "get_mis_citas", "args": {}}]},
+    {"patron": r"agenda\w*\b.*\bmedico (?P<medico_id>\d+)\b.*\b(?P<fecha>\d{4}-\d{2}-\d{2}T\d{2}:\d{2})",
+     "llamadas": [{"name": "agendar_cita", "args": {"medico_id": "{medico_id}", "fecha_hora_inicio": "{fecha}"}}]},
+    {"patron": r"horarios? libres?|cuando hay lugar|proximo hueco",
+     "llamadas": [{"name": "buscar_horarios_libres", "args": {"limite": 5}}]},
+    {"patron": r"\b(?P<especialidad>cardiolog\w*|pediatr\w*|dermatolog\w*|neurolog\w*)",
+     "llamadas": [{"name": "get_medicos_disponibles", "args": {"especialidad": "{especialidad}"}}]},
+    {"patron": r"medicos|doctores|especialistas",
+     "llamadas": [{"name": "get_medicos_disponibles", "args": {}}]},
+]
+
+# finishReason STOP (la API REST se pide con enum-encoding=int)
+FIN_STOP = 1
+
+
+def _sin_acentos(texto):
+    # Sin casefold: los grupos capturados conservan su forma (ej. la 'T' de las fechas)
+    descompuesto = unicodedata.normalize("NFKD", texto)
+    return "".join(c for c in descompuesto if not unicodedata.combining(c))
+
+
+def _valor(plantilla, grupos):
+    if not isinstance(plantilla, str):
+        return plantilla
+    valor = re.sub(r"\{(\w+)\}", lambda m: grupos.get(m.group(1)) or "", plantilla)
+    return float(valor) if re.fullmatch(r"\d+(\.\d+)?", valor) else valor
+
+
+def _tokens(texto):
+    # Aproximación: ~4 caracteres por token
+    return max(1, len(texto) // 4)
+
+
+def _tokens_prompt(cuerpo):
+    # El prompt del sistema se cobra en cada llamada, igual que el historial
+    prompt = [cuerpo.get("systemInstruction"), cuerpo.get("contents") or []]
+    return _tokens(json.dumps(prompt, ensure_ascii=False))
+
+
+class FakeGemini:
+    """
+    Servidor HTTP (en un hilo) que imita la API REST de Gemini.
+    Uso en proceso: `fake = FakeGemini(latencia_ms=300).iniciar()` ... `fake.detener()`.
+    """
+
+    def __init__(self, host="127.0.0.1", puerto=0, latencia_ms=300, jitter_ms=0,
+                 intervalo_stream_ms=20, reglas=None, tasa_errores=0.0, ms_por_1k_tokens=0.0):
+        self.latencia_ms = latencia_ms
+        self.ms_por_1k_tokens = ms_por_1k_tokens
+        self.tasa_errores = tasa_errores
+        self.jitter_ms = jitter_ms
+        self.intervalo_stream_ms = intervalo_stream_ms
+        self.reglas = [dict(r, _re=re.compile(r["patron"], re.IGNORECASE)) for r in (reglas or REGLAS_POR_DEFECTO)]
+        self.contadores = {}
+        self._lock = threading.Lock()
+        self._servidor = ThreadingHTTPServer((host, puerto), self._crear_handler())
+        self._servidor.daemon_threads = True
+        self._hilo = None
+
+    @property
+    def url(self):
+        host, puerto = self._servidor.server_address[:2]
+        return f"http://{host}:{puerto}"
+
+    def iniciar(self):
+        self._hilo = threading.Thread(target=self._servidor.serve_forever, daemon=True)
+        self._hilo.start()
+        return self
+
+    def detener(self):
+        self._servidor.shutdown()
+        self._servidor.server_close()
+
+    def stats(self):
+        with self._lock:
+            return dict(self.contadores)
+
+    def _contar(self, clave):
+        with self._lock:
+            self.contadores[clave] = self.contadores.get(clave, 0) + 1
+
+    def _esperar(self, latencia_ms=None, tokens_prompt=0):
+        latencia = self.latencia_ms if latencia_ms is None else latencia_ms
+        latencia += self.ms_por_1k_tokens * tokens_prompt / 1000
+        if self.jitter_ms:
+            latencia += random.uniform(-self.jitter_ms, self.jitter_ms)
+        if latencia > 0:
+            time.sleep(latencia / 1000)
+
+    # --- Lógica de respuesta ---
+
+    def responder(self, cuerpo):
+        """
+        Devuelve (partes, latencia_ms) para un request de generateContent.
+        """
+        contenidos = cuerpo.get("contents") or []
+        ultimo = contenidos[-1] if contenidos else {"parts": []}
+        partes = ultimo.get("parts") or []
+
+        # 1. Resultado de herramientas -> texto final
+        resultados = [p["functionResponse"] for p in partes if "functionResponse" in p]
+        if resultados:
+            return [{"text": self._resumir(resultados)}], None
+
+        # 2. Mensaje del usuario -> llamada a herramienta según las reglas
+        texto = " ".join(p.get("text", "") for p in partes)
+        normalizado = _sin_acentos(texto)
+        for regla in self.reglas:
+            coincidencia = regla["_re"].search(normalizado)
+            if coincidencia:
+                grupos = coincidencia.groupdict()
+                llamadas = [
+                    {"functionCall": {
+                        "name": llamada["name"],
+                        "args": {k: _valor(v, grupos) for k, v in llamada.get("args", {}).items()},
+                    }}
+                    for llamada in regla["llamadas"]
+                ]
+                for llamada in llamadas:
+                    self._contar("herramienta:" + llamada["functionCall"]["name"])
+                return llamadas, regla.get("latencia_ms")
+
+        # 3. Conversación libre
+        return [{"text": f"Respuesta de prueba. Recibí tu mensaje: {texto[:200]}"}], None
+
+    def _resumir(self, resultados):
+        lineas = []
+        for resultado in resultados:
+            respuesta = resultado.get("response") or {}
+            # AiController envuelve el resultado en {"result": ...}
+            if isinstance(respuesta.get("result"), dict):
+                respuesta = respuesta["result"]
+            nombre = resultado.get("name")
+            if "error" in respuesta:
+                lineas.append(f"No se pudo completar {nombre}: {respuesta['error']}")
+            elif nombre == "agendar_cita":
+                lineas.append(f"¡Listo! Tu cita quedó agendada (ID {respuesta.get('id_cita')}).")
+            else:
+                resumen = json.dumps(respuesta, ensure_ascii=False)
+                lineas.append(f"Esto encontré con {nombre}: {resumen[:300]}")
+        return "\n".join(lineas)
+
+    def _respuesta(self, partes, cuerpo):
+        prompt = _tokens_prompt(cuerpo)
+        salida = _tokens(json.dumps(partes, ensure_ascii=False))
+        return {
+            "candidates": [{
+                "content": {"role": "model", "parts": partes},
+                "finishReason": FIN_STOP,
+                "index": 0,
+            }],
+            "usageMetadata": {
+                "promptTokenCount": prompt,
+                "candidatesTokenCount": salida,
+                "totalTokenCount": prompt + salida,
+            },
+        }
+
+    # --- HTTP ---
+
+    def _crear_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _json(self, estado, datos):
+                cuerpo = json.dumps(datos, ensure_ascii=False).encode("utf-8")
+                self.send_response(estado)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(cuerpo)))
+                self.end_headers()
+                self.wfile.write(cuerpo)
+
+            def do_GET(self):
+                if self.path.startswith("/stats"):
+                    self._json(200, fake.stats())
+                else:
+                    self._json(404, {"error": {"code": 404, "message": "No encontrado"}})
+
+            def do_POST(self):
+                largo = int(self.headers.get("Content-Length") or 0)
+                try:
+                    cuerpo = json.loads(self.rfile.read(largo) or b"{}")
+                except json.JSONDecodeError:
+                    self._json(400, {"error": {"code": 400, "message": "JSON inválido"}})
+                    return
+
+                metodo = self.path.split("?")[0].rsplit(":", 1)[-1]
+                fake._contar(metodo)
+                if metodo != "countTokens" and fake.tasa_errores and random.random() < fake.tasa_errores:
+                    codigo, estado = random.choice(((429, "RESOURCE_EXHAUSTED"), (503, "UNAVAILABLE")))
+                    fake._contar(f"error:{codigo}")
+                    self._json(codigo, {"error": {"code": codigo, "message": "Error simulado", "status": estado}})
+                    return
+                if metodo == "countTokens":
+                    texto = json.dumps(cuerpo.get("contents") or [], ensure_ascii=False)
+                    self._json(200, {"totalTokens": _tokens(texto)})
+                elif metodo == "generateContent":
+                    partes, latencia = fake.responder(cuerpo)
+                    fake._esperar(latencia, _tokens_prompt(cuerpo))
+                    self._json(200, fake._respuesta(partes, cuerpo))
+                elif metodo == "streamGenerateContent":
+                    self._stream(cuerpo)
+                else:
+                    self._json(404, {"error": {"code": 404, "message": f"Método no soportado: {metodo}"}})
+
+            def _stream(self, cuerpo):
+                # El transporte REST espera un arreglo JSON que llega por partes
+                partes, latencia = fake.responder(cuerpo)
+                if len(partes) == 1 and "text" in partes[0]:
+                    palabras = partes[0]["text"].split(" ")
+                    trozos = [[{"text": " ".join(palabras[i:i + 5]) + (" " if i + 5 < len(palabras) else "")}]
+                              for i in range(0, len(palabras), 5)]
+                else:
+                    trozos = [partes]
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                fake._esperar(latencia, _tokens_prompt(cuerpo))
+                for i, trozo in enumerate(trozos):
+                    if i:
+                        time.sleep(fake.intervalo_stream_ms / 1000)
+                    dato = ("[" if i == 0 else ",\n") + json.dumps(fake._respuesta(trozo, cuerpo), ensure_ascii=False)
+                    self._chunk(dato)
+                self._chunk("]")
+                self.wfile.write(b"0\r\n\r\n")
+
+            def _chunk(self, texto):
+                datos = texto.encode("utf-8")
+                self.wfile.write(f"{len(datos):x}\r\n".encode("ascii") + datos + b"\r\n")
+                self.wfile.flush()
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--puerto", type=int, default=8765)
+    parser.add_argument("--latencia-ms", type=float, default=400)
+    parser.add_argument("--jitter-ms", type=float, default=100)
+    parser.add_argument("--intervalo-stream-ms", type=float, default=20)
+    parser.add_argument("--reglas", help="Archivo JSON con las reglas de respuesta")
+    parser.add_argument("--ms-por-1k-tokens", type=float, default=0.0, help="Latencia extra por cada 1000 tokens de prompt")
+    parser.add_argument("--errores", type=float, default=0.0, help="Fracción de llamadas que responden 429/503")
+    args = parser.parse_args()
+
+    reglas = None
+    if args.reglas:
+        with open(args.reglas, encoding="utf-8") as archivo:
+            reglas = json.load(archivo)
+
+    fake = FakeGemini(args.host, args.puerto, args.latencia_ms, args.jitter_ms, args.intervalo_stream_ms, reglas,
+                      args.errores, args.ms_por_1k_tokens)
+    print(f"Gemini falso escuchando en {fake.url} (latencia {args.latencia_ms}±{args.jitter_ms} ms)")
+    try:
+        fake._servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        fake._servidor.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,34 +1,200 @@
+import asyncio
 import os
-import google.generativeai as genai
-from services import medico_service, cita_service
-from datetime import datetime
-# --- ¡ESTA ES LA CORRECCIÓN! ---
-from google.ai.generativelanguage import Part # La importación correcta
-# --- FIN DE LA CORRECCIÓN ---
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from services import medico_service, cita_service, horario_service
+from controllers.intent_router import router as intent_router
+from controllers.cache import TTLCache
+from controllers.gemini_scheduler import planificador, GeminiSaturado
+from controllers import contexto, metrics
+from controllers.database import liberar_conexion
+from services.normalizacion import normalizar_texto
+from datetime import datetime, date
+# El SDK de Gemini (google.generativeai) tarda más de un segundo en importarse:
+# se importa al crear el primer AiController, no al arrancar la app.
 
-class AiController:
-    def __init__(self, user):
-        self.user = user  # El usuario que está chateando
-        
+log = metrics.get_logger(__name__)
+
+# --- Métricas de Gemini y de las herramientas (ver /metrics) ---
+LLM_SEGUNDOS = metrics.histograma(
+    "medagend_llm_llamada_segundos", "Duración de cada llamada a Gemini (en streaming, hasta el último fragmento)", ("modo",)
+)
+LLM_PRIMER_FRAGMENTO = metrics.histograma(
+    "medagend_llm_primer_fragmento_segundos", "Tiempo hasta el primer fragmento de Gemini en streaming"
+)
+LLM_TOKENS = metrics.contador("medagend_llm_tokens_total", "Tokens reportados por Gemini", ("tipo",))
+LLM_PROMPT_TOKENS_TURNO = metrics.histograma(
+    "medagend_llm_prompt_tokens_turno", "Tokens de entrada de un turno de chat (suma de sus llamadas a Gemini)",
+    cubetas=(250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000)
+)
+LLM_ERRORES = metrics.contador("medagend_llm_errores_total", "Turnos de chat que terminaron en error", ("modo",))
+HERRAMIENTA_SEGUNDOS = metrics.histograma(
+    "medagend_herramienta_segundos", "Duración de las herramientas que pide la IA", ("herramienta", "cache")
+)
+
+def _registrar_uso(response):
+    """
+    Suma los tokens de entrada y salida que reporta Gemini en una respuesta.
+    Devuelve los tokens de entrada (0 si Gemini no los reporta).
+    """
+    uso = getattr(response, "usage_metadata", None)
+    if uso:
+        LLM_TOKENS.inc("entrada", cantidad=uso.prompt_token_count)
+        LLM_TOKENS.inc("salida", cantidad=uso.candidates_token_count)
+        return uso.prompt_token_count
+    return 0
+
+_genai_configurado = False
+_genai_lock = threading.Lock()
+# True si send_message_async puede usar el transporte gRPC asíncrono del SDK.
+# Con transporte REST (ej. GEMINI_API_ENDPOINT) el SDK no tiene cliente asíncrono.
+_genai_async_nativo = False
+
+def configurar_genai():
+    """Importa y configura el SDK de Gemini una sola vez por proceso."""
+    global _genai_configurado, _genai_async_nativo
+    if _genai_configurado:
+        return
+    with _genai_lock:
+        if _genai_configurado:
+            return
+        import google.generativeai as genai
         api_key = os.environ.get("GEMINI_API_KEY")
         if not api_key:
             raise ValueError("GEMINI_API_KEY no encontrada en .env")
-            
-        genai.configure(api_key=api_key)
+        # GEMINI_API_ENDPOINT apunta a otro servidor compatible con la API REST
+        # de Gemini, ej. http://127.0.0.1:8765 (benchmarks/fake_gemini.py)
+        endpoint = os.environ.get("GEMINI_API_ENDPOINT")
+        transport = os.environ.get("GEMINI_TRANSPORT") or ("rest" if endpoint else None)
+        opciones = {"api_endpoint": endpoint} if endpoint else None
+        genai.configure(api_key=api_key, transport=transport, client_options=opciones)
+        _genai_async_nativo = transport in (None, "grpc_asyncio") and os.environ.get("GEMINI_ASYNC", "1") != "0"
+        _genai_configurado = True
+
+def historial_a_contenido(historial):
+    """
+    Convierte el historial guardado [{"role": "user"|"ai", "content": ...}]
+    al formato de Gemini, uniendo mensajes seguidos del mismo rol.
+    """
+    contenido = []
+    for mensaje in historial or []:
+        role = "user" if mensaje.get("role") == "user" else "model"
+        texto = mensaje.get("content") or ""
+        if contenido and contenido[-1]["role"] == role:
+            contenido[-1]["parts"][0] += "\n" + texto
+        else:
+            contenido.append({"role": role, "parts": [texto]})
+    # Gemini espera que la conversación empiece con el usuario
+    while contenido and contenido[0]["role"] != "user":
+        contenido.pop(0)
+    return contenido
+
+# Pool compartido para ejecutar en paralelo las herramientas de un mismo turno
+_tool_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("AI_TOOL_WORKERS", "4")),
+    thread_name_prefix="ai-tool"
+)
+
+# Modo ASGI: las llamadas bloqueantes a Gemini (sin cliente asíncrono del SDK, y los
+# streams) corren aquí, no en los hilos que atienden solicitudes. Solo esperan la red.
+llm_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("AI_LLM_WORKERS", "32")),
+    thread_name_prefix="ai-llm"
+)
+
+# Para estimar los tokens de una llamada antes de hacerla (el planificador cobra luego los reales)
+TOKENS_RESPUESTA_ESTIMADOS = 300
+
+MENSAJE_ERROR = "Lo siento, tuve un error procesando tu solicitud. Por favor, intenta de nuevo."
+MENSAJE_SATURADO = "El asistente está atendiendo a muchas personas en este momento. Por favor, intenta de nuevo en unos segundos."
+
+# Herramientas con efectos secundarios: nunca se ejecutan en paralelo
+HERRAMIENTAS_CON_ESCRITURA = {"agendar_cita"}
+
+# Herramientas cuyo resultado cambia con las citas del paciente: una respuesta que las usó no se guarda
+HERRAMIENTAS_PERSONALES = {"agendar_cita", "get_mis_citas"}
+
+# --- Caché de resultados de herramientas y de respuestas de la IA ---
+# Por herramienta: TTL y etiquetas que la invalidan (ver cache.invalidar en los servicios).
+# Las herramientas que no están aquí (ej. agendar_cita) nunca se cachean.
+CACHE_HERRAMIENTAS = {
+    "get_medicos_disponibles": {"ttl": 300, "etiquetas": lambda args: ("medicos",)},
+    "buscar_horarios_libres": {"ttl": 30, "etiquetas": lambda args: ("medicos", "agenda")},
+    "get_mis_citas": {"ttl": 60, "etiquetas": lambda args: (f"citas:{int(args['paciente_id'])}",)},
+}
+CACHE_ACTIVA = os.environ.get("AI_CACHE", "1") != "0"
+# Herramientas excluidas de la caché, ej. AI_CACHE_DESACTIVAR=get_mis_citas,buscar_horarios_libres
+CACHE_DESACTIVADAS = {n.strip() for n in os.environ.get("AI_CACHE_DESACTIVAR", "").split(",") if n.strip()}
+# Caché de respuestas completas para el primer turno (opcional, apagada por defecto)
+CACHE_RESPUESTAS_ACTIVA = os.environ.get("AI_CACHE_RESPUESTAS", "0") == "1"
+
+_cache_herramientas = TTLCache("herramientas_ia", max_entradas=int(os.environ.get("AI_CACHE_MAX_ENTRADAS", "2048")), ttl=60)
+_cache_respuestas = TTLCache("respuestas_ia", max_entradas=512, ttl=600, max_caracteres=2_000_000)
+
+def configurar_cache_herramienta(nombre, activa):
+    """Activa o desactiva la caché de una herramienta en tiempo de ejecución."""
+    if activa:
+        CACHE_DESACTIVADAS.discard(nombre)
+    else:
+        CACHE_DESACTIVADAS.add(nombre)
+        _cache_herramientas.limpiar()
+
+def _normalizar_arg(valor):
+    # Gemini manda los enteros como float (3.0) y el texto con mayúsculas/acentos variables
+    if isinstance(valor, float) and valor.is_integer():
+        return int(valor)
+    if isinstance(valor, str):
+        return " ".join(normalizar_texto(valor).split())
+    return valor
+
+# Citas pasadas que recibe la IA cuando pide el historial (no todo: el prompt no debe crecer con los años)
+HISTORIAL_PARA_IA = 10
+
+# Textos que ve el usuario mientras la IA usa cada herramienta
+DESCRIPCION_HERRAMIENTAS = {
+    "get_medicos_disponibles": "Buscando médicos",
+    "agendar_cita": "Agendando tu cita",
+    "get_mis_citas": "Revisando tus citas",
+    "buscar_horarios_libres": "Buscando horarios disponibles",
+}
+
+class AiController:
+    def __init__(self, user, history=None):
+        self.user = user  # El usuario que está chateando
+        
+        configurar_genai()
         
         # Definir las herramientas que la IA puede usar
         self.tools = {
             "get_medicos_disponibles": self.get_medicos_disponibles,
             "agendar_cita": self.agendar_cita,
             "get_mis_citas": self.get_mis_citas,
+            "buscar_horarios_libres": self.buscar_horarios_libres,
         }
         
+        import google.generativeai as genai
+        system_prompt = self.get_system_prompt()
+        # Se reenvía en cada llamada: cuenta para estimar los tokens
+        self._caracteres_sistema = len(system_prompt)
         self.model = genai.GenerativeModel(
             model_name='models/gemini-pro-latest',
-            system_instruction=self.get_system_prompt(),
+            system_instruction=system_prompt,
             tools=list(self.tools.values()) # Pasar las funciones a Gemini
         )
-        self.chat = self.model.start_chat(history=[])
+        # 'history' permite retomar una conversación previa (ej. tras desalojar la sesión)
+        contenido = historial_a_contenido(history)
+        self.chat = self.model.start_chat(history=contenido)
+        # Tamaño aproximado (en caracteres) del historial que guarda el chat
+        self.tamano_historial = sum(len(c["parts"][0]) for c in contenido)
+        # Herramientas usadas en el turno actual
+        self._herramientas_turno = set()
+        # Tokens de entrada del turno actual y de cada turno terminado (los últimos 100)
+        self.tokens_turno = 0
+        self.tokens_por_turno = []
+        # Caracteres por token medidos con lo que reporta Gemini (para el presupuesto de contexto)
+        self._caracteres_por_token = contexto.CARACTERES_POR_TOKEN
 
     def get_system_prompt(self):
         """
@@ -51,85 +217,406 @@ class AiController:
         1. **REGLA MÁS IMPORTANTE**: Si el usuario pregunta por médicos, doctores, o especialistas (ej. "qué doctores hay", "busco un cardiólogo", "especialistas disponibles"), DEBES usar la herramienta `get_medicos_disponibles` INMEDIATAMENTE.
            - Si el usuario solo dice "qué doctores hay", llama a `get_medicos_disponibles()`.
            - Si el usuario dice "busco un cardiólogo", llama a `get_medicos_disponibles(especialidad="Cardiología")`.
+           - Si el usuario menciona un nombre o un lugar (ej. "el doctor Turing", "consultorio 201"), llama a `get_medicos_disponibles(busqueda="Turing")`.
         
         2. Si el usuario pide agendar una cita, DEBES usar la herramienta `agendar_cita`.
+           - Si el usuario no da una fecha y hora exacta (ej. "lo antes posible", "la próxima semana"),
+             usa PRIMERO `buscar_horarios_libres` y ofrécele los horarios que devuelva. NO adivines horarios.
+           - Si `agendar_cita` responde con "codigo": "horario_ocupado", otra persona ya tomó ese horario:
+             usa `buscar_horarios_libres` con ese médico y ofrécele las alternativas.
         
         3. Si el usuario pregunta por sus citas, DEBES usar `get_mis_citas`.
+           - Solo devuelve las próximas citas; usa `incluir_historial=True` si pregunta por citas pasadas o canceladas.
         
         4. **NUNCA** pidas el ID del paciente, ya lo sabes ({self.user['paciente_id']}).
         
         5. El formato de fecha y hora para agendar es 'AAAA-MM-DDTHH:MM'. Hoy es {datetime.now().strftime('%Y-%m-%d')}.
         """
 
+    def _ejecutar_herramienta(self, function_call):
+        """
+        Ejecuta la herramienta que pidió la IA y devuelve (nombre, resultado).
+        """
+        tool_name = function_call.name
+        tool_args = {key: value for key, value in function_call.args.items()}
+        
+        log.debug("IA quiere llamar a: %s con args: %s", tool_name, tool_args)
+        
+        if tool_name not in self.tools:
+            return tool_name, {"error": f"Herramienta '{tool_name}' desconocida."}
+
+        tool_function = self.tools[tool_name]
+        
+        if 'paciente_id' not in tool_args and (tool_name == 'agendar_cita' or tool_name == 'get_mis_citas'):
+            tool_args['paciente_id'] = self.user['paciente_id']
+        self._herramientas_turno.add(tool_name)
+
+        # Resultado en caché (mismos argumentos normalizados)
+        config = CACHE_HERRAMIENTAS.get(tool_name)
+        if not CACHE_ACTIVA or tool_name in CACHE_DESACTIVADAS:
+            config = None
+        if config:
+            clave = (tool_name,) + tuple(sorted((k, _normalizar_arg(v)) for k, v in tool_args.items()))
+            encontrado, tool_result = _cache_herramientas.get(clave)
+            if encontrado:
+                HERRAMIENTA_SEGUNDOS.observar(0.0, tool_name, "si")
+                log.debug("Resultado de la herramienta (caché): %s", tool_name)
+                return tool_name, tool_result
+        
+        inicio = time.perf_counter()
+        tool_result = tool_function(**tool_args)
+        HERRAMIENTA_SEGUNDOS.observar(time.perf_counter() - inicio, tool_name, "no")
+        
+        # %.300s: el resultado solo se convierte a texto (y recortado) si el log se escribe
+        log.debug("Resultado de la herramienta %s: %.300s", tool_name, tool_result)
+        if config and "error" not in tool_result:
+            _cache_herramientas.set(
+                clave, tool_result,
+                etiquetas=config["etiquetas"](tool_args),
+                ttl=config["ttl"],
+                tamano=len(str(tool_result))
+            )
+        return tool_name, tool_result
+
+    @staticmethod
+    def _respuesta_herramienta(tool_name, tool_result):
+        from google.ai.generativelanguage import Part  # Ya importado por configurar_genai
+        return Part(
+            function_response={
+                "name": tool_name,
+                "response": {
+                    "result": tool_result
+                }
+            }
+        )
+
+    @staticmethod
+    def _extraer_llamadas(parts):
+        """Todas las function_call de una respuesta (Gemini puede pedir varias a la vez)."""
+        return [part.function_call for part in parts if part.function_call]
+
+    def _ejecutar_herramientas(self, function_calls):
+        """
+        Ejecuta todas las herramientas pedidas en un mismo turno y devuelve
+        la lista de Parts con sus resultados, en el mismo orden.
+        Las de solo lectura corren en paralelo en el pool compartido; las que
+        escriben (ej. agendar_cita) corren después, una por una y en orden.
+        """
+        resultados = [None] * len(function_calls)
+        futuros = {}
+        paralelo = len(function_calls) > 1
+        for i, function_call in enumerate(function_calls):
+            if paralelo and function_call.name not in HERRAMIENTAS_CON_ESCRITURA:
+                futuros[i] = _tool_executor.submit(self._ejecutar_herramienta, function_call)
+
+        for i, function_call in enumerate(function_calls):
+            if i not in futuros:
+                resultados[i] = self._ejecutar_herramienta(function_call)
+        for i, futuro in futuros.items():
+            try:
+                resultados[i] = futuro.result()
+            except Exception as e:
+                log.exception("Error al ejecutar la herramienta %s", function_calls[i].name)
+                resultados[i] = (function_calls[i].name, {"error": f"Error interno en la herramienta: {e}"})
+
+        self.tamano_historial += sum(len(str(resultado)) for _, resultado in resultados)
+        return [self._respuesta_herramienta(nombre, resultado) for nombre, resultado in resultados]
+
+    def _registrar_turno_local(self, message, respuesta):
+        """
+        Agrega al chat de Gemini un turno que se respondió sin la IA,
+        para que el modelo conserve el contexto en los siguientes mensajes.
+        """
+        from google.ai.generativelanguage import Part, Content
+        self.chat.history.extend([
+            Content(role="user", parts=[Part(text=message)]),
+            Content(role="model", parts=[Part(text=respuesta)]),
+        ])
+        self.tamano_historial += len(message) + len(respuesta)
+
+    def _clave_respuesta(self, message):
+        """
+        Clave de la caché de respuestas. Solo aplica al primer turno de una
+        conversación (sin historial, la respuesta depende del mensaje y del
+        prompt del sistema). Va por usuario: el prompt lleva sus datos, así
+        que la respuesta nunca se comparte con otro paciente.
+        """
+        if not CACHE_RESPUESTAS_ACTIVA or len(self.chat.history) > 0:
+            return None
+        # Solo las palabras: "¿Qué horario?" y "que horario" comparten entrada
+        palabras = " ".join(re.findall(r"\w+", normalizar_texto(message)))
+        return ("respuesta", self.user['id'], palabras, date.today().isoformat())
+
+    def _guardar_respuesta(self, clave, texto):
+        if clave is None or self._herramientas_turno & HERRAMIENTAS_PERSONALES:
+            return
+        _cache_respuestas.set(clave, texto, etiquetas=("medicos", "agenda"), tamano=len(texto))
+
+    def _respuesta_sin_llm(self, message):
+        """
+        Respuesta que no necesita a Gemini: atajo de intenciones o caché de
+        respuestas. Devuelve None si hay que llamar a la IA.
+        """
+        respuesta = intent_router.responder(message, self.user)
+        if respuesta is None:
+            clave = self._clave_respuesta(message)
+            if clave is not None:
+                _, respuesta = _cache_respuestas.get(clave)
+        if respuesta is not None:
+            self._registrar_turno_local(message, respuesta)
+        return respuesta
+
+    def _caracteres_prompt(self, contenido):
+        """Tamaño aproximado del prompt de una llamada: sistema, historial y contenido nuevo."""
+        return self._caracteres_sistema + self.tamano_historial + len(str(contenido))
+
+    def _tokens_estimados(self, contenido):
+        """Tokens aproximados de una llamada (entrada y respuesta), para el planificador."""
+        return int(self._caracteres_prompt(contenido) / self._caracteres_por_token) + TOKENS_RESPUESTA_ESTIMADOS
+
+    def _medir_uso(self, contenido, response):
+        """Registra los tokens de la llamada y ajusta la relación caracteres/token."""
+        tokens = _registrar_uso(response)
+        self.tokens_turno += tokens
+        # Solo el primer envío del turno (texto): con resultados de herramientas el tamaño es menos preciso
+        if tokens and isinstance(contenido, str):
+            medida = self._caracteres_prompt(contenido) / tokens
+            # Promedio móvil: una llamada rara no cambia mucho la estimación
+            self._caracteres_por_token = 0.8 * self._caracteres_por_token + 0.2 * min(8.0, max(1.0, medida))
+
+    def _empezar_turno(self):
+        """
+        Antes de llamar a Gemini en un turno nuevo: acota el historial que se
+        reenvía (ver controllers/contexto.py) y reinicia los contadores.
+        """
+        self._herramientas_turno = set()
+        self.tokens_turno = 0
+        historial = [type(c).to_dict(c) for c in self.chat.history]
+        acotado, cambio = contexto.acotar(
+            historial, self._caracteres_sistema, caracteres_por_token=self._caracteres_por_token
+        )
+        if cambio:
+            self.chat.history = acotado
+            self.tamano_historial = contexto.caracteres(acotado)
+            log.debug("Historial acotado: %d -> %d mensajes", len(historial), len(acotado))
+
+    def _terminar_turno(self):
+        LLM_PROMPT_TOKENS_TURNO.observar(self.tokens_turno)
+        self.tokens_por_turno = self.tokens_por_turno[-99:] + [self.tokens_turno]
+        log.debug("Turno con %d tokens de entrada (historial de %d caracteres)", self.tokens_turno, self.tamano_historial)
+
+    def _enviar(self, contenido, stream=False):
+        """send_message a Gemini (vía el planificador), midiendo la latencia y los tokens."""
+        # La espera a Gemini puede durar segundos: no retener la conexión de la solicitud
+        liberar_conexion()
+        inicio = time.perf_counter()
+        response = planificador.ejecutar(
+            self.user['id'], lambda: self.chat.send_message(contenido, stream=stream), self._tokens_estimados(contenido),
+            stream=stream
+        )
+        if stream:
+            return response
+        LLM_SEGUNDOS.observar(time.perf_counter() - inicio, "normal")
+        self._medir_uso(contenido, response)
+        return response
+
+    async def _enviar_async(self, contenido):
+        """Como _enviar, pero sin bloquear el event loop mientras Gemini responde."""
+        inicio = time.perf_counter()
+
+        def llamar():
+            if _genai_async_nativo:
+                return self.chat.send_message_async(contenido)
+            return asyncio.get_running_loop().run_in_executor(llm_executor, self.chat.send_message, contenido)
+
+        response = await planificador.ejecutar_async(self.user['id'], llamar, self._tokens_estimados(contenido))
+        LLM_SEGUNDOS.observar(time.perf_counter() - inicio, "async")
+        self._medir_uso(contenido, response)
+        return response
+
+    async def handle_message_async(self, message, ejecutor=None):
+        """
+        Igual que handle_message, para el modo ASGI (asgi.py): espera a Gemini
+        con await y corre lo que toca SQLite (atajos, herramientas) en
+        'ejecutor', un pool acotado de hilos.
+        """
+        loop = asyncio.get_running_loop()
+        respuesta_local = await loop.run_in_executor(ejecutor, self._respuesta_sin_llm, message)
+        if respuesta_local is not None:
+            return respuesta_local
+
+        clave_respuesta = self._clave_respuesta(message)
+        self._empezar_turno()
+        inicio = time.perf_counter()
+        try:
+            response = await self._enviar_async(message)
+            while response.candidates and response.candidates[0].content.parts:
+                function_calls = self._extraer_llamadas(response.candidates[0].content.parts)
+                if not function_calls:
+                    break
+                respuestas = await loop.run_in_executor(ejecutor, self._ejecutar_herramientas, function_calls)
+                response = await self._enviar_async(respuestas)
+
+            self.tamano_historial += len(message) + len(response.text)
+            intent_router.registrar_latencia_llm(time.perf_counter() - inicio)
+            self._terminar_turno()
+            self._guardar_respuesta(clave_respuesta, response.text)
+            return response.text
+
+        except GeminiSaturado:
+            LLM_ERRORES.inc("async")
+            log.warning("Turno de chat sin lugar en el planificador de Gemini")
+            return MENSAJE_SATURADO
+        except Exception:
+            LLM_ERRORES.inc("async")
+            log.exception("Error en AiController (async)")
+            return MENSAJE_ERROR
+
     def handle_message(self, message):
         """
         Maneja un nuevo mensaje del usuario y ejecuta el ciclo de IA (Tool Calling).
         """
+        # 0. Atajo: preguntas comunes o ya respondidas no llaman a Gemini
+        respuesta_local = self._respuesta_sin_llm(message)
+        if respuesta_local is not None:
+            return respuesta_local
+
+        clave_respuesta = self._clave_respuesta(message)
+        self._empezar_turno()
+        inicio = time.perf_counter()
         try:
             # 1. Enviar mensaje a Gemini
-            response = self.chat.send_message(message)
+            response = self._enviar(message)
             
-            # 2. Revisar si la IA quiere usar una herramienta
-            while (response.candidates and response.candidates[0].content.parts and 
-                   response.candidates[0].content.parts[0].function_call):
-                
-                function_call = response.candidates[0].content.parts[0].function_call
-                tool_name = function_call.name
-                tool_args = {key: value for key, value in function_call.args.items()}
-                
-                print(f"IA quiere llamar a: {tool_name} con args: {tool_args}")
+            # 2. Revisar si la IA quiere usar una o varias herramientas
+            while response.candidates and response.candidates[0].content.parts:
+                function_calls = self._extraer_llamadas(response.candidates[0].content.parts)
+                if not function_calls:
+                    break
                 
-                # 3. Ejecutar la herramienta (función de Python)
-                if tool_name in self.tools:
-                    tool_function = self.tools[tool_name]
-                    
-                    if 'paciente_id' not in tool_args and (tool_name == 'agendar_cita' or tool_name == 'get_mis_citas'):
-                        tool_args['paciente_id'] = self.user['paciente_id']
-                    
-                    tool_result = tool_function(**tool_args)
-                else:
-                    tool_result = {"error": f"Herramienta '{tool_name}' desconocida."}
-                
-                print(f"Resultado de la herramienta: {tool_result}")
-
-                # 4. Enviar el resultado de la herramienta de vuelta a Gemini
-                # Esta línea ahora usará el 'Part' que importamos correctamente
-                response = self.chat.send_message(
-                    Part(
-                        function_response={
-                            "name": tool_name,
-                            "response": {
-                                "result": tool_result
-                            }
-                        }
-                    )
-                )
+                # 3. Ejecutar las herramientas (funciones de Python)
+                respuestas = self._ejecutar_herramientas(function_calls)
+
+                # 4. Enviar todos los resultados de vuelta a Gemini en un solo mensaje
+                response = self._enviar(respuestas)
             
             # 5. La IA ha respondido con texto
+            self.tamano_historial += len(message) + len(response.text)
+            intent_router.registrar_latencia_llm(time.perf_counter() - inicio)
+            self._terminar_turno()
+            self._guardar_respuesta(clave_respuesta, response.text)
             return response.text
 
-        except Exception as e:
-            # Imprime el error real en la terminal
-            print(f"Error en AiController: {e}") 
-            return "Lo siento, tuve un error procesando tu solicitud. Por favor, intenta de nuevo."
+        except GeminiSaturado:
+            LLM_ERRORES.inc("normal")
+            log.warning("Turno de chat sin lugar en el planificador de Gemini")
+            return MENSAJE_SATURADO
+        except Exception:
+            LLM_ERRORES.inc("normal")
+            log.exception("Error en AiController")
+            return MENSAJE_ERROR
+
+    def handle_message_stream(self, message):
+        """
+        Igual que handle_message, pero como generador de eventos para streaming:
+          {"tipo": "herramienta", "nombre", "descripcion"}  -> la IA está usando una herramienta
+          {"tipo": "texto", "texto"}                          -> fragmento de la respuesta final
+          {"tipo": "fin", "texto"}                            -> respuesta completa
+          {"tipo": "error", "texto"}                          -> algo falló (el turno termina)
+        """
+        respuesta_local = self._respuesta_sin_llm(message)
+        if respuesta_local is not None:
+            yield {"tipo": "texto", "texto": respuesta_local}
+            yield {"tipo": "fin", "texto": respuesta_local}
+            return
+
+        clave_respuesta = self._clave_respuesta(message)
+        self._empezar_turno()
+        inicio = time.perf_counter()
+        partes_texto = []
+        response = None
+        try:
+            inicio_llamada = time.perf_counter()
+            # send_message(stream=True) regresa cuando llega el primer fragmento
+            response = self._enviar(message, stream=True)
+            LLM_PRIMER_FRAGMENTO.observar(time.perf_counter() - inicio_llamada)
+            
+            while True:
+                function_calls = []
+                # Reenviar cada fragmento de texto en cuanto llega
+                for chunk in response:
+                    if not chunk.candidates or not chunk.candidates[0].content.parts:
+                        continue
+                    for part in chunk.candidates[0].content.parts:
+                        if part.function_call:
+                            function_calls.append(part.function_call)
+                        elif part.text:
+                            partes_texto.append(part.text)
+                            yield {"tipo": "texto", "texto": part.text}
+                LLM_SEGUNDOS.observar(time.perf_counter() - inicio_llamada, "stream")
+                self.tokens_turno += _registrar_uso(response)
+                
+                if not function_calls:
+                    break
+                
+                for function_call in function_calls:
+                    yield {
+                        "tipo": "herramienta",
+                        "nombre": function_call.name,
+                        "descripcion": DESCRIPCION_HERRAMIENTAS.get(function_call.name, "Consultando información"),
+                    }
+                respuestas = self._ejecutar_herramientas(function_calls)
+                inicio_llamada = time.perf_counter()
+                response = self._enviar(respuestas, stream=True)
+                LLM_PRIMER_FRAGMENTO.observar(time.perf_counter() - inicio_llamada)
+            
+            texto = "".join(partes_texto)
+            self.tamano_historial += len(message) + len(texto)
+            intent_router.registrar_latencia_llm(time.perf_counter() - inicio)
+            self._terminar_turno()
+            self._guardar_respuesta(clave_respuesta, texto)
+            yield {"tipo": "fin", "texto": texto}
+
+        except GeminiSaturado:
+            LLM_ERRORES.inc("stream")
+            log.warning("Turno de chat sin lugar en el planificador de Gemini")
+            yield {"tipo": "error", "texto": MENSAJE_SATURADO}
+        except Exception:
+            LLM_ERRORES.inc("stream")
+            log.exception("Error en AiController (stream)")
+            yield {"tipo": "error", "texto": MENSAJE_ERROR}
+        finally:
+            # Si el turno se cortó a mitad de una respuesta, devolver su lugar en el planificador
+            if response is not None:
+                response.cerrar()
 
     # --- Definiciones de Herramientas (Las funciones que la IA puede llamar) ---
     
-    def get_medicos_disponibles(self, especialidad: str = None):
+    def get_medicos_disponibles(self, especialidad: str = None, busqueda: str = None):
         """
-        Obtiene una lista de médicos. Puede filtrarse por especialidad (ej. 'Cardiología').
+        Obtiene una lista de médicos. Puede filtrarse por especialidad (ej. 'Cardiología')
+        o buscar por texto libre en nombre, especialidad y ubicación (ej. 'Turing', 'piso 2').
         
         Args:
             especialidad (str, optional): La especialidad a filtrar.
+            busqueda (str, optional): Texto libre; los resultados vienen ordenados por relevancia.
         """
         try:
-            print(f"Buscando médicos por especialidad: {especialidad}")
-            medicos = medico_service.get_medicos(especialidad_filter=especialidad)
+            if busqueda:
+                log.debug("Buscando médicos por texto: %s", busqueda)
+                medicos = medico_service.buscar_medicos(busqueda)
+            else:
+                log.debug("Buscando médicos por especialidad: %s", especialidad)
+                medicos = medico_service.get_medicos(especialidad_filter=especialidad)
             if not medicos:
                 return {"error": "No se encontraron médicos con esa especialidad."}
+            # Enviar el horario ya compilado y con días normalizados, no el JSON crudo
+            for medico in medicos:
+                horario = horario_service.get_horario_medico(medico['id'], medico.pop('horario_trabajo'))
+                medico['horario'] = horario.como_dict() if horario else {}
             return {"medicos": medicos}
         except Exception as e:
-            print(f"Error al llamar a medico_service.get_medicos: {e}")
+            log.exception("Error al llamar a medico_service.get_medicos")
             return {"error": f"Error interno al buscar médicos: {e}"}
 
     def agendar_cita(self, paciente_id: int, medico_id: int, fecha_hora_inicio: str, notas_paciente: str = ""):
@@ -143,7 +630,7 @@ class AiController:
             notas_paciente (str, optional): Notas que el paciente quiera añadir.
         """
         try:
-            print(f"Intentando agendar cita para paciente {paciente_id} con médico {medico_id} a las {fecha_hora_inicio}")
+            log.debug("Intentando agendar cita para paciente %s con médico %s a las %s", paciente_id, medico_id, fecha_hora_inicio)
             resultado = cita_service.agendar_nueva_cita(
                 paciente_id=paciente_id,
                 medico_id=medico_id,
@@ -152,22 +639,55 @@ class AiController:
             )
             return resultado # Devuelve el dict de éxito o error
         except Exception as e:
-            print(f"Error al llamar a cita_service.agendar_nueva_cita: {e}")
+            log.exception("Error al llamar a cita_service.agendar_nueva_cita")
             return {"error": f"Error interno al agendar la cita: {e}"}
 
-    def get_mis_citas(self, paciente_id: int):
+    def buscar_horarios_libres(self, medico_id: int = None, especialidad: str = None, desde: str = None, hasta: str = None, duracion_minutos: int = 30, limite: int = 5):
+        """
+        Busca los próximos horarios libres para agendar, de un médico o de una especialidad.
+        Úsala antes de agendar_cita cuando el usuario no tenga una hora exacta.
+        
+        Args:
+            medico_id (int, optional): El ID del médico.
+            especialidad (str, optional): La especialidad (ej. 'Cardiología') si no hay médico específico.
+            desde (str, optional): Fecha/hora mínima en formato 'AAAA-MM-DDTHH:MM'. Por defecto, ahora.
+            hasta (str, optional): Fecha/hora máxima en formato 'AAAA-MM-DDTHH:MM'.
+            duracion_minutos (int, optional): Minutos libres seguidos que necesita la cita (por defecto 30).
+            limite (int, optional): Cuántos horarios devolver (por defecto 5).
+        """
+        try:
+            log.debug("Buscando horarios libres: medico=%s especialidad=%s desde=%s hasta=%s duracion=%s", medico_id, especialidad, desde, hasta, duracion_minutos)
+            return cita_service.buscar_horarios_libres(
+                medico_id=int(medico_id) if medico_id is not None else None,
+                especialidad=especialidad,
+                desde=desde,
+                hasta=hasta,
+                duracion_minutos=duracion_minutos if duracion_minutos else 30,
+                limite=limite if limite else 5
+            )
+        except Exception as e:
+            log.exception("Error al llamar a cita_service.buscar_horarios_libres")
+            return {"error": f"Error interno al buscar horarios: {e}"}
+
+    def get_mis_citas(self, paciente_id: int, incluir_historial: bool = False):
         """
-        Obtiene una lista de todas las citas (pasadas y futuras) del paciente.
+        Obtiene las próximas citas programadas del paciente (las más cercanas primero).
+        Solo si el usuario pregunta por citas pasadas o canceladas, pide también el historial.
         
         Args:
             paciente_id (int): El ID del paciente.
+            incluir_historial (bool, optional): Agregar las citas más recientes de cualquier estado.
         """
         try:
-            print(f"Buscando citas para paciente {paciente_id}")
-            citas = cita_service.get_citas_paciente(paciente_id=paciente_id)
-            if not citas:
-                return {"error": "No tienes citas registradas."}
-            return {"citas": citas}
+            log.debug("Buscando citas para paciente %s", paciente_id)
+            resultado = {"proximas": cita_service.get_proximas_citas(paciente_id)}
+            if incluir_historial:
+                historial = cita_service.get_historial_citas(paciente_id, limite=HISTORIAL_PARA_IA)
+                resultado["historial"] = historial.get("citas", [])
+                resultado["hay_mas_historial"] = bool(historial.get("siguiente"))
+            if not resultado["proximas"] and not resultado.get("historial"):
+                return {"error": "No tienes citas programadas."}
+            return resultado
         except Exception as e:
-            print(f"Error al llamar a cita_service.get_citas_paciente: {e}")
-            return {"error": f"Error interno al buscar tus citas: {e}"}
\ No newline at end of file
+            log.exception("Error al llamar a cita_service.get_proximas_citas")
+            return {"error": f"Error interno al buscar tus citas: {e}"}
@@ -0,0 +1,136 @@
+import threading
+import time
+from collections import OrderedDict
+from controllers import metrics
+
+# Todas las cachés creadas, para poder reportar sus estadísticas juntas
+_caches = {}
+
+
+class TTLCache:
+    """
+    Caché en memoria con LRU, TTL por entrada e invalidación por etiquetas.
+
+    La memoria está acotada por número de entradas y por un tamaño
+    aproximado (en caracteres) del total guardado. Los valores deben
+    tratarse como de solo lectura: se comparten entre solicitudes.
+    """
+
+    def __init__(self, nombre, max_entradas=1024, ttl=60, max_caracteres=5_000_000):
+        self.nombre = nombre
+        self.max_entradas = max_entradas
+        self.ttl = ttl
+        self.max_caracteres = max_caracteres
+        self._datos = OrderedDict()      # clave -> (expira, valor, etiquetas, tamaño)
+        self._por_etiqueta = {}          # etiqueta -> set(claves)
+        self._lock = threading.Lock()
+        self._caracteres = 0
+        # Contadores
+        self.hits = 0
+        self.misses = 0
+        self.expiradas = 0
+        self.desalojos = 0
+        self.invalidaciones = 0
+        _caches[nombre] = self
+
+    def _quitar(self, clave):
+        _, _, etiquetas, tamano = self._datos.pop(clave)
+        self._caracteres -= tamano
+        for etiqueta in etiquetas:
+            claves = self._por_etiqueta.get(etiqueta)
+            if claves is not None:
+                claves.discard(clave)
+                if not claves:
+                    del self._por_etiqueta[etiqueta]
+
+    def get(self, clave):
+        """Devuelve (encontrado, valor)."""
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada is None:
+                self.misses += 1
+                return False, None
+            if entrada[0] < time.monotonic():
+                self._quitar(clave)
+                self.expiradas += 1
+                self.misses += 1
+                return False, None
+            self._datos.move_to_end(clave)
+            self.hits += 1
+            return True, entrada[1]
+
+    def set(self, clave, valor, etiquetas=(), ttl=None, tamano=1):
+        """
+        Guarda un valor. 'tamano' es una estimación en caracteres que usa el
+        tope de memoria; un valor más grande que el tope no se guarda.
+        """
+        if tamano > self.max_caracteres:
+            return
+        expira = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            if clave in self._datos:
+                self._quitar(clave)
+            self._datos[clave] = (expira, valor, tuple(etiquetas), tamano)
+            self._caracteres += tamano
+            for etiqueta in etiquetas:
+                self._por_etiqueta.setdefault(etiqueta, set()).add(clave)
+            while len(self._datos) > self.max_entradas or self._caracteres > self.max_caracteres:
+                self._quitar(next(iter(self._datos)))
+                self.desalojos += 1
+
+    def invalidar(self, *etiquetas):
+        """Descarta todas las entradas marcadas con alguna de las etiquetas."""
+        with self._lock:
+            for etiqueta in etiquetas:
+                for clave in list(self._por_etiqueta.get(etiqueta, ())):
+                    if clave in self._datos:
+                        self._quitar(clave)
+                        self.invalidaciones += 1
+
+    def invalidar_clave(self, clave):
+        with self._lock:
+            if clave in self._datos:
+                self._quitar(clave)
+                self.invalidaciones += 1
+
+    def limpiar(self):
+        with self._lock:
+            self._datos.clear()
+            self._por_etiqueta.clear()
+            self._caracteres = 0
+
+    def stats(self):
+        with self._lock:
+            consultas = self.hits + self.misses
+            return {
+                "entradas": len(self._datos),
+                "max_entradas": self.max_entradas,
+                "caracteres": self._caracteres,
+                "max_caracteres": self.max_caracteres,
+                "ttl_segundos": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "tasa_hits": round(self.hits / consultas, 4) if consultas else 0.0,
+                "expiradas": self.expiradas,
+                "desalojos": self.desalojos,
+                "invalidaciones": self.invalidaciones,
+            }
+
+
+def invalidar(*etiquetas):
+    """Invalida las etiquetas en todas las cachés (ej. después de escribir en la BD)."""
+    for cache in list(_caches.values()):
+        cache.invalidar(*etiquetas)
+
+
+def stats_todas():
+    return {nombre: cache.stats() for nombre, cache in list(_caches.items())}
+
+
+@metrics.registrar_colector
+def _metricas_caches():
+    gauges = []
+    for nombre, stats in stats_todas().items():
+        for campo in ("entradas", "caracteres", "hits", "misses", "desalojos", "invalidaciones"):
+            gauges.append((f"medagend_cache_{campo}", f"Caché en memoria: {campo}", stats[campo], {"cache": nombre}))
+    return gauges
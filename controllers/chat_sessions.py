@@ -0,0 +1,214 @@
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from datetime import date
+from controllers.ai_controller import AiController
+from controllers import metrics
+
+# --- Límites del registro de sesiones (configurables por entorno) ---
+MAX_SESIONES = int(os.environ.get("CHAT_MAX_SESIONES", "500"))
+TTL_SEGUNDOS = float(os.environ.get("CHAT_SESION_TTL", "1800"))              # 30 min sin uso
+MAX_CARACTERES = int(os.environ.get("CHAT_MAX_CARACTERES", str(20_000_000)))  # ~historial total en memoria
+
+
+class _Sesion:
+    __slots__ = ('controller', 'lock', 'ultimo_uso', 'huella', 'tamano')
+
+    def __init__(self):
+        self.controller = None
+        self.lock = threading.Lock()     # Un turno a la vez por usuario
+        self.ultimo_uso = time.monotonic()
+        self.huella = None
+        self.tamano = 0
+
+
+class ChatSessionRegistry:
+    """
+    Mantiene un AiController "caliente" por usuario para reutilizar el
+    modelo y el chat de Gemini entre turnos.
+
+    Las sesiones se desalojan por LRU (máximo de sesiones), por TTL de
+    inactividad y por un tope de memoria aproximado. Si una sesión
+    desalojada vuelve, se reconstruye a partir del historial guardado.
+    """
+
+    def __init__(self, max_sesiones=MAX_SESIONES, ttl=TTL_SEGUNDOS, max_caracteres=MAX_CARACTERES):
+        self.max_sesiones = max_sesiones
+        self.ttl = ttl
+        self.max_caracteres = max_caracteres
+        self._sesiones = OrderedDict()
+        self._lock = threading.Lock()
+        self._caracteres = 0
+        # Contadores
+        self.hits = 0
+        self.misses = 0
+        self.restauradas = 0
+        self.desalojos_lru = 0
+        self.desalojos_ttl = 0
+        self.desalojos_memoria = 0
+
+    @staticmethod
+    def _huella(user):
+        # Si cambian los datos del usuario o el día, el prompt del sistema ya no sirve
+        return (tuple(sorted(user.items())), date.today().isoformat())
+
+    def _desalojar(self, user_id, contador):
+        sesion = self._sesiones.pop(user_id, None)
+        if sesion is not None:
+            self._caracteres -= sesion.tamano
+            setattr(self, contador, getattr(self, contador) + 1)
+
+    def _limpiar(self):
+        # Llamar con self._lock tomado. Las más viejas están al principio. Las
+        # que tienen un turno en curso no se desalojan: el siguiente turno del
+        # usuario crearía otra sesión (con otro lock) y correrían a la vez
+        ahora = time.monotonic()
+        for user_id, sesion in list(self._sesiones.items()):
+            if sesion.lock.locked():
+                continue
+            if ahora - sesion.ultimo_uso > self.ttl:
+                self._desalojar(user_id, 'desalojos_ttl')
+            elif len(self._sesiones) > self.max_sesiones:
+                self._desalojar(user_id, 'desalojos_lru')
+            elif self._caracteres > self.max_caracteres and len(self._sesiones) > 1:
+                self._desalojar(user_id, 'desalojos_memoria')
+            else:
+                break
+
+    def _obtener(self, user_id):
+        with self._lock:
+            self._limpiar()
+            sesion = self._sesiones.get(user_id)
+            if sesion is None:
+                sesion = _Sesion()
+                self._sesiones[user_id] = sesion
+            sesion.ultimo_uso = time.monotonic()
+            self._sesiones.move_to_end(user_id)
+            return sesion
+
+    def _vigente(self, user_id, sesion):
+        # Entre _obtener y tomar sesion.lock otro hilo pudo desalojarla
+        with self._lock:
+            return self._sesiones.get(user_id) is sesion
+
+    def _preparar(self, sesion, user, cargar_historial):
+        # Llamar con sesion.lock tomado: crea el AiController si no sirve el actual
+        huella = self._huella(user)
+        if sesion.controller is not None and sesion.huella == huella:
+            self.hits += 1
+            return sesion.controller
+        historial = cargar_historial() or []
+        sesion.controller = AiController(user=user, history=historial)
+        sesion.huella = huella
+        self.misses += 1
+        if historial:
+            self.restauradas += 1
+        return sesion.controller
+
+    def _terminar(self, user_id, sesion):
+        with self._lock:
+            sesion.ultimo_uso = time.monotonic()
+            nuevo_tamano = sesion.controller.tamano_historial if sesion.controller else 0
+            if self._sesiones.get(user_id) is sesion:
+                self._caracteres += nuevo_tamano - sesion.tamano
+            sesion.tamano = nuevo_tamano
+            self._limpiar()
+
+    @contextmanager
+    def sesion(self, user, cargar_historial):
+        """
+        Entrega el AiController del usuario, creándolo si hace falta.
+        'cargar_historial' es una función que devuelve el historial guardado;
+        solo se llama si hay que reconstruir la sesión.
+        Mientras dura el bloque, ningún otro turno del mismo usuario corre.
+        """
+        user_id = user['id']
+        while True:
+            sesion = self._obtener(user_id)
+            sesion.lock.acquire()
+            if self._vigente(user_id, sesion):
+                break
+            sesion.lock.release()
+
+        try:
+            controller = self._preparar(sesion, user, cargar_historial)
+            try:
+                yield controller
+            finally:
+                self._terminar(user_id, sesion)
+        finally:
+            sesion.lock.release()
+
+    @asynccontextmanager
+    async def sesion_async(self, user, cargar_historial, ejecutor=None):
+        """
+        Igual que sesion(), para el modo ASGI: esperar el turno de otro
+        request del mismo usuario no bloquea el event loop, y crear el
+        controlador (lee el historial de SQLite) corre en 'ejecutor'.
+        """
+        user_id = user['id']
+        while True:
+            sesion = self._obtener(user_id)
+            while not sesion.lock.acquire(blocking=False):
+                await asyncio.sleep(0.05)
+            if self._vigente(user_id, sesion):
+                break
+            sesion.lock.release()
+        try:
+            controller = await asyncio.get_running_loop().run_in_executor(
+                ejecutor, self._preparar, sesion, user, cargar_historial
+            )
+            try:
+                yield controller
+            finally:
+                self._terminar(user_id, sesion)
+        finally:
+            sesion.lock.release()
+
+    def descartar(self, user_id):
+        """
+        Olvida la sesión de un usuario (ej. al limpiar el chat). Si tiene un
+        turno en curso se conserva la entrada (y su lock) y el controlador se
+        rehace en el siguiente turno.
+        """
+        with self._lock:
+            sesion = self._sesiones.get(user_id)
+            if sesion is None:
+                return
+            if sesion.lock.locked():
+                sesion.huella = None
+                return
+            del self._sesiones[user_id]
+            self._caracteres -= sesion.tamano
+
+    def stats(self):
+        with self._lock:
+            return {
+                "activas": len(self._sesiones),
+                "max_sesiones": self.max_sesiones,
+                "ttl_segundos": self.ttl,
+                "caracteres": self._caracteres,
+                "max_caracteres": self.max_caracteres,
+                "hits": self.hits,
+                "misses": self.misses,
+                "restauradas": self.restauradas,
+                "desalojos_lru": self.desalojos_lru,
+                "desalojos_ttl": self.desalojos_ttl,
+                "desalojos_memoria": self.desalojos_memoria,
+            }
+
+
+# Registro global del proceso
+registro = ChatSessionRegistry()
+
+
+@metrics.registrar_colector
+def _metricas_sesiones():
+    stats = registro.stats()
+    return [
+        ("medagend_chat_sesiones_activas", "Sesiones de IA en memoria", stats["activas"], {}),
+        ("medagend_chat_sesiones_caracteres", "Tamaño aproximado de los historiales en memoria", stats["caracteres"], {}),
+    ]
@@ -0,0 +1,207 @@
+import os
+from controllers import metrics
+
+# --- Configuración ---
+# Presupuesto aproximado de tokens para prompt del sistema + historial (0 = sin límite)
+CONTEXTO_TOKENS = int(os.environ.get("AI_CONTEXTO_TOKENS", "4000"))
+# Turnos más recientes que se reenvían completos (con las llamadas a herramientas)
+TURNOS_RECIENTES = int(os.environ.get("AI_TURNOS_RECIENTES", "4"))
+# Resultados de herramientas más largos que esto se reducen a referencias tras su turno
+RESULTADO_MAX_CARACTERES = int(os.environ.get("AI_RESULTADO_MAX_CARACTERES", "1500"))
+# Texto que se conserva de cada mensaje de un turno antiguo
+TEXTO_ANTIGUO_MAX_CARACTERES = 400
+# Elementos de una lista que se conservan como referencia (el resto solo se cuenta)
+REFERENCIAS_MAX = 10
+# Campos que identifican un médico, una cita o un horario en los resultados de herramientas
+CAMPOS_REFERENCIA = (
+    "id", "medico_id", "nombre_completo", "medico_nombre", "especialidad", "fecha_hora_inicio", "inicio", "estado"
+)
+
+# Para estimar tokens sin llamar a la API
+CARACTERES_POR_TOKEN = 4
+
+CONTEXTO_COMPACTADOS = metrics.contador(
+    "medagend_contexto_compactados_total", "Elementos del historial reducidos para acotar el prompt", ("tipo",)
+)
+
+
+def _recortar(texto, maximo):
+    return texto if len(texto) <= maximo else texto[:maximo].rstrip() + "…"
+
+
+def _tamano_parte(parte):
+    if "text" in parte:
+        return len(parte["text"] or "")
+    if "function_call" in parte:
+        llamada = parte["function_call"]
+        return len(llamada.get("name", "")) + len(str(llamada.get("args") or {}))
+    if "function_response" in parte:
+        return len(str(parte["function_response"].get("response") or {}))
+    return 0
+
+
+def caracteres(contenidos):
+    """Tamaño aproximado (en caracteres) de una lista de contenidos."""
+    return sum(_tamano_parte(parte) for contenido in contenidos for parte in contenido["parts"])
+
+
+def _inicia_turno(contenido):
+    # Un turno empieza con texto del usuario (no con el resultado de una herramienta)
+    return contenido["role"] == "user" and any(parte.get("text") for parte in contenido["parts"])
+
+
+def dividir_turnos(contenidos):
+    """Agrupa el historial en turnos: mensaje del usuario y todo lo que vino después."""
+    turnos = []
+    for contenido in contenidos:
+        if _inicia_turno(contenido) or not turnos:
+            turnos.append([])
+        turnos[-1].append(contenido)
+    return turnos
+
+
+def _referencia(elemento):
+    if not isinstance(elemento, dict):
+        return elemento
+    return {campo: elemento[campo] for campo in CAMPOS_REFERENCIA if campo in elemento}
+
+
+def compactar_resultado(resultado):
+    """
+    Versión corta del resultado de una herramienta: las listas quedan como
+    referencias (id, nombre, fecha...) de los primeros REFERENCIAS_MAX
+    elementos y el número de los omitidos.
+    """
+    if not isinstance(resultado, dict):
+        return _recortar(str(resultado), RESULTADO_MAX_CARACTERES)
+    compacto = {}
+    for clave, valor in resultado.items():
+        if isinstance(valor, list):
+            compacto[clave] = [_referencia(v) for v in valor[:REFERENCIAS_MAX]]
+            if len(valor) > REFERENCIAS_MAX:
+                compacto[f"{clave}_omitidos"] = len(valor) - REFERENCIAS_MAX
+        elif isinstance(valor, dict):
+            compacto[clave] = _referencia(valor) or _recortar(str(valor), 200)
+        elif isinstance(valor, str):
+            compacto[clave] = _recortar(valor, 200)
+        else:
+            compacto[clave] = valor
+    return compacto
+
+
+def _describir_resultado(respuesta):
+    """'3 medicos: IDs 1, 2, 3' o un texto corto para un resultado de herramienta."""
+    resultado = respuesta.get("result", respuesta) if isinstance(respuesta, dict) else respuesta
+    if not isinstance(resultado, dict):
+        return _recortar(str(resultado), 80)
+    if "error" in resultado:
+        return "error: " + _recortar(str(resultado["error"]), 80)
+    descripciones = []
+    for clave, valor in resultado.items():
+        if isinstance(valor, list):
+            ids = [str(v.get("id", v.get("medico_id"))) for v in valor[:REFERENCIAS_MAX]
+                   if isinstance(v, dict) and ("id" in v or "medico_id" in v)]
+            texto = f"{len(valor)} {clave}"
+            descripciones.append(f"{texto}: IDs {', '.join(ids)}" if ids else texto)
+        elif clave in ("success", "id_cita", "mensaje"):
+            descripciones.append(f"{clave}={_recortar(str(valor), 80)}")
+    return "; ".join(descripciones) or "ok"
+
+
+def _ya_resumido(turno):
+    # Un turno resumido (o respondido sin la IA): usuario y modelo, solo texto corto
+    if len(turno) != 2 or any(len(c["parts"]) != 1 or "text" not in c["parts"][0] for c in turno):
+        return False
+    return all(len(c["parts"][0]["text"] or "") <= 2 * TEXTO_ANTIGUO_MAX_CARACTERES for c in turno)
+
+
+def resumir_turno(turno):
+    """
+    Reduce un turno antiguo a dos mensajes de texto: lo que pidió el
+    usuario y la respuesta, con una línea por herramienta usada.
+    """
+    textos_usuario = []
+    herramientas = []
+    respuesta = ""
+    for contenido in turno:
+        for parte in contenido["parts"]:
+            if "function_call" in parte:
+                llamada = parte["function_call"]
+                argumentos = ", ".join(f"{k}={v}" for k, v in (llamada.get("args") or {}).items())
+                herramientas.append(f"{llamada.get('name')}({argumentos})")
+            elif "function_response" in parte:
+                resultado = parte["function_response"]
+                herramientas.append(f"-> {_describir_resultado(resultado.get('response') or {})}")
+            elif parte.get("text") and contenido["role"] == "user":
+                textos_usuario.append(parte["text"])
+        if contenido["role"] == "model":
+            # La respuesta es el último mensaje del modelo con texto (en streaming llega en varias partes)
+            texto = "".join(parte.get("text") or "" for parte in contenido["parts"])
+            if texto:
+                respuesta = texto
+
+    texto_modelo = _recortar(respuesta, TEXTO_ANTIGUO_MAX_CARACTERES)
+    if herramientas:
+        texto_modelo = f"[Herramientas: {' '.join(herramientas)}]\n{texto_modelo}"
+    return [
+        {"role": "user", "parts": [{"text": _recortar("\n".join(textos_usuario), TEXTO_ANTIGUO_MAX_CARACTERES)}]},
+        {"role": "model", "parts": [{"text": texto_modelo or "(sin respuesta)"}]},
+    ]
+
+
+def _compactar_resultados(turno):
+    """Reemplaza los resultados de herramientas demasiado largos por su versión corta."""
+    cambio = False
+    for contenido in turno:
+        for parte in contenido["parts"]:
+            respuesta = (parte.get("function_response") or {}).get("response")
+            if respuesta and len(str(respuesta)) > RESULTADO_MAX_CARACTERES:
+                compacto = {"result": compactar_resultado(respuesta.get("result", respuesta))}
+                if compacto != respuesta:
+                    parte["function_response"]["response"] = compacto
+                    CONTEXTO_COMPACTADOS.inc("resultado")
+                    cambio = True
+    return cambio
+
+
+def acotar(contenidos, caracteres_sistema=0, presupuesto_tokens=None, recientes=None, caracteres_por_token=None):
+    """
+    Acota el historial (lista de contenidos como dicts) antes de un turno nuevo:
+      1. Los últimos 'recientes' turnos van completos, pero con los
+         resultados largos de herramientas reducidos a referencias.
+      2. Los turnos anteriores se resumen en dos mensajes de texto.
+      3. Si aun así se pasa del presupuesto, se quitan los más antiguos.
+    'caracteres_por_token' convierte el presupuesto a caracteres; lo mejor es
+    medirlo con los tokens que reporta Gemini (ver AiController).
+    Devuelve (contenidos, cambio); cambio=False si no hubo nada que hacer.
+    """
+    presupuesto_tokens = CONTEXTO_TOKENS if presupuesto_tokens is None else presupuesto_tokens
+    recientes = TURNOS_RECIENTES if recientes is None else recientes
+    if presupuesto_tokens <= 0:
+        return contenidos, False
+
+    turnos = dividir_turnos(contenidos)
+    cambio = False
+    antiguos = max(0, len(turnos) - recientes)
+    for i, turno in enumerate(turnos):
+        if i < antiguos:
+            if not _ya_resumido(turno):
+                turnos[i] = resumir_turno(turno)
+                CONTEXTO_COMPACTADOS.inc("turno")
+                cambio = True
+        elif _compactar_resultados(turno):
+            cambio = True
+
+    limite = presupuesto_tokens * (caracteres_por_token or CARACTERES_POR_TOKEN) - caracteres_sistema
+    total = sum(caracteres(turno) for turno in turnos)
+    quitados = 0
+    while total > limite and len(turnos) - quitados > recientes:
+        total -= caracteres(turnos[quitados])
+        quitados += 1
+    if quitados:
+        CONTEXTO_COMPACTADOS.inc("turno_omitido", cantidad=quitados)
+        cambio = True
+
+    if not cambio:
+        return contenidos, False
+    return [contenido for turno in turnos[quitados:] for contenido in turno], True
@@ -1,26 +1,671 @@
+import os
 import sqlite3
+import threading
+import time
+from queue import LifoQueue, Empty
+from flask import g, has_app_context
 from werkzeug.security import generate_password_hash
+from services.normalizacion import normalizar_texto
+from controllers import metrics
 
-DB_NAME = "medical_system_v2.db"
+log = metrics.get_logger(__name__)
 
-def get_db_connection():
+DB_NAME = os.environ.get("MEDAGEND_DB", "medical_system_v2.db")
+
+# --- Configuración del pool de conexiones ---
+POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "8"))
+POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))  # segundos de espera máxima por una conexión
+# Conexiones temporales por encima de POOL_SIZE: se abren en vez de esperar y se cierran al devolverse
+POOL_OVERFLOW = int(os.environ.get("DB_POOL_OVERFLOW", "16"))
+# Medir cada execute() (ver controllers/metrics.py); METRICS_SQL=0 lo apaga
+MEDIR_SQL = metrics.ACTIVAS and os.environ.get("METRICS_SQL", "1") != "0"
+
+# PRAGMAs que se aplican UNA sola vez al crear cada conexión física
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL;",       # Modo WAL para concurrencia
+    "PRAGMA foreign_keys = ON;",      # Forzar integridad referencial
+    "PRAGMA synchronous=NORMAL;",     # Seguro con WAL y mucho más rápido que FULL
+    "PRAGMA busy_timeout=5000;",      # Esperar hasta 5s un lock en vez de fallar de inmediato
+    "PRAGMA cache_size=-20000;",      # ~20MB de caché de páginas por conexión
+    "PRAGMA mmap_size=268435456;",    # 256MB de lectura vía mmap
+    "PRAGMA temp_store=MEMORY;",
+)
+
+
+class CursorMedido(sqlite3.Cursor):
     """
-    Crea una conexión a la base de datos optimizada para concurrencia.
+    Cursor que registra la duración de cada execute() por operación y
+    tabla. El tiempo de fetch de un SELECT grande queda fuera: execute()
+    solo avanza hasta la primera fila.
     """
-    conn = sqlite3.connect(DB_NAME)
-    conn.execute("PRAGMA journal_mode=WAL;")  # Modo WAL para concurrencia
-    conn.execute("PRAGMA foreign_keys = ON;") # Forzar integridad referencial
+
+    def execute(self, sql, parametros=()):
+        inicio = time.perf_counter()
+        try:
+            return super().execute(sql, parametros)
+        finally:
+            metrics.observar_sql(sql, time.perf_counter() - inicio)
+
+    def executemany(self, sql, filas):
+        inicio = time.perf_counter()
+        try:
+            return super().executemany(sql, filas)
+        finally:
+            metrics.observar_sql(sql, time.perf_counter() - inicio)
+
+
+class ConexionMedida(sqlite3.Connection):
+    """Conexión cuyos cursores (incluidos los de conn.execute) son CursorMedido."""
+
+    def cursor(self, factory=CursorMedido):
+        return super().cursor(factory)
+
+    def execute(self, sql, parametros=()):
+        return self.cursor().execute(sql, parametros)
+
+    def executemany(self, sql, filas):
+        return self.cursor().executemany(sql, filas)
+
+
+def _crear_conexion():
+    """
+    Abre una conexión física nueva y le aplica los PRAGMAs.
+    """
+    conn = sqlite3.connect(
+        DB_NAME, check_same_thread=False,
+        factory=ConexionMedida if MEDIR_SQL else sqlite3.Connection
+    )
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
     conn.row_factory = sqlite3.Row
     return conn
 
-def init_db():
+
+class PooledConnection:
+    """
+    Envoltura ligera sobre una conexión del pool.
+    Se comporta como una sqlite3.Connection, pero close() la devuelve
+    al pool en lugar de cerrarla.
+    """
+
+    def __init__(self, pool, conn, request_scoped=False):
+        self._pool = pool
+        self._conn = conn
+        self._request_scoped = request_scoped
+
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise sqlite3.ProgrammingError("La conexión ya fue devuelta al pool.")
+        return getattr(self._conn, name)
+
+    def close(self):
+        # Las conexiones de la solicitud se liberan en el teardown de Flask; lo
+        # que quedó sin confirmar se revierte ya, para que no lo herede el
+        # siguiente servicio que use la conexión en la misma solicitud
+        if self._request_scoped:
+            if self._conn is not None and self._conn.in_transaction:
+                self._conn.rollback()
+            return
+        self.release()
+
+    def release(self):
+        if self._conn is not None:
+            self._pool.release(self._conn)
+            self._conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Igual que sqlite3.Connection: confirma si no hubo excepción y si
+        # no revierte; la conexión sigue abierta (devolverla con close())
+        return self._conn.__exit__(exc_type, exc, tb)
+
+
+class ConnectionPool:
+    """
+    Pool de conexiones SQLite compartido por todos los hilos.
+    Reutiliza conexiones ya configuradas y lleva contadores para
+    detectar contención bajo carga. Con las 'size' conexiones en uso abre
+    hasta 'overflow' temporales (se cierran al devolverse) antes de
+    hacer esperar a nadie.
+    """
+
+    def __init__(self, size=POOL_SIZE, timeout=POOL_TIMEOUT, overflow=POOL_OVERFLOW):
+        self.size = size
+        self.timeout = timeout
+        self.overflow = max(0, overflow)
+        self._idle = LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._in_use = 0
+        # Contadores
+        self.hits = 0         # checkout servido por una conexión ya abierta
+        self.misses = 0       # checkout que tuvo que abrir una conexión nueva
+        self.temporales = 0   # de esas, las abiertas por encima de 'size'
+        self.waits = 0        # checkout que tuvo que esperar a que se liberara una
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def acquire(self):
+        try:
+            conn = self._idle.get_nowait()
+            with self._lock:
+                self.hits += 1
+                self._in_use += 1
+            return conn
+        except Empty:
+            pass
+
+        with self._lock:
+            if self._created < self.size + self.overflow:
+                if self._created >= self.size:
+                    self.temporales += 1
+                self._created += 1
+                self.misses += 1
+                self._in_use += 1
+                crear = True
+            else:
+                crear = False
+
+        if crear:
+            try:
+                return _crear_conexion()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                    self._in_use -= 1
+                raise
+
+        # Pool y conexiones temporales agotados: esperar a que alguien devuelva una
+        inicio = time.perf_counter()
+        try:
+            conn = self._idle.get(timeout=self.timeout)
+        except Empty:
+            with self._lock:
+                self.timeouts += 1
+            raise sqlite3.OperationalError(
+                f"No hay conexiones disponibles en el pool (espera > {self.timeout}s)."
+            )
+        espera = time.perf_counter() - inicio
+        with self._lock:
+            self.hits += 1
+            self.waits += 1
+            self._in_use += 1
+            self.wait_total += espera
+            self.wait_max = max(self.wait_max, espera)
+        return conn
+
+    def release(self, conn):
+        # Nunca devolver al pool una conexión con una transacción abierta
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self._cerrar(conn)
+            return
+        with self._lock:
+            # Por encima de 'size' (conexión temporal) se cierra en vez de guardarse
+            sobra = self._created > self.size
+        if sobra:
+            self._cerrar(conn)
+            return
+        with self._lock:
+            self._in_use -= 1
+        self._idle.put(conn)
+
+    def _cerrar(self, conn):
+        conn.close()
+        with self._lock:
+            self._created -= 1
+            self._in_use -= 1
+
+    def close_all(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+    def stats(self):
+        with self._lock:
+            checkouts = self.hits + self.misses
+            return {
+                "db": DB_NAME,
+                "pool_size": self.size,
+                "overflow": self.overflow,
+                "abiertas": self._created,
+                "en_uso": self._in_use,
+                "libres": self._idle.qsize(),
+                "checkouts": checkouts,
+                "hits": self.hits,
+                "misses": self.misses,
+                "temporales": self.temporales,
+                "esperas": self.waits,
+                "timeouts": self.timeouts,
+                "espera_total_ms": round(self.wait_total * 1000, 3),
+                "espera_max_ms": round(self.wait_max * 1000, 3),
+                "espera_promedio_ms": round(self.wait_total * 1000 / self.waits, 3) if self.waits else 0.0,
+            }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Devuelve el pool global (se crea la primera vez que se usa)."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool()
+    return _pool
+
+
+def get_pool_stats():
+    """Contadores del pool para monitoreo (tamaño, hits/misses, esperas)."""
+    return get_pool().stats()
+
+
+@metrics.registrar_colector
+def _metricas_pool():
+    estado = get_pool().stats()
+    return [
+        ("medagend_db_pool_conexiones", "Conexiones del pool por estado", estado["abiertas"], {"estado": "abiertas"}),
+        ("medagend_db_pool_conexiones", "Conexiones del pool por estado", estado["en_uso"], {"estado": "en_uso"}),
+        ("medagend_db_pool_esperas", "Checkouts que esperaron una conexión libre", estado["esperas"], {}),
+        ("medagend_db_pool_timeouts", "Checkouts que agotaron DB_POOL_TIMEOUT", estado["timeouts"], {}),
+        ("medagend_db_pool_espera_segundos", "Tiempo total esperando conexiones", estado["espera_total_ms"] / 1000, {}),
+    ]
+
+
+def get_db_connection():
+    """
+    Devuelve una conexión a la base de datos optimizada para concurrencia.
+
+    Dentro de una solicitud de Flask se reutiliza una sola conexión por
+    solicitud (guardada en `g`) y se libera en el teardown. Fuera de Flask
+    (scripts, hilos de trabajo) se toma una conexión del pool que vuelve
+    al pool al llamar a close().
+    """
+    pool = get_pool()
+    if has_app_context():
+        conn = g.get("_db_conn")
+        if conn is None:
+            conn = PooledConnection(pool, pool.acquire(), request_scoped=True)
+            g._db_conn = conn
+        return conn
+    return PooledConnection(pool, pool.acquire())
+
+
+def close_db(e=None):
+    """
+    Libera la conexión de la solicitud actual (teardown de Flask). Una
+    transacción que quedó abierta se revierte al devolverla al pool.
+    """
+    conn = g.pop("_db_conn", None)
+    if conn is not None:
+        conn.release()
+
+def liberar_conexion():
+    """
+    Devuelve al pool la conexión de la solicitud actual antes de una espera
+    larga (una llamada a Gemini), para que un chat lento no deje sin
+    conexiones al resto de las rutas. Si la solicitud vuelve a usar la base
+    después, get_db_connection toma otra.
+    """
+    if has_app_context():
+        close_db()
+
+
+def init_app(app):
+    """Registra la liberación de la conexión al terminar cada solicitud."""
+    app.teardown_appcontext(close_db)
+
+def _migrar_citas_fecha_fin(cursor):
+    """
+    Migración: añade 'fecha_hora_fin' a bases de datos anteriores y
+    rellena las filas existentes a partir del inicio + duración.
+    """
+    columnas = [col['name'] for col in cursor.execute("PRAGMA table_info(citas)")]
+    if 'fecha_hora_fin' in columnas:
+        return
+
+    cursor.execute("ALTER TABLE citas ADD COLUMN fecha_hora_fin DATETIME")
+    cursor.execute("""
+        UPDATE citas
+        SET fecha_hora_fin = datetime(fecha_hora_inicio, '+' || duracion_minutos || ' minutes')
+        WHERE fecha_hora_fin IS NULL
+    """)
+
+# None = aún no se ha revisado si existe la tabla medicos_fts
+_fts_disponible = None
+
+def busqueda_fts_disponible(cursor):
+    """
+    True si existe el índice FTS5 de médicos (requiere SQLite con FTS5 y
+    el tokenizador 'trigram', 3.34+). Se revisa una sola vez por proceso.
+    """
+    global _fts_disponible
+    if _fts_disponible is None:
+        fila = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'medicos_fts'"
+        ).fetchone()
+        _fts_disponible = fila is not None
+    return _fts_disponible
+
+def indexar_medico(cursor, medico_id, nombre_completo, especialidad, ubicacion):
+    """
+    Guarda la especialidad normalizada y la fila del índice de búsqueda
+    de un médico ya existente. Los médicos nuevos los indexan los triggers
+    de medicos (ver _crear_triggers_busqueda_medicos); esto queda para
+    las migraciones que ponen al día bases anteriores.
+    """
+    cursor.execute(
+        "UPDATE medicos SET especialidad_norm = ? WHERE id = ?",
+        (normalizar_texto(especialidad), medico_id)
+    )
+    if busqueda_fts_disponible(cursor):
+        cursor.execute("DELETE FROM medicos_fts WHERE rowid = ?", (medico_id,))
+        cursor.execute(
+            "INSERT INTO medicos_fts (rowid, nombre, especialidad, ubicacion) VALUES (?, ?, ?, ?)",
+            (medico_id, normalizar_texto(nombre_completo), normalizar_texto(especialidad), normalizar_texto(ubicacion))
+        )
+
+def _migrar_medicos_busqueda(cursor):
+    """
+    Migración: añade 'especialidad_norm' (sin acentos ni mayúsculas) y el
+    índice FTS5 por trigramas sobre nombre, especialidad y ubicación.
+    """
+    global _fts_disponible
+    columnas = [col['name'] for col in cursor.execute("PRAGMA table_info(medicos)")]
+    if 'especialidad_norm' not in columnas:
+        cursor.execute("ALTER TABLE medicos ADD COLUMN especialidad_norm TEXT")
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_medicos_especialidad_norm
+    ON medicos (especialidad_norm)
+    """)
+    # El texto se guarda ya normalizado: el 'trigram' de SQLite < 3.45 no quita acentos
+    try:
+        cursor.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS medicos_fts
+        USING fts5(nombre, especialidad, ubicacion, tokenize = 'trigram')
+        """)
+        _fts_disponible = True
+    except sqlite3.OperationalError as e:
+        log.warning("Búsqueda FTS5 no disponible, se usará LIKE (%s)", e)
+        _fts_disponible = False
+
+def _indexar_medicos_pendientes(cursor):
+    """Indexa los médicos que aún no tienen especialidad normalizada."""
+    pendientes = cursor.execute(
+        "SELECT id, nombre_completo, especialidad, ubicacion FROM medicos WHERE especialidad_norm IS NULL"
+    ).fetchall()
+    for medico in pendientes:
+        indexar_medico(cursor, medico['id'], medico['nombre_completo'], medico['especialidad'], medico['ubicacion'])
+
+# Letras de Latin-1 (español, portugués, francés...) que normalizar_texto cambia
+_SIN_ACENTOS = tuple(
+    (letra, normalizar_texto(letra))
+    for letra in map(chr, range(0xC0, 0x100))
+    if normalizar_texto(letra) != letra
+)
+
+# SQLite no acepta más de ~30 replace() anidados: se aplican por lotes
+_REEMPLAZOS_POR_PASO = 14
+
+def _reemplazar_sql(expresion, reemplazos):
+    for letra, reemplazo in reemplazos:
+        expresion = f"replace({expresion}, '{letra}', '{reemplazo}')"
+    return expresion
+
+def _pasos_normalizar(columna, destino):
+    """
+    normalizar_texto escrito en SQL, para los triggers: así funcionan en
+    cualquier conexión (también sqlite3.connect sin funciones registradas).
+    lower() de SQLite solo cambia ASCII; los acentos se quitan con replace().
+    Devuelve expresiones que se asignan a 'destino' en orden: la primera
+    lee 'columna' y las demás el valor que dejó la anterior.
+    """
+    lotes = [
+        _SIN_ACENTOS[i:i + _REEMPLAZOS_POR_PASO]
+        for i in range(0, len(_SIN_ACENTOS), _REEMPLAZOS_POR_PASO)
+    ]
+    primero = _reemplazar_sql(f"trim(lower(COALESCE({columna}, '')))", lotes[0])
+    return [primero] + [_reemplazar_sql(destino, lote) for lote in lotes[1:]]
+
+def _crear_triggers_busqueda_medicos(cursor):
+    """
+    Triggers que mantienen especialidad_norm y medicos_fts con cada INSERT,
+    UPDATE o DELETE en medicos, sin importar por dónde se escriba
+    (servicios, importación, scripts o benchmarks).
+    """
+    indexar = "".join(
+        f"UPDATE medicos SET especialidad_norm = {paso} WHERE id = NEW.id;\n"
+        for paso in _pasos_normalizar("NEW.especialidad", "especialidad_norm")
+    )
+    fts = busqueda_fts_disponible(cursor)
+    if fts:
+        pasos = list(zip(
+            _pasos_normalizar("NEW.nombre_completo", "nombre"),
+            _pasos_normalizar("NEW.especialidad", "especialidad"),
+            _pasos_normalizar("NEW.ubicacion", "ubicacion"),
+        ))
+        nombre, especialidad, ubicacion = pasos[0]
+        indexar += (
+            "DELETE FROM medicos_fts WHERE rowid = NEW.id;\n"
+            "INSERT INTO medicos_fts (rowid, nombre, especialidad, ubicacion) "
+            f"VALUES (NEW.id, {nombre}, {especialidad}, {ubicacion});\n"
+        )
+        indexar += "".join(
+            f"UPDATE medicos_fts SET nombre = {nombre}, especialidad = {especialidad}, "
+            f"ubicacion = {ubicacion} WHERE rowid = NEW.id;\n"
+            for nombre, especialidad, ubicacion in pasos[1:]
+        )
+    cursor.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_medicos_busqueda_insert
+    AFTER INSERT ON medicos
+    BEGIN
+        {indexar}
+    END
+    """)
+    cursor.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_medicos_busqueda_update
+    AFTER UPDATE OF nombre_completo, especialidad, ubicacion ON medicos
+    BEGIN
+        {indexar}
+    END
+    """)
+    if fts:
+        cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_medicos_busqueda_delete
+        AFTER DELETE ON medicos
+        BEGIN
+            DELETE FROM medicos_fts WHERE rowid = OLD.id;
+        END
+        """)
+
+# Tablas cuyas escrituras incrementan un contador de versión (ver get_contadores)
+TABLAS_VERSIONADAS = ("medicos", "citas")
+
+def _crear_contadores(cursor):
+    """
+    Contadores de versión mantenidos por triggers: cualquier INSERT, UPDATE
+    o DELETE en una tabla versionada incrementa su contador y guarda la hora.
+    Sirven como clave de cachés (fragmentos renderizados) y para ETag/Last-Modified.
+    """
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS contadores (
+        nombre TEXT PRIMARY KEY,
+        valor INTEGER NOT NULL DEFAULT 0,
+        actualizado_en DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    for tabla in TABLAS_VERSIONADAS:
+        cursor.execute("INSERT OR IGNORE INTO contadores (nombre) VALUES (?)", (tabla,))
+        for evento in ("INSERT", "UPDATE", "DELETE"):
+            cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{tabla}_version_{evento.lower()}
+            AFTER {evento} ON {tabla}
+            BEGIN
+                UPDATE contadores SET valor = valor + 1, actualizado_en = CURRENT_TIMESTAMP
+                WHERE nombre = '{tabla}';
+            END
+            """)
+
+# Tablas con un contador '<tabla>_total' de filas, para no hacer COUNT(*) en cada página
+TABLAS_CONTADAS = ("pacientes", "medicos")
+
+def _crear_totales(cursor):
+    """
+    Contadores de filas mantenidos por triggers de INSERT y DELETE (el
+    valor es el número de filas, no una versión). Se inician con un
+    COUNT(*) al crearlos.
+    """
+    for tabla in TABLAS_CONTADAS:
+        nombre = f"{tabla}_total"
+        cursor.execute(
+            f"INSERT OR REPLACE INTO contadores (nombre, valor) VALUES (?, (SELECT COUNT(*) FROM {tabla}))",
+            (nombre,)
+        )
+        for evento, delta in (("INSERT", "+ 1"), ("DELETE", "- 1")):
+            cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{tabla}_total_{evento.lower()}
+            AFTER {evento} ON {tabla}
+            BEGIN
+                UPDATE contadores SET valor = valor {delta}, actualizado_en = CURRENT_TIMESTAMP
+                WHERE nombre = '{nombre}';
+            END
+            """)
+
+def get_contadores(*nombres):
+    """
+    Devuelve {nombre: (valor, actualizado_en)} de los contadores pedidos.
+    'actualizado_en' es texto UTC 'AAAA-MM-DD HH:MM:SS'.
+    """
+    conn = get_db_connection()
+    try:
+        marcas = ",".join("?" * len(nombres))
+        filas = conn.execute(
+            f"SELECT nombre, valor, actualizado_en FROM contadores WHERE nombre IN ({marcas})", nombres
+        ).fetchall()
+        return {fila['nombre']: (fila['valor'], fila['actualizado_en']) for fila in filas}
+    finally:
+        conn.close()
+
+# --- Estadísticas de citas por médico y día ---
+# Los triggers las mantienen al día con cada reserva, cancelación o
+# completado (incluidas las importaciones), así que el dashboard nunca
+# recorre la tabla citas. reconstruir_estadisticas_citas las recalcula.
+
+# Contribución de una fila de citas ('NEW' u 'OLD') a su día
+def _aporte_cita(fila):
+    return (
+        f"{fila}.estado = 'programada'",
+        f"{fila}.estado = 'completada'",
+        f"{fila}.estado = 'cancelada'",
+        f"CASE WHEN {fila}.estado = 'cancelada' THEN 0 ELSE {fila}.duracion_minutos END",
+    )
+
+def _sumar_cita_sql(fila):
+    programadas, completadas, canceladas, minutos = _aporte_cita(fila)
+    return f"""
+    INSERT INTO estadisticas_citas (dia, medico_id, programadas, completadas, canceladas, minutos_ocupados)
+    VALUES (date({fila}.fecha_hora_inicio), {fila}.medico_id, {programadas}, {completadas}, {canceladas}, {minutos})
+    ON CONFLICT (dia, medico_id) DO UPDATE SET
+        programadas = programadas + excluded.programadas,
+        completadas = completadas + excluded.completadas,
+        canceladas = canceladas + excluded.canceladas,
+        minutos_ocupados = minutos_ocupados + excluded.minutos_ocupados;
+    """
+
+def _restar_cita_sql(fila):
+    programadas, completadas, canceladas, minutos = _aporte_cita(fila)
+    return f"""
+    UPDATE estadisticas_citas SET
+        programadas = programadas - ({programadas}),
+        completadas = completadas - ({completadas}),
+        canceladas = canceladas - ({canceladas}),
+        minutos_ocupados = minutos_ocupados - ({minutos})
+    WHERE dia = date({fila}.fecha_hora_inicio) AND medico_id = {fila}.medico_id;
+    """
+
+def _crear_estadisticas_citas(cursor):
+    """
+    Tabla estadisticas_citas (una fila por día y médico) y los triggers
+    que la actualizan. 'minutos_ocupados' no cuenta las citas canceladas.
+    """
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS estadisticas_citas (
+        dia TEXT NOT NULL, -- AAAA-MM-DD de fecha_hora_inicio
+        medico_id INTEGER NOT NULL,
+        programadas INTEGER NOT NULL DEFAULT 0,
+        completadas INTEGER NOT NULL DEFAULT 0,
+        canceladas INTEGER NOT NULL DEFAULT 0,
+        minutos_ocupados INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (dia, medico_id)
+    ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_estadisticas_citas_medico
+    ON estadisticas_citas (medico_id, dia)
+    """)
+    cursor.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_citas_estadisticas_insert
+    AFTER INSERT ON citas
+    BEGIN
+        {_sumar_cita_sql("NEW")}
+    END
+    """)
+    cursor.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_citas_estadisticas_update
+    AFTER UPDATE OF estado, medico_id, fecha_hora_inicio, duracion_minutos ON citas
+    BEGIN
+        {_restar_cita_sql("OLD")}
+        {_sumar_cita_sql("NEW")}
+    END
+    """)
+    cursor.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_citas_estadisticas_delete
+    AFTER DELETE ON citas
+    BEGIN
+        {_restar_cita_sql("OLD")}
+    END
+    """)
+
+def reconstruir_estadisticas_citas(cursor):
+    """
+    Recalcula estadisticas_citas desde cero recorriendo todas las citas
+    (bases anteriores a los triggers o reparaciones). Devuelve las filas
+    generadas. Hay que llamarla dentro de una transacción.
+    """
+    cursor.execute("DELETE FROM estadisticas_citas")
+    cursor.execute("""
+        INSERT INTO estadisticas_citas (dia, medico_id, programadas, completadas, canceladas, minutos_ocupados)
+        SELECT date(fecha_hora_inicio), medico_id,
+               SUM(estado = 'programada'), SUM(estado = 'completada'), SUM(estado = 'cancelada'),
+               SUM(CASE WHEN estado = 'cancelada' THEN 0 ELSE duracion_minutos END)
+        FROM citas
+        GROUP BY date(fecha_hora_inicio), medico_id
+    """)
+    return cursor.execute("SELECT COUNT(*) FROM estadisticas_citas").fetchone()[0]
+
+# --- Migraciones versionadas ---
+# Cada migración corre una sola vez por base de datos y queda registrada en
+# schema_version. Son idempotentes (IF NOT EXISTS, revisión de columnas) para
+# que una base creada antes de existir schema_version se pueda versionar.
+# Para cambiar el esquema: agregar una función al final de MIGRACIONES.
+
+def _m001_tablas_base(cursor):
     """
     Crea todas las tablas desde cero si no existen.
     Esta es la "Base de Datos Chingona".
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     # --- Usuarios: El sistema central de login ---
     cursor.execute("""
     CREATE TABLE IF NOT EXISTS usuarios (
@@ -50,7 +695,8 @@ def init_db():
         nombre_completo TEXT NOT NULL,
         especialidad TEXT NOT NULL,
         horario_trabajo TEXT,
-        ubicacion TEXT  -- <-- ¡NUEVO CAMPO! (Ej: "Consultorio 105, Piso 1")
+        ubicacion TEXT,  -- <-- ¡NUEVO CAMPO! (Ej: "Consultorio 105, Piso 1")
+        especialidad_norm TEXT -- Especialidad sin acentos ni mayúsculas (para filtrar con índice)
     )
     """)
     
@@ -62,6 +708,7 @@ def init_db():
         medico_id INTEGER NOT NULL,
         fecha_hora_inicio DATETIME NOT NULL,
         duracion_minutos INTEGER NOT NULL DEFAULT 30,
+        fecha_hora_fin DATETIME, -- Persistida para que el chequeo de traslapes use índices
         estado TEXT NOT NULL DEFAULT 'programada' CHECK(estado IN ('programada', 'cancelada', 'completada')),
         notas_paciente TEXT,
         FOREIGN KEY (paciente_id) REFERENCES pacientes (id),
@@ -80,27 +727,234 @@ def init_db():
         FOREIGN KEY (cita_id) REFERENCES citas (id)
     )
     """)
+
+def _m002_citas_fecha_fin(cursor):
+    _migrar_citas_fecha_fin(cursor)
+    # Índice parcial: solo las citas vivas participan en el chequeo de traslapes
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_citas_medico_programada
+    ON citas (medico_id, fecha_hora_inicio, fecha_hora_fin)
+    WHERE estado = 'programada'
+    """)
+
+def _m003_busqueda_medicos(cursor):
+    _migrar_medicos_busqueda(cursor)
+    # Médicos de bases anteriores sin clave normalizada ni fila en el índice
+    _indexar_medicos_pendientes(cursor)
+
+def _m004_chat_en_servidor(cursor):
+    # --- Chat: conversaciones y mensajes guardados en el servidor ---
+    # La cookie de sesión solo guarda el id de la conversación.
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS conversaciones (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        usuario_id INTEGER NOT NULL,
+        creada_en DATETIME DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (usuario_id) REFERENCES usuarios (id) ON DELETE CASCADE
+    )
+    """)
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_conversaciones_usuario
+    ON conversaciones (usuario_id, creada_en)
+    """)
     
-    # --- Crear usuario Admin por defecto ---
-    try:
-        admin_pass_hash = generate_password_hash("admin123")
-        cursor.execute(
-            "INSERT INTO usuarios (username, password_hash, role) VALUES (?, ?, ?)",
-            ('admin', admin_pass_hash, 'admin')
-        )
-    except sqlite3.IntegrityError:
-        pass  # El admin ya existe
+    # Solo se insertan filas (append-only); nunca se actualizan mensajes
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS mensajes_chat (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        conversacion_id INTEGER NOT NULL,
+        usuario_id INTEGER NOT NULL,
+        role TEXT NOT NULL CHECK(role IN ('user', 'ai')),
+        content TEXT NOT NULL,
+        creado_en DATETIME DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (conversacion_id) REFERENCES conversaciones (id) ON DELETE CASCADE
+    )
+    """)
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_mensajes_usuario_fecha
+    ON mensajes_chat (usuario_id, creado_en)
+    """)
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_mensajes_conversacion
+    ON mensajes_chat (conversacion_id, id)
+    """)
 
-    # --- (Opcional) Crear un médico de prueba ---
-    try:
-        horario_dr = '{"lunes": ["09:00-12:00"], "miercoles": ["09:00-12:00"], "viernes": ["09:00-12:00"]}'
-        cursor.execute(
-            "INSERT INTO medicos (nombre_completo, especialidad, horario_trabajo, ubicacion) VALUES (?, ?, ?, ?)",
-            ('Dr. Alan Turing', 'Cardiología', horario_dr, 'Consultorio 201')
-        )
-    except sqlite3.IntegrityError:
-        pass
+def _m005_indices_listados(cursor):
+    # Listados del panel de admin: paginación por (nombre_completo, id)
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_pacientes_nombre
+    ON pacientes (nombre_completo, id)
+    """)
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_medicos_nombre
+    ON medicos (nombre_completo, id)
+    """)
+
+def _m006_indices_citas_paciente(cursor):
+    # Próximas citas de un paciente (portal, IA): filtro por estado y rango de fechas
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_citas_paciente_estado
+    ON citas (paciente_id, estado, fecha_hora_inicio)
+    """)
+    # Historial paginado de un paciente, de la más reciente a la más antigua
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_citas_paciente_inicio
+    ON citas (paciente_id, fecha_hora_inicio)
+    """)
+
+def _m007_contadores(cursor):
+    _crear_contadores(cursor)
+
+def _m008_quitar_medico_prueba_duplicado(cursor):
+    """
+    Antes el médico de prueba se insertaba en cada arranque. Se conserva el
+    primero y se borran las copias que no tienen citas.
+    """
+    duplicados = [fila[0] for fila in cursor.execute("""
+        SELECT id FROM medicos
+        WHERE nombre_completo = ? AND especialidad = ? AND ubicacion = ?
+        AND id > (SELECT MIN(id) FROM medicos WHERE nombre_completo = ? AND especialidad = ? AND ubicacion = ?)
+        AND id NOT IN (SELECT medico_id FROM citas)
+    """, MEDICO_PRUEBA[:2] + MEDICO_PRUEBA[3:] + MEDICO_PRUEBA[:2] + MEDICO_PRUEBA[3:])]
+    for medico_id in duplicados:
+        cursor.execute("DELETE FROM medicos WHERE id = ?", (medico_id,))
+        if busqueda_fts_disponible(cursor):
+            cursor.execute("DELETE FROM medicos_fts WHERE rowid = ?", (medico_id,))
+    if duplicados:
+        log.info("Se borraron %s copias del médico de prueba.", len(duplicados))
+
+def _m009_estadisticas_citas(cursor):
+    _crear_estadisticas_citas(cursor)
+    filas = reconstruir_estadisticas_citas(cursor)
+    if filas:
+        log.info("Estadísticas de citas calculadas: %s filas (día, médico).", filas)
 
+def _m010_busqueda_medicos_por_triggers(cursor):
+    _crear_triggers_busqueda_medicos(cursor)
+    # Médicos insertados sin indexar_medico (scripts, benchmarks) antes de los triggers
+    _indexar_medicos_pendientes(cursor)
+
+def _m011_totales(cursor):
+    _crear_totales(cursor)
+
+MIGRACIONES = (
+    (1, "tablas_base", _m001_tablas_base),
+    (2, "citas_fecha_fin", _m002_citas_fecha_fin),
+    (3, "busqueda_medicos", _m003_busqueda_medicos),
+    (4, "chat_en_servidor", _m004_chat_en_servidor),
+    (5, "indices_listados", _m005_indices_listados),
+    (6, "indices_citas_paciente", _m006_indices_citas_paciente),
+    (7, "contadores", _m007_contadores),
+    (8, "quitar_medico_prueba_duplicado", _m008_quitar_medico_prueba_duplicado),
+    (9, "estadisticas_citas", _m009_estadisticas_citas),
+    (10, "busqueda_medicos_por_triggers", _m010_busqueda_medicos_por_triggers),
+    (11, "totales", _m011_totales),
+)
+VERSION_ESQUEMA = MIGRACIONES[-1][0]
+
+def version_esquema(cursor):
+    """Última migración aplicada (0 si la base no tiene schema_version)."""
+    existe = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'schema_version'"
+    ).fetchone()
+    if not existe:
+        return 0
+    return cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+def _aplicar_migraciones(conn):
+    """
+    Aplica las migraciones pendientes, cada una en su propia transacción
+    BEGIN IMMEDIATE: si varios workers arrancan a la vez, solo uno la
+    aplica y los demás la ven registrada al tomar el lock.
+    Devuelve los nombres de las migraciones aplicadas.
+    """
+    aplicadas = []
+    cursor = conn.cursor()
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        nombre TEXT NOT NULL,
+        aplicada_en DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
     conn.commit()
-    conn.close()
-    print("Base de datos inicializada exitosamente.")
\ No newline at end of file
+    for version, nombre, migracion in MIGRACIONES:
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            if version <= version_esquema(cursor):
+                conn.rollback()
+                continue
+            migracion(cursor)
+            cursor.execute("INSERT INTO schema_version (version, nombre) VALUES (?, ?)", (version, nombre))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        aplicadas.append(nombre)
+    return aplicadas
+
+# --- Datos iniciales ---
+
+# (nombre, especialidad, horario, ubicación) del médico de prueba
+MEDICO_PRUEBA = (
+    'Dr. Alan Turing', 'Cardiología',
+    '{"lunes": ["09:00-12:00"], "miercoles": ["09:00-12:00"], "viernes": ["09:00-12:00"]}',
+    'Consultorio 201'
+)
+
+def _sembrar_datos(conn):
+    """
+    Crea el admin por defecto y el médico de prueba si no existen. Se revisa
+    antes de hashear: generate_password_hash es lento a propósito.
+    """
+    cursor = conn.cursor()
+
+    def faltantes():
+        falta_admin = not cursor.execute("SELECT 1 FROM usuarios WHERE username = 'admin'").fetchone()
+        falta_medico = not cursor.execute(
+            "SELECT 1 FROM medicos WHERE nombre_completo = ?", (MEDICO_PRUEBA[0],)
+        ).fetchone()
+        return falta_admin, falta_medico
+
+    falta_admin, falta_medico = faltantes()
+    if not (falta_admin or falta_medico):
+        return
+    admin_pass_hash = generate_password_hash("admin123") if falta_admin else None
+
+    # Otro worker pudo sembrar mientras tanto: revisar de nuevo con el lock tomado
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        falta_admin, falta_medico = faltantes()
+        # --- Crear usuario Admin por defecto ---
+        if falta_admin and admin_pass_hash:
+            cursor.execute(
+                "INSERT INTO usuarios (username, password_hash, role) VALUES (?, ?, ?)",
+                ('admin', admin_pass_hash, 'admin')
+            )
+        # --- (Opcional) Crear un médico de prueba ---
+        if falta_medico:
+            cursor.execute(
+                "INSERT INTO medicos (nombre_completo, especialidad, horario_trabajo, ubicacion) VALUES (?, ?, ?, ?)",
+                MEDICO_PRUEBA
+            )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def init_db():
+    """
+    Deja la base de datos lista: aplica las migraciones pendientes y crea los
+    datos iniciales que falten. Si el esquema ya está al día (lo normal en
+    cada reinicio), solo cuesta un par de SELECT.
+    """
+    conn = get_db_connection()
+    try:
+        if version_esquema(conn.cursor()) < VERSION_ESQUEMA:
+            aplicadas = _aplicar_migraciones(conn)
+            if aplicadas:
+                log.info("Migraciones aplicadas: %s", ", ".join(aplicadas))
+        _sembrar_datos(conn)
+    finally:
+        conn.close()
+    log.info("Base de datos inicializada exitosamente (esquema v%s).", VERSION_ESQUEMA)
@@ -0,0 +1,372 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+from controllers import metrics
+
+# --- Configuración (0 = sin límite) ---
+# Cuota del proyecto en Gemini: solicitudes y tokens por minuto
+RPM = float(os.environ.get("GEMINI_RPM", "0"))
+TPM = float(os.environ.get("GEMINI_TPM", "0"))
+# Solicitudes por minuto para un mismo usuario (un paciente no se lleva toda la cuota)
+RPM_POR_USUARIO = float(os.environ.get("GEMINI_RPM_POR_USUARIO", "0"))
+# Llamadas a Gemini al mismo tiempo en todo el proceso
+MAX_EN_VUELO = int(os.environ.get("GEMINI_MAX_EN_VUELO", "32"))
+# Segundos que una llamada puede esperar turno antes de rendirse
+ESPERA_MAXIMA_S = float(os.environ.get("GEMINI_ESPERA_MAXIMA_S", "30"))
+# Reintentos ante 429/5xx o errores de red, con espera exponencial (base * 2^intento, con jitter)
+REINTENTOS = int(os.environ.get("GEMINI_REINTENTOS", "3"))
+REINTENTO_BASE_S = float(os.environ.get("GEMINI_REINTENTO_BASE_S", "0.5"))
+REINTENTO_MAXIMO_S = float(os.environ.get("GEMINI_REINTENTO_MAXIMO_S", "8"))
+
+# Códigos HTTP de Gemini que vale la pena reintentar
+CODIGOS_REINTENTABLES = {429, 500, 502, 503, 504}
+
+log = metrics.get_logger(__name__)
+
+GEMINI_ESPERA = metrics.histograma(
+    "medagend_gemini_espera_segundos", "Tiempo en la cola del planificador antes de llamar a Gemini"
+)
+GEMINI_LIMITADAS = metrics.contador(
+    "medagend_gemini_limitadas_total", "Llamadas que tuvieron que esperar por un límite", ("motivo",)
+)
+GEMINI_REINTENTOS = metrics.contador(
+    "medagend_gemini_reintentos_total", "Reintentos de llamadas a Gemini por tipo de error", ("error",)
+)
+GEMINI_RECHAZADAS = metrics.contador(
+    "medagend_gemini_rechazadas_total", "Llamadas que no consiguieron turno en GEMINI_ESPERA_MAXIMA_S"
+)
+
+
+class GeminiSaturado(Exception):
+    """No hubo turno para llamar a Gemini dentro de la espera máxima."""
+
+
+class RespuestaEnStream:
+    """
+    Respuesta de send_message(stream=True) que ocupa su lugar en vuelo
+    hasta terminar de leerse: Gemini sigue generando después del primer
+    fragmento. Al agotarla o cerrarla (cerrar(), o el generador que la
+    recorre se cierra) se libera el lugar y se cobran los tokens reales.
+    Lo demás (usage_metadata, candidates...) se delega a la respuesta.
+    """
+
+    def __init__(self, respuesta, liberar):
+        self._respuesta = respuesta
+        self._liberar = liberar
+
+    def __iter__(self):
+        try:
+            yield from self._respuesta
+        finally:
+            self.cerrar()
+
+    def cerrar(self):
+        liberar, self._liberar = self._liberar, None
+        if liberar is not None:
+            liberar(self._respuesta)
+
+    def __getattr__(self, nombre):
+        return getattr(self._respuesta, nombre)
+
+
+class _Cubeta:
+    """Cubeta de fichas que se rellena a 'por_minuto' fichas por minuto."""
+
+    def __init__(self, por_minuto):
+        self.capacidad = por_minuto
+        self.fichas = por_minuto
+        self._ultimo = time.monotonic()
+
+    def _rellenar(self, ahora):
+        self.fichas = min(self.capacidad, self.fichas + (ahora - self._ultimo) * self.capacidad / 60)
+        self._ultimo = ahora
+
+    def espera(self, cantidad, ahora):
+        """Segundos hasta que haya 'cantidad' fichas (0 si ya las hay)."""
+        if self.capacidad <= 0:
+            return 0
+        self._rellenar(ahora)
+        # Una llamada más grande que la cubeta espera a que se llene, no para siempre
+        falta = min(cantidad, self.capacidad) - self.fichas
+        return falta * 60 / self.capacidad if falta > 0 else 0
+
+    def consumir(self, cantidad):
+        # Puede quedar en negativo (ej. al cobrar los tokens reales): las siguientes esperan más
+        if self.capacidad > 0:
+            self.fichas -= cantidad
+
+    def vaciar(self):
+        if self.capacidad > 0:
+            self.fichas = min(self.fichas, 0)
+
+    @property
+    def llena(self):
+        return self.capacidad <= 0 or self.fichas >= self.capacidad
+
+
+class _Turno:
+    __slots__ = ("usuario", "tokens", "avisar", "encolado", "concedido", "limitado")
+
+    def __init__(self, usuario, tokens, avisar):
+        self.usuario = usuario
+        self.tokens = tokens
+        self.avisar = avisar
+        self.encolado = time.monotonic()
+        self.concedido = False
+        self.limitado = False
+
+
+class PlanificadorGemini:
+    """
+    Punto único por el que pasan las llamadas a Gemini.
+
+    - Cubetas de fichas para solicitudes/min y tokens/min del proyecto, y
+      opcionalmente solicitudes/min por usuario.
+    - Cola justa: una fila por usuario, atendidas por turnos (round robin),
+      así un paciente con muchas llamadas no retrasa a los demás.
+    - Tope de llamadas en vuelo.
+    - Reintentos con espera exponencial ante 429/5xx y errores de red.
+
+    Un hilo despachador entrega los turnos; quien llama solo espera el suyo.
+    """
+
+    def __init__(self, rpm=RPM, tpm=TPM, rpm_por_usuario=RPM_POR_USUARIO, max_en_vuelo=MAX_EN_VUELO,
+                 espera_maxima=ESPERA_MAXIMA_S, reintentos=REINTENTOS):
+        self.max_en_vuelo = max_en_vuelo
+        self.espera_maxima = espera_maxima
+        self.reintentos = reintentos
+        self.rpm_por_usuario = rpm_por_usuario
+        self._rpm = _Cubeta(rpm)
+        self._tpm = _Cubeta(tpm)
+        self._cubetas_usuario = {}
+        self._sin_limite = _Cubeta(0)
+        self._colas = OrderedDict()  # usuario -> deque de _Turno, en orden de atención
+        self._en_cola = 0
+        self._en_vuelo = 0
+        self._cond = threading.Condition()
+        self._hilo = None
+
+    # --- Despacho ---
+
+    def _cubeta_usuario(self, usuario):
+        if self.rpm_por_usuario <= 0:
+            return self._sin_limite
+        cubeta = self._cubetas_usuario.get(usuario)
+        if cubeta is None:
+            if len(self._cubetas_usuario) > 10_000:
+                # Olvidar a los usuarios que ya recuperaron todo su cupo
+                self._cubetas_usuario = {u: c for u, c in self._cubetas_usuario.items() if not c.llena}
+            cubeta = self._cubetas_usuario[usuario] = _Cubeta(self.rpm_por_usuario)
+        return cubeta
+
+    def _siguiente(self, ahora):
+        """
+        El primer usuario (en orden de turno) cuya siguiente llamada cabe en
+        los límites. Devuelve (usuario, None) o (None, segundos a esperar).
+        """
+        menor_espera = None
+        for usuario, cola in self._colas.items():
+            turno = cola[0]
+            esperas = {
+                "rpm": self._rpm.espera(1, ahora),
+                "tpm": self._tpm.espera(turno.tokens, ahora),
+                "rpm_usuario": self._cubeta_usuario(usuario).espera(1, ahora),
+            }
+            motivo, espera = max(esperas.items(), key=lambda par: par[1])
+            if espera <= 0:
+                return usuario, None
+            if not turno.limitado:
+                turno.limitado = True
+                GEMINI_LIMITADAS.inc(motivo)
+            menor_espera = espera if menor_espera is None else min(menor_espera, espera)
+        return None, menor_espera
+
+    def _despachar(self):
+        with self._cond:
+            while True:
+                if not self._colas:
+                    self._cond.wait()
+                    continue
+                if self._en_vuelo >= self.max_en_vuelo:
+                    for cola in self._colas.values():
+                        if not cola[0].limitado:
+                            cola[0].limitado = True
+                            GEMINI_LIMITADAS.inc("en_vuelo")
+                    self._cond.wait()
+                    continue
+                usuario, espera = self._siguiente(time.monotonic())
+                if usuario is None:
+                    self._cond.wait(espera)
+                    continue
+
+                cola = self._colas.pop(usuario)
+                turno = cola.popleft()
+                if cola:
+                    # Al final de la fila: los demás usuarios van primero
+                    self._colas[usuario] = cola
+                self._en_cola -= 1
+                self._en_vuelo += 1
+                self._rpm.consumir(1)
+                self._tpm.consumir(turno.tokens)
+                self._cubeta_usuario(usuario).consumir(1)
+                turno.concedido = True
+                GEMINI_ESPERA.observar(time.monotonic() - turno.encolado)
+                turno.avisar()
+
+    def _encolar(self, turno):
+        with self._cond:
+            if self._hilo is None:
+                self._hilo = threading.Thread(target=self._despachar, name="gemini-planificador", daemon=True)
+                self._hilo.start()
+            self._colas.setdefault(turno.usuario, deque()).append(turno)
+            self._en_cola += 1
+            self._cond.notify_all()
+
+    def _abandonar(self, turno):
+        """
+        Saca de la cola un turno que se cansó de esperar. Devuelve False si
+        el despachador alcanzó a concederlo (entonces hay que usarlo).
+        """
+        with self._cond:
+            if turno.concedido:
+                return False
+            cola = self._colas.get(turno.usuario)
+            if cola is not None:
+                cola.remove(turno)
+                if not cola:
+                    del self._colas[turno.usuario]
+            self._en_cola -= 1
+        GEMINI_RECHAZADAS.inc()
+        return True
+
+    def _liberar(self, tokens_estimados, respuesta=None):
+        with self._cond:
+            self._en_vuelo -= 1
+            # Cobrar los tokens reales en lugar de la estimación
+            uso = getattr(respuesta, "usage_metadata", None)
+            if uso is not None and uso.total_token_count:
+                self._tpm.consumir(uso.total_token_count - tokens_estimados)
+            self._cond.notify_all()
+
+    def _esperar_turno(self, usuario, tokens):
+        listo = threading.Event()
+        turno = _Turno(usuario, tokens, listo.set)
+        self._encolar(turno)
+        if not listo.wait(self.espera_maxima) and self._abandonar(turno):
+            raise GeminiSaturado(f"Sin turno para Gemini después de {self.espera_maxima:g} s")
+
+    async def _esperar_turno_async(self, usuario, tokens):
+        loop = asyncio.get_running_loop()
+        futuro = loop.create_future()
+
+        def avisar():
+            loop.call_soon_threadsafe(lambda: futuro.done() or futuro.set_result(None))
+
+        turno = _Turno(usuario, tokens, avisar)
+        self._encolar(turno)
+        await asyncio.wait([futuro], timeout=self.espera_maxima)
+        if not futuro.done():
+            if self._abandonar(turno):
+                raise GeminiSaturado(f"Sin turno para Gemini después de {self.espera_maxima:g} s")
+            await futuro
+
+    # --- Reintentos ---
+
+    def _espera_reintento(self, error, intento):
+        """Segundos antes de reintentar, o None si el error no se reintenta."""
+        codigo = getattr(error, "code", None)
+        codigo = int(codigo) if isinstance(codigo, int) else None
+        de_red = isinstance(error, (ConnectionError, TimeoutError)) or type(error).__name__ in (
+            "ConnectionError", "Timeout", "ReadTimeout", "ConnectTimeout"
+        )
+        if intento >= self.reintentos or not (codigo in CODIGOS_REINTENTABLES or de_red):
+            return None
+        if codigo == 429:
+            # Gemini dice que nos pasamos de la cuota: frenar a todos, no solo a esta llamada
+            with self._cond:
+                self._rpm.vaciar()
+        GEMINI_REINTENTOS.inc(str(codigo) if codigo else "red")
+        espera = min(REINTENTO_MAXIMO_S, REINTENTO_BASE_S * 2 ** intento)
+        return espera * random.uniform(0.5, 1.0)
+
+    def ejecutar(self, usuario, funcion, tokens=0, stream=False):
+        """
+        Llama a funcion() (una llamada a Gemini) cuando le toca al usuario y
+        dentro de los límites, reintentando los errores transitorios.
+        'tokens' es la estimación de tokens de la llamada (entrada + salida).
+        Con stream=True devuelve una RespuestaEnStream: el lugar se libera al
+        terminar de leerla, no al llegar el primer fragmento.
+        """
+        for intento in range(self.reintentos + 1):
+            self._esperar_turno(usuario, tokens)
+            respuesta = None
+            liberar = True
+            try:
+                respuesta = funcion()
+                if stream:
+                    liberar = False
+                    return RespuestaEnStream(respuesta, lambda r: self._liberar(tokens, r))
+                return respuesta
+            except Exception as e:
+                espera = self._espera_reintento(e, intento)
+                if espera is None:
+                    raise
+                log.warning("Gemini falló (%s), reintento %d en %.1f s", e, intento + 1, espera)
+            finally:
+                if liberar:
+                    self._liberar(tokens, respuesta)
+            time.sleep(espera)
+
+    async def ejecutar_async(self, usuario, funcion, tokens=0):
+        """Como ejecutar(), para una función que devuelve una corrutina."""
+        for intento in range(self.reintentos + 1):
+            await self._esperar_turno_async(usuario, tokens)
+            respuesta = None
+            try:
+                respuesta = await funcion()
+                return respuesta
+            except Exception as e:
+                espera = self._espera_reintento(e, intento)
+                if espera is None:
+                    raise
+                log.warning("Gemini falló (%s), reintento %d en %.1f s", e, intento + 1, espera)
+            finally:
+                self._liberar(tokens, respuesta)
+            await asyncio.sleep(espera)
+
+    def stats(self):
+        with self._cond:
+            ahora = time.monotonic()
+            for cubeta in (self._rpm, self._tpm):
+                cubeta.espera(0, ahora)  # rellena según el tiempo transcurrido
+            return {
+                "en_cola": self._en_cola,
+                "usuarios_en_cola": len(self._colas),
+                "en_vuelo": self._en_vuelo,
+                "max_en_vuelo": self.max_en_vuelo,
+                "rpm_disponibles": round(self._rpm.fichas, 1) if self._rpm.capacidad > 0 else None,
+                "tpm_disponibles": round(self._tpm.fichas) if self._tpm.capacidad > 0 else None,
+            }
+
+
+planificador = PlanificadorGemini()
+
+
+@metrics.registrar_colector
+def _metricas_planificador():
+    stats = planificador.stats()
+    gauges = [
+        ("medagend_gemini_en_cola", "Llamadas a Gemini esperando turno", stats["en_cola"], {}),
+        ("medagend_gemini_usuarios_en_cola", "Usuarios con llamadas esperando turno", stats["usuarios_en_cola"], {}),
+        ("medagend_gemini_en_vuelo", "Llamadas a Gemini en curso", stats["en_vuelo"], {}),
+    ]
+    for limite in ("rpm", "tpm"):
+        if stats[f"{limite}_disponibles"] is not None:
+            gauges.append((
+                "medagend_gemini_cupo_disponible", "Fichas disponibles en cada cubeta de cuota",
+                stats[f"{limite}_disponibles"], {"limite": limite}
+            ))
+    return gauges
@@ -0,0 +1,228 @@
+import os
+import re
+import threading
+import time
+from services import medico_service, cita_service, horario_service
+from services.normalizacion import normalizar_texto
+
+# Se puede apagar con CHAT_INTENT_ROUTER=0 (todo va directo a Gemini)
+ACTIVO = os.environ.get("CHAT_INTENT_ROUTER", "1") != "0"
+
+# Mensajes más largos que esto se consideran abiertos y van a la IA
+MAX_PALABRAS = 12
+# Médicos que se listan en una respuesta (el resto se ofrece filtrar)
+MAX_MEDICOS = int(os.environ.get("CHAT_MAX_MEDICOS", "10"))
+
+# Raíz de la especialidad (sin acentos) -> nombre para mostrar.
+# Se filtra por la raíz para que "cardiologo", "cardióloga" y "Cardiología" coincidan.
+ESPECIALIDADES = {
+    "cardiolog": "Cardiología",
+    "dermatolog": "Dermatología",
+    "pediatr": "Pediatría",
+    "neurolog": "Neurología",
+    "ginecolog": "Ginecología",
+    "oftalmolog": "Oftalmología",
+    "traumatolog": "Traumatología",
+    "ortoped": "Ortopedia",
+    "psiquiatr": "Psiquiatría",
+    "psicolog": "Psicología",
+    "endocrinolog": "Endocrinología",
+    "gastroenterolog": "Gastroenterología",
+    "urolog": "Urología",
+    "otorrino": "Otorrinolaringología",
+    "oncolog": "Oncología",
+    "neumolog": "Neumología",
+    "nefrolog": "Nefrología",
+    "reumatolog": "Reumatología",
+    "nutriolog": "Nutriología",
+    "medicina general": "Medicina General",
+    "medico general": "Medicina General",
+}
+
+# Cuando el texto mencionado no sirve como filtro
+_FILTRO = {"medico general": "medicina general"}
+
+# Si el mensaje pide hacer algo (agendar, cancelar...), lo resuelve la IA
+_RE_ACCION = re.compile(
+    r"\b(agend\w*|reserv\w*|programar\w*|sacar\w*|cancel\w*|cambiar\w*|mover\w*|reagend\w*"
+    r"|quiero una cita|necesito una cita)\b"
+)
+
+# Relatos o preguntas con contexto ("el doctor me dijo que...") también van a la IA
+_RE_RELATO = re.compile(
+    r"\b(me|dijo|dijeron|receto|recetaron|duele|dolor|puedo|pero|porque|olvide|explica\w*)\b"
+    r"|\bque (es|son|hace|hacen|estudia)\b|\bpara que\b"
+)
+
+_RE_MIS_CITAS = re.compile(
+    r"\b(mis citas|mi cita|mis consultas|mi proxima cita|mis proximas citas|tengo (alguna |una )?citas?)\b"
+    r"|^(ver |revisar |mostrar |consultar )?(las )?citas( programadas| agendadas| pendientes)?$"
+)
+
+_DOC = r"(doctor|doctora|medico|medica|especialista|pediatra|psiquiatra|otorrino|ortopedista|\w+olog[oa])"
+_RE_MEDICOS = re.compile(
+    rf"\b(un|una|algun|alguna)\s+{_DOC}\b"      # "busco un cardiólogo", "hay algún pediatra"
+    rf"|\b{_DOC}(s|es)\b"                       # "qué doctores hay", "lista de médicos"
+)
+
+_RE_PALABRA_OLOGO = re.compile(r"\b(\w+olog)(o|a|os|as|ia|ias)\b")
+
+
+def _especialidad_en(texto):
+    """Devuelve (raiz_filtro, nombre) de la especialidad mencionada, o (None, None)."""
+    for raiz, nombre in ESPECIALIDADES.items():
+        if raiz in texto:
+            return _FILTRO.get(raiz, raiz), nombre
+    m = _RE_PALABRA_OLOGO.search(texto)
+    if m:
+        raiz = m.group(1)
+        return raiz, raiz.capitalize() + "ía"
+    return None, None
+
+
+def _formato_fecha(valor):
+    return str(valor)[:16].replace('T', ' ')
+
+
+class IntentRouter:
+    """
+    Atajo determinista delante de Gemini para las preguntas más comunes
+    ("qué doctores hay", "busco un cardiólogo", "mis citas"): llama al
+    servicio directamente y responde con una plantilla, sin usar la IA.
+    Lleva contadores de aciertos y de la latencia de IA ahorrada.
+    """
+
+    def __init__(self, activo=ACTIVO):
+        self.activo = activo
+        self._lock = threading.Lock()
+        self.mensajes = 0
+        self.aciertos = {}
+        self.tiempo_local = 0.0
+        self.llamadas_llm = 0
+        self.tiempo_llm = 0.0
+
+    def clasificar(self, mensaje):
+        """Devuelve (intencion, especialidad) o (None, None) si el mensaje es abierto."""
+        texto = re.sub(r"[^\w\s]", " ", normalizar_texto(mensaje))
+        texto = re.sub(r"\s+", " ", texto).strip()
+        if not texto or len(texto.split()) > MAX_PALABRAS:
+            return None, None
+        if _RE_ACCION.search(texto) or _RE_RELATO.search(texto):
+            return None, None
+
+        if _RE_MIS_CITAS.search(texto):
+            return "mis_citas", None
+        if _RE_MEDICOS.search(texto):
+            return "medicos", _especialidad_en(texto)
+        return None, None
+
+    def responder(self, mensaje, user):
+        """
+        Responde el mensaje localmente si es una intención conocida.
+        Devuelve el texto de la respuesta, o None para que lo maneje la IA.
+        """
+        if not self.activo:
+            return None
+        inicio = time.perf_counter()
+        intencion, especialidad = self.clasificar(mensaje)
+
+        respuesta = None
+        if intencion == "mis_citas":
+            respuesta = self._responder_mis_citas(user)
+        elif intencion == "medicos":
+            respuesta = self._responder_medicos(*especialidad)
+
+        with self._lock:
+            self.mensajes += 1
+            if respuesta is not None:
+                self.aciertos[intencion] = self.aciertos.get(intencion, 0) + 1
+                self.tiempo_local += time.perf_counter() - inicio
+        return respuesta
+
+    def _responder_medicos(self, raiz, nombre):
+        # Solo los primeros MAX_MEDICOS: la respuesta queda en el historial del chat
+        if raiz:
+            medicos = medico_service.get_medicos(especialidad_filter=raiz, limite=MAX_MEDICOS + 1)
+            hay_mas = len(medicos) > MAX_MEDICOS
+            medicos = medicos[:MAX_MEDICOS]
+        else:
+            medicos = medico_service.listar_medicos(limite=MAX_MEDICOS).get('medicos', [])
+            total = medico_service.contar_medicos()
+            hay_mas = total > len(medicos)
+        if not medicos:
+            if nombre:
+                return (f"Por ahora no tenemos médicos de {nombre} registrados. "
+                        "¿Quieres que te muestre a todos los médicos disponibles?")
+            return "Por ahora no hay médicos registrados."
+
+        if nombre:
+            if hay_mas:
+                encabezado = f"Estos son los primeros {len(medicos)} médicos de {nombre}:"
+            else:
+                encabezado = f"Encontré {len(medicos)} médico(s) de {nombre}:"
+        elif hay_mas:
+            encabezado = f"Tenemos {total} médicos; estos son los primeros {len(medicos)}:"
+        else:
+            encabezado = f"Estos son nuestros {len(medicos)} médico(s):"
+        lineas = [encabezado]
+        for medico in medicos:
+            try:
+                horario = horario_service.get_horario_medico(medico['id'], medico['horario_trabajo'])
+            except ValueError:
+                horario = None
+            turnos = "; ".join(f"{dia} {', '.join(t)}" for dia, t in horario.items()) if horario else ""
+            linea = f"- {medico['nombre_completo']} ({medico['especialidad']}), {medico['ubicacion'] or 'sin ubicación'}"
+            if turnos:
+                linea += f". Horario: {turnos}"
+            lineas.append(linea)
+        if hay_mas:
+            filtros = "un nombre o una ubicación" if nombre else "una especialidad, un nombre o una ubicación"
+            lineas.append(f"Dime {filtros} y te muestro solo esos médicos, o te busco un horario libre.")
+        else:
+            lineas.append("¿Quieres que te busque un horario libre o que te agende una cita?")
+        return "\n".join(lineas)
+
+    def _responder_mis_citas(self, user):
+        programadas = cita_service.get_proximas_citas(user['paciente_id'])
+        if not programadas:
+            if cita_service.get_historial_citas(user['paciente_id'], limite=1)['citas']:
+                return ("No tienes citas programadas (tus citas anteriores están en tu historial). "
+                        "¿Quieres que te ayude a agendar una?")
+            return "No tienes citas registradas. ¿Quieres que te ayude a agendar una?"
+
+        if len(programadas) >= cita_service.PROXIMAS_CITAS_LIMITE:
+            lineas = [f"Estas son tus próximas {len(programadas)} citas programadas:"]
+        else:
+            lineas = [f"Tienes {len(programadas)} cita(s) programada(s):"]
+        for cita in programadas:
+            lineas.append(
+                f"- {_formato_fecha(cita['fecha_hora_inicio'])} con {cita['medico_nombre']} "
+                f"({cita['medico_especialidad']})"
+            )
+        return "\n".join(lineas)
+
+    def registrar_latencia_llm(self, segundos):
+        """La IA reporta cuánto tardó cada turno, para estimar el ahorro."""
+        with self._lock:
+            self.llamadas_llm += 1
+            self.tiempo_llm += segundos
+
+    def stats(self):
+        with self._lock:
+            total_aciertos = sum(self.aciertos.values())
+            llm_promedio = self.tiempo_llm / self.llamadas_llm if self.llamadas_llm else 0.0
+            local_promedio = self.tiempo_local / total_aciertos if total_aciertos else 0.0
+            return {
+                "activo": self.activo,
+                "mensajes": self.mensajes,
+                "aciertos": total_aciertos,
+                "aciertos_por_intencion": dict(self.aciertos),
+                "tasa_aciertos": round(total_aciertos / self.mensajes, 4) if self.mensajes else 0.0,
+                "latencia_local_promedio_ms": round(local_promedio * 1000, 3),
+                "latencia_llm_promedio_ms": round(llm_promedio * 1000, 3),
+                "latencia_ahorrada_estimada_s": round(total_aciertos * max(llm_promedio - local_promedio, 0.0), 3),
+            }
+
+
+# Router global del proceso
+router = IntentRouter()
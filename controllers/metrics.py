@@ -0,0 +1,322 @@
+import bisect
+import hmac
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from functools import lru_cache
+from flask import Response, g, request
+
+# --- Configuración ---
+ACTIVAS = os.environ.get("METRICS", "1") != "0"
+# /metrics solo responde a una sesión de admin o, si se define, a "Authorization: Bearer <token>"
+TOKEN = os.environ.get("METRICS_TOKEN")
+# Consultas SQL más lentas que esto se registran como aviso
+SQL_LENTA_MS = float(os.environ.get("SQL_LENTA_MS", "100"))
+
+LOG_NIVEL = os.environ.get("LOG_NIVEL", "INFO").upper()
+# Fracción de mensajes DEBUG/INFO que se escriben (1.0 = todos)
+LOG_MUESTREO = float(os.environ.get("LOG_MUESTREO", "1.0"))
+# Tope de líneas por segundo (todos los niveles); lo demás se descarta y se cuenta
+LOG_MAX_POR_SEGUNDO = float(os.environ.get("LOG_MAX_POR_SEGUNDO", "50"))
+
+# Cubetas de latencia en segundos (de 1 ms a 30 s)
+CUBETAS_SEGUNDOS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# nombre -> métrica, en orden de registro
+_registro = {}
+_registro_lock = threading.Lock()
+# Funciones que devuelven gauges calculados al momento de exportar
+_colectores = []
+
+
+def _escapar(valor):
+    return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _formato_etiquetas(nombres, valores, extra=None):
+    pares = [f'{n}="{_escapar(v)}"' for n, v in zip(nombres, valores)]
+    if extra:
+        pares.append(extra)
+    return "{" + ",".join(pares) + "}" if pares else ""
+
+
+def _formato_numero(valor):
+    if valor == float("inf"):
+        return "+Inf"
+    if isinstance(valor, float) and valor.is_integer():
+        return str(int(valor))
+    return repr(valor) if isinstance(valor, float) else str(valor)
+
+
+class Contador:
+    """Contador monótono con etiquetas (tipo 'counter' de Prometheus)."""
+
+    tipo = "counter"
+
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *valores, cantidad=1):
+        if not ACTIVAS:
+            return
+        with self._lock:
+            self._series[valores] = self._series.get(valores, 0) + cantidad
+
+    def lineas(self):
+        with self._lock:
+            series = sorted(self._series.items())
+        for valores, total in series:
+            yield f"{self.nombre}{_formato_etiquetas(self.etiquetas, valores)} {_formato_numero(total)}"
+
+
+class Histograma:
+    """
+    Histograma con cubetas fijas (tipo 'histogram' de Prometheus). Cada
+    observación cuesta una búsqueda binaria y un lock corto.
+    """
+
+    tipo = "histogram"
+
+    def __init__(self, nombre, ayuda, etiquetas=(), cubetas=CUBETAS_SEGUNDOS):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self.cubetas = tuple(cubetas)
+        self._series = {}  # valores -> [conteos por cubeta..., suma, total]
+        self._lock = threading.Lock()
+
+    def observar(self, valor, *valores):
+        if not ACTIVAS:
+            return
+        indice = bisect.bisect_left(self.cubetas, valor)
+        with self._lock:
+            serie = self._series.get(valores)
+            if serie is None:
+                serie = self._series[valores] = [0] * (len(self.cubetas) + 2)
+            if indice < len(self.cubetas):
+                serie[indice] += 1
+            serie[-2] += valor
+            serie[-1] += 1
+
+    def lineas(self):
+        with self._lock:
+            series = sorted((valores, list(serie)) for valores, serie in self._series.items())
+        for valores, serie in series:
+            acumulado = 0
+            for limite, conteo in zip(self.cubetas, serie):
+                acumulado += conteo
+                le = f'le="{_formato_numero(float(limite))}"'
+                yield f"{self.nombre}_bucket{_formato_etiquetas(self.etiquetas, valores, le)} {acumulado}"
+            infinito = _formato_etiquetas(self.etiquetas, valores, 'le="+Inf"')
+            yield f"{self.nombre}_bucket{infinito} {serie[-1]}"
+            etiquetas = _formato_etiquetas(self.etiquetas, valores)
+            yield f"{self.nombre}_sum{etiquetas} {round(serie[-2], 6)}"
+            yield f"{self.nombre}_count{etiquetas} {serie[-1]}"
+
+
+def _registrar(clase, nombre, ayuda, etiquetas, **kwargs):
+    with _registro_lock:
+        metrica = _registro.get(nombre)
+        if metrica is None:
+            metrica = _registro[nombre] = clase(nombre, ayuda, etiquetas, **kwargs)
+        return metrica
+
+
+def contador(nombre, ayuda, etiquetas=()):
+    """Devuelve el contador 'nombre' (lo crea la primera vez)."""
+    return _registrar(Contador, nombre, ayuda, etiquetas)
+
+
+def histograma(nombre, ayuda, etiquetas=(), cubetas=CUBETAS_SEGUNDOS):
+    """Devuelve el histograma 'nombre' (lo crea la primera vez)."""
+    return _registrar(Histograma, nombre, ayuda, etiquetas, cubetas=cubetas)
+
+
+def registrar_colector(funcion):
+    """
+    Registra una función que devuelve gauges al exportar:
+    una lista de (nombre, ayuda, valor, {etiqueta: valor}).
+    """
+    _colectores.append(funcion)
+    return funcion
+
+
+def exportar():
+    """Todas las métricas en el formato de texto de Prometheus."""
+    lineas = []
+    with _registro_lock:
+        metricas = list(_registro.values())
+    for metrica in metricas:
+        lineas.append(f"# HELP {metrica.nombre} {metrica.ayuda}")
+        lineas.append(f"# TYPE {metrica.nombre} {metrica.tipo}")
+        lineas.extend(metrica.lineas())
+
+    vistos = set()
+    for colector in _colectores:
+        try:
+            gauges = list(colector())
+        except Exception as e:
+            log.warning("Colector de métricas %s falló: %s", colector.__name__, e)
+            continue
+        for nombre, ayuda, valor, etiquetas in gauges:
+            if nombre not in vistos:
+                vistos.add(nombre)
+                lineas.append(f"# HELP {nombre} {ayuda}")
+                lineas.append(f"# TYPE {nombre} gauge")
+            lineas.append(
+                f"{nombre}{_formato_etiquetas(etiquetas.keys(), etiquetas.values())} {_formato_numero(valor)}"
+            )
+    return "\n".join(lineas) + "\n"
+
+
+# --- Logger muestreado ---
+
+LOGS_DESCARTADOS = contador(
+    "medagend_logs_descartados_total", "Líneas de log descartadas por muestreo o por el tope por segundo", ("nivel",)
+)
+
+
+class _FiltroMuestreo(logging.Filter):
+    """
+    Deja pasar una fracción de los DEBUG/INFO (LOG_MUESTREO) y, para
+    todos los niveles, como máximo LOG_MAX_POR_SEGUNDO líneas (cubeta de
+    tokens). Así el costo del log está acotado aunque la carga crezca.
+    """
+
+    def __init__(self, muestreo=LOG_MUESTREO, max_por_segundo=LOG_MAX_POR_SEGUNDO):
+        super().__init__()
+        self.muestreo = muestreo
+        self.max_por_segundo = max_por_segundo
+        self._fichas = max_por_segundo
+        self._ultimo = time.monotonic()
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING and self.muestreo < 1.0 and random.random() >= self.muestreo:
+            LOGS_DESCARTADOS.inc(record.levelname.lower())
+            return False
+        if self.max_por_segundo > 0:
+            with self._lock:
+                ahora = time.monotonic()
+                self._fichas = min(self.max_por_segundo, self._fichas + (ahora - self._ultimo) * self.max_por_segundo)
+                self._ultimo = ahora
+                if self._fichas < 1:
+                    LOGS_DESCARTADOS.inc(record.levelname.lower())
+                    return False
+                self._fichas -= 1
+        return True
+
+
+def _configurar_logging():
+    raiz = logging.getLogger("medagend")
+    if raiz.handlers:
+        return raiz
+    manejador = logging.StreamHandler(sys.stderr)
+    manejador.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    manejador.addFilter(_FiltroMuestreo())
+    raiz.addHandler(manejador)
+    raiz.setLevel(getattr(logging, LOG_NIVEL, logging.INFO))
+    raiz.propagate = False
+    return raiz
+
+
+def get_logger(nombre):
+    """
+    Logger con niveles y muestreo para el código de la app. Usar formato
+    perezoso (log.debug("x=%s", x)) para no armar el texto si se descarta.
+    """
+    _configurar_logging()
+    return logging.getLogger(f"medagend.{nombre.rsplit('.', 1)[-1]}")
+
+
+log = get_logger(__name__)
+
+
+# --- SQL ---
+
+SQL_SEGUNDOS = histograma(
+    "medagend_sql_consulta_segundos", "Duración de execute() por operación y tabla", ("operacion", "tabla")
+)
+SQL_LENTAS = contador(
+    "medagend_sql_consultas_lentas_total", "Consultas más lentas que SQL_LENTA_MS", ("operacion", "tabla")
+)
+
+_TABLA_SQL = re.compile(r"\b(?:FROM|INTO|UPDATE|JOIN|TABLE|ON)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?([A-Za-z_]\w*)", re.IGNORECASE)
+
+
+@lru_cache(maxsize=1024)
+def etiqueta_sql(sql):
+    """('SELECT', 'citas') para una consulta; se calcula una vez por texto SQL."""
+    palabras = sql.split(None, 1)
+    operacion = palabras[0].upper() if palabras else ""
+    tabla = _TABLA_SQL.search(sql)
+    return operacion, tabla.group(1).lower() if tabla else ""
+
+
+def observar_sql(sql, segundos):
+    etiquetas = etiqueta_sql(sql)
+    SQL_SEGUNDOS.observar(segundos, *etiquetas)
+    if segundos * 1000 >= SQL_LENTA_MS:
+        SQL_LENTAS.inc(*etiquetas)
+        log.warning("Consulta lenta (%.1f ms): %s", segundos * 1000, " ".join(sql.split())[:300])
+
+
+# --- HTTP ---
+
+HTTP_SEGUNDOS = histograma(
+    "medagend_http_solicitud_segundos", "Latencia de las solicitudes HTTP (hasta enviar los encabezados)",
+    ("endpoint", "metodo")
+)
+HTTP_SOLICITUDES = contador(
+    "medagend_http_solicitudes_total", "Solicitudes HTTP por endpoint, método y código", ("endpoint", "metodo", "estado")
+)
+
+
+def _antes_de_solicitud():
+    g._metrics_inicio = time.perf_counter()
+
+
+def _despues_de_solicitud(respuesta):
+    inicio = g.pop("_metrics_inicio", None)
+    if inicio is not None:
+        # Sin regla = 404: una sola etiqueta para no crear una serie por URL
+        endpoint = request.endpoint or "sin_ruta"
+        HTTP_SEGUNDOS.observar(time.perf_counter() - inicio, endpoint, request.method)
+        HTTP_SOLICITUDES.inc(endpoint, request.method, str(respuesta.status_code))
+    return respuesta
+
+
+def _metricas_permitidas():
+    autorizacion = request.headers.get("Authorization")
+    if TOKEN and autorizacion and hmac.compare_digest(autorizacion, f"Bearer {TOKEN}"):
+        return True
+    usuario = g.get("user")
+    return bool(usuario) and usuario["role"] == "admin"
+
+
+def metrics_view():
+    """
+    Exporta las métricas a Prometheus. Cerrado por defecto: sin token
+    válido ni sesión de admin responde 401 (si mandó credenciales) o 404.
+    """
+    if not _metricas_permitidas():
+        if request.headers.get("Authorization"):
+            return Response("No autorizado\n", status=401, mimetype="text/plain")
+        return Response("No encontrado\n", status=404, mimetype="text/plain")
+    return Response(exportar(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def init_app(app):
+    """Mide cada solicitud y expone GET /metrics."""
+    if ACTIVAS:
+        app.before_request(_antes_de_solicitud)
+        app.after_request(_despues_de_solicitud)
+    app.add_url_rule("/metrics", "metrics", metrics_view)
@@ -0,0 +1,72 @@
+import argparse
+import json
+import sys
+from dotenv import load_dotenv
+
+# Cargar variables de entorno (MEDAGEND_DB) antes de importar la base de datos
+load_dotenv()
+
+from controllers.database import init_db
+from services import importacion_service
+
+# Uso:
+#   python importar_datos.py medicos medicos.csv
+#   python importar_datos.py pacientes pacientes.jsonl --procesos 8 --errores errores.jsonl
+#   python importar_datos.py citas citas.csv --lote 5000
+#
+# Columnas esperadas:
+#   medicos:   nombre_completo, especialidad, horario_trabajo (JSON, opcional), ubicacion
+#   pacientes: username, password, nombre_completo, email, telefono
+#   citas:     paciente_id, medico_id, fecha_hora_inicio, duracion_minutos, estado, notas_paciente
+
+def main():
+    parser = argparse.ArgumentParser(description="Importa médicos, pacientes o citas desde CSV/JSONL.")
+    parser.add_argument("tipo", choices=importacion_service.TIPOS)
+    parser.add_argument("archivo", help="Archivo .csv (con encabezados) o .jsonl")
+    parser.add_argument("--lote", type=int, default=importacion_service.TAMANO_LOTE,
+                        help="Filas por transacción (default: %(default)s)")
+    parser.add_argument("--procesos", type=int, default=None,
+                        help="Procesos para hashear contraseñas (default: número de CPUs)")
+    parser.add_argument("--errores", default=None,
+                        help="Guardar las filas rechazadas en este archivo JSONL")
+    args = parser.parse_args()
+
+    init_db()
+
+    archivo_errores = open(args.errores, "w", encoding="utf-8") if args.errores else None
+
+    def al_error(linea, mensaje):
+        if archivo_errores:
+            archivo_errores.write(json.dumps({"linea": linea, "error": mensaje}, ensure_ascii=False) + "\n")
+        else:
+            print(f"  Línea {linea}: {mensaje}", file=sys.stderr)
+
+    print(f"Importando {args.tipo} desde {args.archivo}...")
+    try:
+        reporte = importacion_service.importar(
+            args.tipo, args.archivo,
+            tamano_lote=max(1, args.lote),
+            procesos=args.procesos,
+            al_error=al_error
+        )
+    finally:
+        if archivo_errores:
+            archivo_errores.close()
+
+    if "error" in reporte:
+        print(f"Error: {reporte['error']}", file=sys.stderr)
+        return 1
+
+    print("=" * 40)
+    print(f"Filas leídas:     {reporte['leidas']}")
+    print(f"Importadas:       {reporte['importadas']}")
+    print(f"Con error:        {reporte['errores']}")
+    print(f"Tiempo:           {reporte['segundos']} s")
+    print(f"Filas/segundo:    {reporte['filas_por_segundo']}")
+    if args.errores and reporte['errores']:
+        print(f"Detalle de errores en {args.errores}")
+    print("=" * 40)
+    return 0 if reporte['errores'] == 0 else 2
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,29 @@
+import sys
+from dotenv import load_dotenv
+
+# Cargar variables de entorno (MEDAGEND_DB) antes de importar la base de datos
+load_dotenv()
+
+from controllers.database import init_db
+from services import estadisticas_service
+
+# Uso:
+#   python reconstruir_estadisticas.py
+#
+# Recalcula la tabla estadisticas_citas (citas por médico y día) desde la
+# tabla citas. Los triggers la mantienen al día; esto solo hace falta para
+# repararla (ej. una base restaurada sin la tabla) o verificarla.
+
+def main():
+    init_db()
+    print("Reconstruyendo estadísticas de citas...")
+    resultado = estadisticas_service.reconstruir()
+    if "error" in resultado:
+        print(f"Error: {resultado['error']}", file=sys.stderr)
+        return 1
+    print(f"Listo: {resultado['filas']} filas (día, médico) en {resultado['segundos']} s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -53,6 +53,8 @@ def register():
 
 @auth_bp.route('/logout')
 def logout():
+    if session.get('user_id') is not None:
+        auth_service.invalidar_usuario(session['user_id'])
     session.clear()
     flash("Has cerrado sesión exitosamente.", "success")
     return redirect(url_for('auth.login'))
\ No newline at end of file
@@ -1,9 +1,22 @@
-from flask import Blueprint, request, jsonify, render_template, session, g, redirect, url_for
-from controllers.ai_controller import AiController
+from flask import Blueprint, request, jsonify, render_template, session, g, redirect, url_for, Response, stream_with_context
+from controllers.chat_sessions import registro as chat_sessions
+from services import chat_service
+from controllers.database import liberar_conexion
+from controllers import metrics
 from functools import wraps
+import json
 
 chat_bp = Blueprint('chat', __name__)
 
+log = metrics.get_logger(__name__)
+
+# Cuántos mensajes se cargan por página (y cuántos se le devuelven a la IA al restaurar)
+MENSAJES_POR_PAGINA = 30
+MENSAJES_PARA_RESTAURAR = 100
+
+ERROR_SIN_MENSAJE = "No se recibió ningún mensaje."
+ERROR_CONEXION = "Lo siento, tuve un error de conexión con el asistente. (Verifica la API Key de Gemini)"
+
 def patient_required(f):
     """
     Un decorador para asegurar que solo los pacientes
@@ -17,6 +30,45 @@ def patient_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def conversacion_actual():
+    """
+    Devuelve el id de la conversación del usuario. La cookie de sesión solo
+    guarda este id; los mensajes viven en la base de datos.
+    """
+    # Las sesiones viejas guardaban todo el historial en la cookie
+    session.pop('chat_history', None)
+
+    user_id = g.user['id']
+    conversacion_id = session.get('conversacion_id')
+    if conversacion_id and chat_service.es_conversacion_de(conversacion_id, user_id):
+        return conversacion_id
+
+    conversacion_id = chat_service.get_conversacion_reciente(user_id) or chat_service.crear_conversacion(user_id)
+    session['conversacion_id'] = conversacion_id
+    return conversacion_id
+
+def mensaje_recibido():
+    """El texto del mensaje en el JSON de la solicitud (None si no viene)."""
+    data = request.json
+    return data.get('message')
+
+def cargador_historial(conversacion_id, user_id):
+    """
+    Función que devuelve el historial guardado de la conversación. Solo se
+    llama si hay que reconstruir la sesión de IA.
+    """
+    def cargar_historial():
+        mensajes, _ = chat_service.get_mensajes(conversacion_id, user_id, limite=MENSAJES_PARA_RESTAURAR)
+        return mensajes
+    return cargar_historial
+
+def guardar_turno(conversacion_id, user_id, user_message, ai_response):
+    """Guarda el turno completo en el servidor (no en la cookie). No lanza errores."""
+    try:
+        chat_service.agregar_mensajes(conversacion_id, user_id, [("user", user_message), ("ai", ai_response)])
+    except Exception:
+        log.exception("Error al guardar el historial de chat")
+
 @chat_bp.route('/')
 @patient_required
 def chat_view():
@@ -24,12 +76,24 @@ def chat_view():
     Muestra la página principal del chat.
     La ruta final será /chat/ gracias al prefijo en app.py
     """
-    # Inicializar el historial en la sesión
-    if 'chat_history' not in session:
-        session['chat_history'] = []
+    conversacion_id = conversacion_actual()
     
-    # Pasamos el historial guardado en la sesión a la plantilla
-    return render_template('chat.html', chat_history=session['chat_history'])
+    # Solo la última página; los mensajes anteriores se cargan bajo demanda
+    mensajes, hay_mas = chat_service.get_mensajes(conversacion_id, g.user['id'], limite=MENSAJES_POR_PAGINA)
+    return render_template('chat.html', chat_history=mensajes, hay_mas=hay_mas)
+
+@chat_bp.route('/api/chat/historial')
+@patient_required
+def api_chat_historial():
+    """
+    Devuelve mensajes anteriores al id 'antes_de' (paginación hacia atrás).
+    """
+    conversacion_id = conversacion_actual()
+    antes_de = request.args.get('antes_de', type=int)
+    mensajes, hay_mas = chat_service.get_mensajes(
+        conversacion_id, g.user['id'], antes_de=antes_de, limite=MENSAJES_POR_PAGINA
+    )
+    return jsonify({"mensajes": mensajes, "hay_mas": hay_mas})
 
 @chat_bp.route('/api/chat', methods=['POST'])
 @patient_required
@@ -38,52 +102,103 @@ def api_chat_message():
     API endpoint para manejar un mensaje de chat.
     Devuelve JSON.
     """
-    data = request.json
-    user_message = data.get('message')
+    user_message = mensaje_recibido()
     
     if not user_message:
-        return jsonify({"error": "No se recibió ningún mensaje."}), 400
+        return jsonify({"error": ERROR_SIN_MENSAJE}), 400
     
-    # --- ESTA ES LA CORRECCIÓN ---
-    # Asegurarse de que el historial exista si el usuario lo limpió
-    if 'chat_history' not in session:
-        session['chat_history'] = []
-    # --- FIN DE LA CORRECCIÓN ---
-    
-    # Añadir mensaje de usuario al historial de sesión
-    session['chat_history'].append({"role": "user", "content": user_message})
+    conversacion_id = conversacion_actual()
+    user_id = g.user['id']
+    cargar_historial = cargador_historial(conversacion_id, user_id)
+    # El turno puede esperar la sesión y a Gemini: devolver la conexión al pool mientras
+    liberar_conexion()
     
     try:
-        # Crear el controlador de IA (ahora necesita al usuario)
+        # Reutilizar el controlador de IA del usuario (modelo y chat ya creados).
         # g.user es el usuario cargado en app.py, que incluye 'paciente_id', etc.
-        ai_controller = AiController(user=g.user) 
-        
-        # Obtener respuesta de la IA (manejando el historial internamente)
-        ai_response = ai_controller.handle_message(user_message)
+        with chat_sessions.sesion(g.user, cargar_historial) as ai_controller:
+            # Obtener respuesta de la IA (el chat conserva el contexto entre turnos)
+            ai_response = ai_controller.handle_message(user_message)
         
-        # Añadir respuesta de IA al historial de sesión
-        session['chat_history'].append({"role": "ai", "content": ai_response})
-        session.modified = True # Marcar la sesión como modificada
+        # Guardar el turno completo en el servidor (no en la cookie)
+        chat_service.agregar_mensajes(conversacion_id, user_id, [("user", user_message), ("ai", ai_response)])
         
         # Devolver solo la respuesta de la IA
         return jsonify({"response": ai_response})
         
-    except Exception as e:
+    except Exception:
         # Manejo de errores (ej. API Key de Gemini inválida)
-        print(f"Error en api_chat_message: {e}")
-        error_message = "Lo siento, tuve un error de conexión con el asistente. (Verifica la API Key de Gemini)"
+        log.exception("Error en api_chat_message")
+        error_message = ERROR_CONEXION
         
         # AÑADIDO: También guardar este error en el historial
-        if 'chat_history' in session:
-            session['chat_history'].append({"role": "ai", "content": error_message})
-            session.modified = True
+        guardar_turno(conversacion_id, user_id, user_message, error_message)
             
         return jsonify({"response": error_message}), 500
 
 
+def evento_sse(evento):
+    """Formatea un evento para Server-Sent Events."""
+    return f"event: {evento['tipo']}\ndata: {json.dumps(evento, ensure_ascii=False)}\n\n"
+
+@chat_bp.route('/api/chat/stream', methods=['POST'])
+@patient_required
+def api_chat_stream():
+    """
+    Igual que api_chat_message, pero responde con Server-Sent Events:
+    avisa cuando la IA usa una herramienta y envía el texto según se genera.
+    """
+    user_message = mensaje_recibido()
+    
+    if not user_message:
+        return jsonify({"error": ERROR_SIN_MENSAJE}), 400
+    
+    # Resolver la conversación antes de empezar a enviar (puede tocar la cookie)
+    conversacion_id = conversacion_actual()
+    user = g.user
+    user_id = user['id']
+    cargar_historial = cargador_historial(conversacion_id, user_id)
+    # El stream vive lo que tarde Gemini: no retener la conexión de la solicitud
+    liberar_conexion()
+
+    def generar():
+        respuesta = None
+        fallo = False
+        try:
+            with chat_sessions.sesion(user, cargar_historial) as ai_controller:
+                for evento in ai_controller.handle_message_stream(user_message):
+                    if evento['tipo'] in ('fin', 'error'):
+                        respuesta = evento['texto']
+                        fallo = evento['tipo'] == 'error'
+                    yield evento_sse(evento)
+        except GeneratorExit:
+            # El cliente se desconectó a mitad del turno: el chat de Gemini
+            # pudo quedar a medias, así que se reconstruye en el próximo mensaje
+            chat_sessions.descartar(user_id)
+            raise
+        except Exception:
+            log.exception("Error en api_chat_stream")
+            respuesta = ERROR_CONEXION
+            fallo = True
+            yield evento_sse({"tipo": "error", "texto": respuesta})
+
+        if fallo:
+            # Un stream cortado puede dejar el chat de Gemini a medias: empezar de nuevo
+            chat_sessions.descartar(user_id)
+        guardar_turno(conversacion_id, user_id, user_message, respuesta)
+
+    return Response(
+        stream_with_context(generar()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
 @chat_bp.route('/api/chat/clear', methods=['POST'])
 @patient_required
 def api_chat_clear():
-    """Limpia el historial de chat de la sesión."""
+    """Empieza una conversación nueva (los mensajes anteriores se conservan en la BD)."""
     session.pop('chat_history', None)
-    return jsonify({"success": True, "message": "Historial limpiado."})
\ No newline at end of file
+    session['conversacion_id'] = chat_service.crear_conversacion(g.user['id'])
+    chat_sessions.descartar(g.user['id'])
+    return jsonify({"success": True, "message": "Historial limpiado."})
@@ -1,6 +1,22 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, g
-from services import paciente_service, medico_service, cita_service # <-- AÑADIDO cita_service
+from flask import (
+    Blueprint, render_template, request, redirect, url_for, flash, g, jsonify, make_response, Response,
+    stream_with_context, session
+)
+from markupsafe import Markup
+from services import (
+    auth_service, paciente_service, medico_service, cita_service, horario_service, estadisticas_service,
+    exportacion_service
+)
+from services.normalizacion import normalizar_texto
+from controllers.database import get_pool_stats, get_contadores
+from controllers.chat_sessions import registro as chat_sessions
+from controllers.intent_router import router as intent_router
+from controllers.gemini_scheduler import planificador as planificador_gemini
+from controllers import cache
+from controllers.cache import TTLCache
+from datetime import datetime, timezone
 from functools import wraps
+import hashlib
 import json
 
 # --- ¡NUEVO! Importamos el decorador de paciente ---
@@ -8,6 +24,18 @@ from routes.chat_routes import patient_required
 
 views_bp = Blueprint('views', __name__)
 
+@views_bp.app_template_filter('horario')
+def horario_filter(medico):
+    """
+    Devuelve el horario compilado (y cacheado) de un médico para las plantillas.
+    Uso: {% for dia, turnos in medico | horario %}
+    """
+    try:
+        horario = horario_service.get_horario_medico(medico['id'], medico['horario_trabajo'])
+    except ValueError:
+        horario = None
+    return horario.items() if horario else []
+
 # --- Decorador de Admin ---
 def admin_required(f):
     """
@@ -36,13 +64,7 @@ def admin_dashboard():
             
             # Ejemplo simple de horario por defecto si está vacío
             if not horario_json:
-                horario_json = json.dumps({
-                    "lunes": ["09:00-13:00", "14:00-17:00"],
-                    "martes": ["09:00-13:00", "14:00-17:00"],
-                    "miercoles": ["09:00-13:00", "14:00-17:00"],
-                    "jueves": ["09:00-13:00", "14:00-17:00"],
-                    "viernes": ["09:00-13:00", "14:00-17:00"]
-                })
+                horario_json = medico_service.HORARIO_POR_DEFECTO
             
             # --- ¡FUNCIÓN ACTUALIZADA! ---
             resultado = medico_service.crear_medico(nombre, especialidad, horario_json, ubicacion)
@@ -54,34 +76,227 @@ def admin_dashboard():
             
             return redirect(url_for('views.admin_dashboard'))
 
-    # Para el método GET
-    pacientes = paciente_service.get_pacientes()
-    medicos = medico_service.get_medicos()
+    # Para el método GET: solo la primera página; el resto se carga con la API
+    pacientes = paciente_service.listar_pacientes()
+    medicos = medico_service.listar_medicos()
+    estadisticas = estadisticas_service.get_estadisticas()
     
-    return render_template('admin_dashboard.html', pacientes=pacientes, medicos=medicos)
+    return render_template(
+        'admin_dashboard.html',
+        pacientes=pacientes['pacientes'],
+        pacientes_siguiente=pacientes['siguiente'],
+        total_pacientes=paciente_service.contar_pacientes(),
+        medicos=medicos['medicos'],
+        medicos_siguiente=medicos['siguiente'],
+        total_medicos=medico_service.contar_medicos(),
+        citas_hoy=estadisticas_service.citas_del_dia(),
+        estadisticas=estadisticas
+    )
+
+def _pagina_json(resultado):
+    if 'error' in resultado:
+        return jsonify(resultado), 400
+    return jsonify(resultado)
+
+def _descarga(resultado):
+    """
+    Respuesta en streaming de una exportación (ver exportacion_service): el
+    archivo se envía lote por lote mientras se lee de la base de datos.
+    """
+    if 'error' in resultado:
+        return jsonify(resultado), 400
+    return Response(
+        stream_with_context(resultado['contenido']),
+        mimetype=resultado['mimetype'],
+        headers={
+            'Content-Disposition': f'attachment; filename="{resultado["nombre_archivo"]}"',
+            'Cache-Control': 'private, no-store',
+        }
+    )
+
+@views_bp.route('/admin/api/pacientes')
+@admin_required
+def admin_api_pacientes():
+    """
+    Página de pacientes para el dashboard.
+    Parámetros: cursor (de la respuesta anterior), q (filtro), limite.
+    """
+    return _pagina_json(paciente_service.listar_pacientes(
+        cursor_token=request.args.get('cursor'),
+        limite=request.args.get('limite', 50),
+        busqueda=request.args.get('q', '').strip() or None
+    ))
+
+@views_bp.route('/admin/api/medicos')
+@admin_required
+def admin_api_medicos():
+    """
+    Página de médicos para el dashboard.
+    Parámetros: cursor (de la respuesta anterior), q (filtro), limite.
+    """
+    return _pagina_json(medico_service.listar_medicos(
+        cursor_token=request.args.get('cursor'),
+        limite=request.args.get('limite', 50),
+        busqueda=request.args.get('q', '').strip() or None
+    ))
+
+@views_bp.route('/admin/api/estadisticas')
+@admin_required
+def admin_api_estadisticas():
+    """
+    Citas por día, tasas de cancelación e inasistencia y ocupación de
+    los médicos (de la tabla estadisticas_citas, no de citas).
+    Parámetros: desde, hasta (AAAA-MM-DD), limite (médicos).
+    """
+    return _pagina_json(estadisticas_service.get_estadisticas(
+        desde=request.args.get('desde') or None,
+        hasta=request.args.get('hasta') or None,
+        limite_medicos=request.args.get('limite', estadisticas_service.MEDICOS_LIMITE)
+    ))
+
+@views_bp.route('/admin/exportar/citas.<formato>')
+@admin_required
+def admin_exportar_citas(formato):
+    """
+    Descarga las citas de la clínica en CSV o iCalendar (.ics).
+    Parámetros: desde, hasta (AAAA-MM-DD), medico_id.
+    """
+    return _descarga(exportacion_service.exportar_citas(
+        formato,
+        medico_id=request.args.get('medico_id') or None,
+        desde=request.args.get('desde') or None,
+        hasta=request.args.get('hasta') or None
+    ))
+
+@views_bp.route('/admin/exportar/pacientes.csv')
+@admin_required
+def admin_exportar_pacientes():
+    """Descarga el padrón de pacientes en CSV."""
+    return _descarga(exportacion_service.exportar_pacientes())
+
+@views_bp.route('/admin/api/db-stats')
+@admin_required
+def admin_db_stats():
+    """
+    Contadores del pool de conexiones (para ver contención bajo carga).
+    """
+    return jsonify(get_pool_stats())
+
+@views_bp.route('/admin/api/user-cache-stats')
+@admin_required
+def admin_user_cache_stats():
+    """
+    Contadores de la caché de g.user (consultas a la base de datos ahorradas).
+    """
+    return jsonify(auth_service.get_user_cache_stats())
+
+@views_bp.route('/admin/api/chat-stats')
+@admin_required
+def admin_chat_stats():
+    """
+    Contadores del chat: registro de sesiones (hits, desalojos, memoria)
+    y atajo de intenciones (tasa de aciertos, latencia ahorrada),
+    cola del planificador de Gemini y cupo disponible.
+    """
+    return jsonify({
+        "sesiones": chat_sessions.stats(),
+        "intenciones": intent_router.stats(),
+        "gemini": planificador_gemini.stats(),
+        "caches": cache.stats_todas(),
+    })
 
 # --- ¡TODA ESTA ES LA NUEVA SECCIÓN PARA EL PORTAL DE PACIENTE! ---
 
+# Directorio renderizado, por (versión de la tabla medicos, búsqueda). La versión la
+# incrementan los triggers de 'contadores', así que una entrada vieja nunca se sirve.
+_cache_directorio = TTLCache("directorio_medicos", max_entradas=256, ttl=3600, max_caracteres=20_000_000)
+
+def _directorio_html(version, busqueda):
+    """
+    HTML del directorio de médicos (tarjetas y modales de horario). Es igual
+    para todos los pacientes: solo se consulta y renderiza al cambiar la
+    tabla medicos o con una búsqueda nueva.
+    """
+    clave = (version, " ".join(normalizar_texto(busqueda).split()))
+    encontrado, html = _cache_directorio.get(clave)
+    if encontrado:
+        return html
+
+    if busqueda:
+        medicos = medico_service.buscar_medicos(busqueda, limite=50)
+    else:
+        medicos = medico_service.get_medicos()
+    html = Markup(render_template('_directorio_medicos.html', medicos=medicos, busqueda=busqueda))
+    _cache_directorio.set(clave, html, etiquetas=("medicos",), tamano=len(html))
+    return html
+
+def _ultima_modificacion(*marcas):
+    """La más reciente de las fechas 'AAAA-MM-DD HH:MM:SS' (UTC) de los contadores."""
+    return max(datetime.strptime(marca, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc) for marca in marcas)
+
 @views_bp.route('/portal')
 @patient_required
 def portal_paciente():
     """
     Muestra el nuevo Portal de Paciente.
+    Responde 304 si el navegador ya tiene esta misma versión de la página.
     """
-    # Obtenemos los datos para mostrar en el portal
-    
-    # 1. Médicos (para la tarjeta de "Consultar Médicos")
-    medicos = medico_service.get_medicos()
-    
-    # 2. Citas (para la tarjeta de "Mis Próximas Citas")
+    busqueda = request.args.get('q', '').strip()
+    contadores = get_contadores("medicos", "citas")
+    version_medicos, medicos_modificado = contadores["medicos"]
+    _, citas_modificado = contadores["citas"]
+
+    # 1. Citas (para la tarjeta de "Mis Próximas Citas"); el historial se pide aparte
     # g.user es el paciente logueado (incluye 'paciente_id')
-    citas_paciente = cita_service.get_citas_paciente(g.user['paciente_id'])
-    
-    # (Opcional) Convertir los horarios JSON de los médicos en algo legible
-    # Esto es avanzado, pero lo haremos en la plantilla con un truco.
-    
-    return render_template(
-        'portal_paciente.html', 
-        medicos=medicos, 
-        citas=citas_paciente
-    )
\ No newline at end of file
+    citas_paciente = cita_service.get_proximas_citas(g.user['paciente_id'])
+
+    # 2. Validadores: la página depende del paciente, de sus próximas citas (que
+    # cambian también con el tiempo, al terminar una) y de la versión del directorio
+    huella = json.dumps([
+        g.user['id'], g.user['nombre_completo'], version_medicos, busqueda,
+        [(cita['id'], str(cita['fecha_hora_inicio'])) for cita in citas_paciente],
+    ], ensure_ascii=False)
+    etag = hashlib.sha1(huella.encode('utf-8')).hexdigest()
+    ultima_modificacion = _ultima_modificacion(medicos_modificado, citas_modificado)
+
+    respuesta = make_response()
+    respuesta.set_etag(etag)
+    respuesta.last_modified = ultima_modificacion
+    # Privada (depende de la sesión) y siempre revalidada con el servidor
+    respuesta.headers['Cache-Control'] = 'private, no-cache'
+    respuesta.vary.add('Cookie')
+    # Con mensajes flash pendientes (ej. "Bienvenido" tras un login) hay que renderizar:
+    # la copia del navegador no los tiene y se mostrarían en la siguiente página
+    if not session.get('_flashes') and respuesta.make_conditional(request).status_code == 304:
+        return respuesta
+
+    # 3. Médicos (para la tarjeta de "Consultar Médicos"), filtrados si hay búsqueda
+    respuesta.set_data(render_template(
+        'portal_paciente.html',
+        directorio=_directorio_html(version_medicos, busqueda),
+        citas=citas_paciente,
+        busqueda=busqueda
+    ))
+    return respuesta
+
+@views_bp.route('/portal/api/historial')
+@patient_required
+def portal_api_historial():
+    """
+    Historial de citas del paciente, de la más reciente a la más antigua.
+    Parámetros: cursor (de la respuesta anterior), limite.
+    """
+    return _pagina_json(cita_service.get_historial_citas(
+        g.user['paciente_id'],
+        cursor_token=request.args.get('cursor'),
+        limite=request.args.get('limite', 20)
+    ))
+
+@views_bp.route('/portal/exportar/citas.<formato>')
+@patient_required
+def portal_exportar_citas(formato):
+    """
+    Descarga todas las citas del paciente en CSV o iCalendar (.ics), para
+    importarlas en su calendario.
+    """
+    return _descarga(exportacion_service.exportar_citas(formato, paciente_id=g.user['paciente_id']))
@@ -1,7 +1,24 @@
+import os
 import sqlite3
+import threading
 from controllers.database import get_db_connection
+from controllers.cache import TTLCache
 from werkzeug.security import generate_password_hash, check_password_hash
 
+# Perfil de sesión (g.user) por user_id, en la memoria de cada worker. La app
+# no tiene rutas que editen un usuario o paciente existente; un cambio hecho
+# fuera de ella (rol, nombre, email) se ve en cada worker cuando vence la
+# entrada, a lo más USER_CACHE_TTL segundos después. Se acepta ese desfase;
+# una ruta que edite perfiles debe llamar a invalidar_usuario(), que solo
+# limpia la caché del worker donde corre.
+_cache_usuarios = TTLCache(
+    "usuarios_sesion",
+    max_entradas=int(os.environ.get("USER_CACHE_MAX", "4096")),
+    ttl=int(os.environ.get("USER_CACHE_TTL", "60"))
+)
+_estaticas_omitidas = 0
+_lock_contadores = threading.Lock()
+
 def validar_usuario(username, password):
     """
     Valida las credenciales de un usuario.
@@ -22,7 +39,43 @@ def get_user_data_for_session(user_id):
     """
     Obtiene los datos combinados de 'usuarios' y 'pacientes'
     para ser usados en la sesión (g.user).
+    Usa la caché de perfiles; solo va a la base de datos en un miss.
+    """
+    encontrado, user_data = _cache_usuarios.get(user_id)
+    if not encontrado:
+        user_data = _consultar_usuario(user_id)
+        if user_data is None:
+            return None
+        _cache_usuarios.set(user_id, user_data)
+    # Copia: g.user puede modificarse durante la solicitud
+    return dict(user_data)
+
+def invalidar_usuario(user_id=None):
     """
+    Descarta el perfil cacheado de un usuario (o de todos si user_id es None).
+    """
+    if user_id is None:
+        _cache_usuarios.limpiar()
+    else:
+        _cache_usuarios.invalidar_clave(user_id)
+
+def registrar_solicitud_estatica():
+    """Cuenta una solicitud que no necesitó cargar g.user (archivos estáticos)."""
+    global _estaticas_omitidas
+    with _lock_contadores:
+        _estaticas_omitidas += 1
+
+def get_user_cache_stats():
+    """
+    Contadores de la caché de g.user. 'consultas_evitadas' son las
+    idas a la base de datos que se ahorraron (hits + estáticos omitidos).
+    """
+    stats = _cache_usuarios.stats()
+    stats["estaticas_omitidas"] = _estaticas_omitidas
+    stats["consultas_evitadas"] = stats["hits"] + _estaticas_omitidas
+    return stats
+
+def _consultar_usuario(user_id):
     conn = get_db_connection()
     cursor = conn.cursor()
     
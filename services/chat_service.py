@@ -0,0 +1,81 @@
+from controllers.database import get_db_connection
+
+def crear_conversacion(usuario_id):
+    """
+    Abre una conversación nueva para el usuario y devuelve su id.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("INSERT INTO conversaciones (usuario_id) VALUES (?)", (usuario_id,))
+    conn.commit()
+    conversacion_id = cursor.lastrowid
+    conn.close()
+    return conversacion_id
+
+def get_conversacion_reciente(usuario_id):
+    """
+    Devuelve el id de la conversación más reciente del usuario, o None.
+    """
+    conn = get_db_connection()
+    fila = conn.execute("""
+        SELECT id FROM conversaciones
+        WHERE usuario_id = ?
+        ORDER BY creada_en DESC, id DESC
+        LIMIT 1
+    """, (usuario_id,)).fetchone()
+    conn.close()
+    return fila['id'] if fila else None
+
+def es_conversacion_de(conversacion_id, usuario_id):
+    conn = get_db_connection()
+    fila = conn.execute(
+        "SELECT 1 FROM conversaciones WHERE id = ? AND usuario_id = ?",
+        (conversacion_id, usuario_id)
+    ).fetchone()
+    conn.close()
+    return fila is not None
+
+def agregar_mensajes(conversacion_id, usuario_id, mensajes):
+    """
+    Guarda uno o más mensajes [(role, content), ...] en una sola transacción.
+    """
+    conn = get_db_connection()
+    try:
+        conn.executemany(
+            "INSERT INTO mensajes_chat (conversacion_id, usuario_id, role, content) VALUES (?, ?, ?, ?)",
+            [(conversacion_id, usuario_id, role, content) for role, content in mensajes]
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def get_mensajes(conversacion_id, usuario_id, antes_de=None, limite=30):
+    """
+    Devuelve una página de mensajes de la conversación, del más viejo al
+    más nuevo, y si quedan mensajes anteriores: (mensajes, hay_mas).
+    'antes_de' es el id del mensaje más viejo ya cargado (paginación por cursor).
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    query = """
+        SELECT id, role, content, creado_en FROM mensajes_chat
+        WHERE conversacion_id = ? AND usuario_id = ?
+    """
+    params = [conversacion_id, usuario_id]
+    if antes_de is not None:
+        query += " AND id < ?"
+        params.append(antes_de)
+    query += " ORDER BY id DESC LIMIT ?"
+    params.append(limite + 1)
+
+    cursor.execute(query, params)
+    filas = cursor.fetchall()
+    conn.close()
+
+    hay_mas = len(filas) > limite
+    mensajes = [dict(row) for row in filas[:limite]]
+    mensajes.reverse()
+    return mensajes, hay_mas
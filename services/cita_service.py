@@ -1,12 +1,97 @@
 import sqlite3
+import heapq
+import random
+import time
+from itertools import islice, repeat
 from controllers.database import get_db_connection
+from controllers import cache, metrics
 from datetime import datetime, timedelta
-import json
+from services import horario_service, medico_service, paginacion
+
+log = metrics.get_logger(__name__)
+
+# Duración máxima de una cita. Acota hacia atrás las búsquedas por rango:
+# una cita que empezó más de esto antes de un instante ya no lo puede cubrir.
+DURACION_MAXIMA_MINUTOS = 8 * 60
+
+# Cuántas próximas citas se muestran en el portal y se le dan a la IA
+PROXIMAS_CITAS_LIMITE = 10
+
+# Columnas de una cita con los datos del médico (sin paciente_id ni fecha_hora_fin)
+COLUMNAS_CITA = """
+    c.id, c.medico_id, c.fecha_hora_inicio, c.duracion_minutos, c.estado, c.notas_paciente,
+    m.nombre_completo AS medico_nombre, m.especialidad AS medico_especialidad, m.ubicacion AS medico_ubicacion
+"""
+
+# Horizonte máximo para buscar horarios libres
+HORIZONTE_MAXIMO_DIAS = 180
+
+# Reintentos al tomar el lock de escritura (además del busy_timeout de la conexión)
+ESPERA_BASE_SEGUNDOS = 0.02
+ESPERA_TOPE_SEGUNDOS = 0.5
+ESPERA_MAXIMA_SEGUNDOS = 10
+
+# Códigos de resultado de agendar_nueva_cita para quien necesite distinguir errores
+CODIGO_HORARIO_OCUPADO = "horario_ocupado"
+CODIGO_REINTENTAR = "reintentar"
+
+def validar_horario_cita(medico_id, fecha_hora_inicio, duracion_minutos):
+    """
+    Reglas de una cita que no dependen de otras citas: duración válida y
+    que caiga dentro de un turno del médico (horario compilado y en caché).
+    Devuelve None si es válida o el mensaje de error.
+    """
+    if not 0 < duracion_minutos <= DURACION_MAXIMA_MINUTOS:
+        return f"La duración debe estar entre 1 y {DURACION_MAXIMA_MINUTOS} minutos."
+
+    try:
+        horario = horario_service.get_horario_medico(medico_id)
+    except ValueError as e:
+        return f"Error al validar horario del médico: {e}"
+
+    if horario is None:
+        return "El médico no existe."
+
+    dia_semana = fecha_hora_inicio.weekday()
+    if not horario.trabaja(dia_semana):
+        dia = horario_service.DIAS_SEMANA[dia_semana]
+        return f"El médico no trabaja los {dia if dia.endswith('s') else dia + 's'}."
+
+    # Comprobar si la cita cae dentro de algún turno de trabajo
+    if not horario.contiene(fecha_hora_inicio, fecha_hora_inicio + timedelta(minutes=duracion_minutos)):
+        return "La cita está fuera del horario de trabajo del médico."
+
+    return None
+
+def buscar_conflicto(cursor, medico_id, fecha_hora_inicio, fecha_hora_fin):
+    """
+    Devuelve el id de una cita 'programada' del médico que se traslapa con
+    [inicio, fin), o None.
+
+    Las citas 'programada' de un médico nunca se traslapan entre sí, así que
+    basta con revisar la última que empieza antes de que termine la nueva:
+    si esa termina después de nuestro inicio, hay conflicto. Es un solo
+    probe sobre idx_citas_medico_programada en lugar de recorrer la tabla.
+    """
+    cursor.execute("""
+        SELECT id FROM (
+            SELECT id, fecha_hora_fin FROM citas
+            WHERE medico_id = ?
+            AND estado = 'programada'
+            AND fecha_hora_inicio < ?
+            ORDER BY fecha_hora_inicio DESC
+            LIMIT 1
+        )
+        WHERE fecha_hora_fin > ?
+    """, (medico_id, fecha_hora_fin, fecha_hora_inicio))
+    conflicto = cursor.fetchone()
+    return conflicto['id'] if conflicto else None
 
 def agendar_nueva_cita(paciente_id, medico_id, fecha_hora_inicio_str, duracion_minutos=30, notas=""):
     """
     Agenda una nueva cita con validación de conflictos.
     Esta es la lógica "sin fallas".
+    Si el horario ya está tomado, el error trae "codigo": "horario_ocupado".
     """
     
     # 1. Validar formato de fecha
@@ -19,69 +104,70 @@ def agendar_nueva_cita(paciente_id, medico_id, fecha_hora_inicio_str, duracion_m
     if fecha_hora_inicio < datetime.now():
         return {"error": "No se puede agendar una cita en el pasado."}
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # 2. Validar horario de trabajo del médico
-    cursor.execute("SELECT horario_trabajo FROM medicos WHERE id = ?", (medico_id,))
-    medico = cursor.fetchone()
-    if not medico:
-        conn.close()
-        return {"error": "El médico no existe."}
+    # 2. Validar duración y horario de trabajo del médico
+    error = validar_horario_cita(medico_id, fecha_hora_inicio, duracion_minutos)
+    if error:
+        return {"error": error}
 
+    # 3. Chequeo de traslapes + INSERT atómicos (ver _reservar)
+    conn = get_db_connection()
     try:
-        horario = json.loads(medico['horario_trabajo'])
-        dia_semana = fecha_hora_inicio.strftime('%A').lower() # ej. 'lunes'
-        
-        if dia_semana not in horario:
-            conn.close()
-            return {"error": f"El médico no trabaja los {dia_semana}."}
-
-        # Comprobar si la cita cae dentro de algún turno de trabajo
-        esta_en_turno = False
-        for turno in horario[dia_semana]:
-            inicio_turno_str, fin_turno_str = turno.split('-')
-            inicio_turno = fecha_hora_inicio.replace(hour=int(inicio_turno_str.split(':')[0]), minute=int(inicio_turno_str.split(':')[1]))
-            fin_turno = fecha_hora_inicio.replace(hour=int(fin_turno_str.split(':')[0]), minute=int(fin_turno_str.split(':')[1]))
-            
-            if fecha_hora_inicio >= inicio_turno and fecha_hora_fin <= fin_turno:
-                esta_en_turno = True
-                break
-        
-        if not esta_en_turno:
-            conn.close()
-            return {"error": "La cita está fuera del horario de trabajo del médico."}
-            
-    except Exception as e:
+        resultado = _reservar(conn, paciente_id, medico_id, fecha_hora_inicio, fecha_hora_fin, duracion_minutos, notas)
+    finally:
         conn.close()
-        return {"error": f"Error al validar horario del médico: {e}"}
 
-    # 3. Validar conflictos con OTRAS citas (Overlap check)
-    cursor.execute("""
-        SELECT * FROM citas
-        WHERE medico_id = ? 
-        AND estado = 'programada'
-        AND (
-            (fecha_hora_inicio < ? AND datetime(fecha_hora_inicio, '+' || duracion_minutos || ' minutes') > ?) OR
-            (fecha_hora_inicio >= ? AND fecha_hora_inicio < ?)
-        )
-    """, (medico_id, fecha_hora_fin, fecha_hora_inicio, fecha_hora_inicio, fecha_hora_fin))
-    
-    conflicto = cursor.fetchone()
-    if conflicto:
-        conn.close()
-        return {"error": f"El médico ya tiene una cita en ese horario (ID Cita: {conflicto['id']})."}
+    if resultado.get('success'):
+        # Cambian los horarios libres y las citas del paciente
+        cache.invalidar("agenda", f"citas:{int(paciente_id)}")
+    return resultado
+
+def _es_bloqueo(e):
+    mensaje = str(e)
+    return "locked" in mensaje or "busy" in mensaje
+
+def _reservar(conn, paciente_id, medico_id, fecha_hora_inicio, fecha_hora_fin, duracion_minutos, notas):
+    """
+    Chequeo de traslapes e INSERT en una transacción BEGIN IMMEDIATE: el
+    lock de escritura se toma ANTES de leer, así que dos reservas que se
+    traslapan no pueden pasar ambas el chequeo. Si la base está ocupada se
+    reintenta con espera exponencial con jitter, hasta ESPERA_MAXIMA_SEGUNDOS.
+    """
+    cursor = conn.cursor()
+    limite = time.monotonic() + ESPERA_MAXIMA_SEGUNDOS
+    intento = 0
+    while True:
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            break
+        except sqlite3.OperationalError as e:
+            intento += 1
+            espera = random.uniform(0, min(ESPERA_BASE_SEGUNDOS * 2 ** intento, ESPERA_TOPE_SEGUNDOS))
+            if not _es_bloqueo(e) or time.monotonic() + espera > limite:
+                log.warning("No se pudo tomar el lock de escritura tras %s intentos: %s", intento, e)
+                return {
+                    "error": "El sistema está ocupado en este momento. Por favor, intenta de nuevo.",
+                    "codigo": CODIGO_REINTENTAR
+                }
+            time.sleep(espera)
 
-    # 4. ¡Todo bien! Insertar la cita
     try:
+        conflicto_id = buscar_conflicto(cursor, medico_id, fecha_hora_inicio, fecha_hora_fin)
+        if conflicto_id is not None:
+            conn.rollback()
+            return {
+                "error": f"El médico ya tiene una cita en ese horario (ID Cita: {conflicto_id}).",
+                "codigo": CODIGO_HORARIO_OCUPADO,
+                "conflicto_id": conflicto_id
+            }
+
+        # 4. ¡Todo bien! Insertar la cita
         cursor.execute("""
-            INSERT INTO citas (paciente_id, medico_id, fecha_hora_inicio, duracion_minutos, notas_paciente)
-            VALUES (?, ?, ?, ?, ?)
-        """, (paciente_id, medico_id, fecha_hora_inicio, duracion_minutos, notas))
+            INSERT INTO citas (paciente_id, medico_id, fecha_hora_inicio, duracion_minutos, fecha_hora_fin, notas_paciente)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (paciente_id, medico_id, fecha_hora_inicio, duracion_minutos, fecha_hora_fin, notas))
         
         nueva_cita_id = cursor.lastrowid
         conn.commit()
-        conn.close()
         return {
             "success": True, 
             "id_cita": nueva_cita_id, 
@@ -89,14 +175,18 @@ def agendar_nueva_cita(paciente_id, medico_id, fecha_hora_inicio_str, duracion_m
         }
     except sqlite3.IntegrityError as e:
         conn.rollback()
-        conn.close()
+        if 'UNIQUE constraint failed: citas' in str(e):
+            return {"error": "El médico ya tiene una cita a esa hora.", "codigo": CODIGO_HORARIO_OCUPADO}
         return {"error": f"Error de integridad: {e}"}
     except Exception as e:
         conn.rollback()
-        conn.close()
         return {"error": f"Error inesperado al guardar: {e}"}
 
 def get_citas_paciente(paciente_id):
+    """
+    Todo el historial del paciente. Crece con los años: para el portal y
+    la IA usar get_proximas_citas y get_historial_citas (paginado).
+    """
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute("""
@@ -108,4 +198,226 @@ def get_citas_paciente(paciente_id):
     """, (paciente_id,))
     citas = cursor.fetchall()
     conn.close()
-    return [dict(row) for row in citas]
\ No newline at end of file
+    return [dict(row) for row in citas]
+
+def get_proximas_citas(paciente_id, limite=PROXIMAS_CITAS_LIMITE, ahora=None):
+    """
+    Citas 'programada' del paciente que aún no terminan, de la más cercana
+    a la más lejana. Filtro, orden y límite van en SQL sobre
+    idx_citas_paciente_estado (paciente_id, estado, fecha_hora_inicio): el
+    costo no depende de cuántas citas pasadas tenga el paciente.
+    """
+    ahora = ahora or datetime.now()
+    conn = get_db_connection()
+    try:
+        # Una cita en curso empezó hace a lo más DURACION_MAXIMA_MINUTOS
+        cursor = conn.execute(f"""
+            SELECT {COLUMNAS_CITA}
+            FROM citas c
+            JOIN medicos m ON c.medico_id = m.id
+            WHERE c.paciente_id = ?
+            AND c.estado = 'programada'
+            AND c.fecha_hora_inicio >= ?
+            AND c.fecha_hora_fin > ?
+            ORDER BY c.fecha_hora_inicio
+            LIMIT ?
+        """, (paciente_id, ahora - timedelta(minutes=DURACION_MAXIMA_MINUTOS), ahora, int(limite)))
+        return [dict(row) for row in cursor.fetchall()]
+    finally:
+        conn.close()
+
+def get_historial_citas(paciente_id, cursor_token=None, limite=paginacion.LIMITE_POR_DEFECTO):
+    """
+    Todas las citas del paciente (cualquier estado), de la más reciente a la
+    más antigua, paginadas por keyset sobre (fecha_hora_inicio, id) con
+    idx_citas_paciente_inicio. 'cursor_token' viene de la página anterior.
+    Devuelve {"citas": [...], "siguiente": token o None} o {"error": ...}.
+    """
+    limite = paginacion.normalizar_limite(limite)
+    condiciones = ["c.paciente_id = ?"]
+    params = [paciente_id]
+    if cursor_token:
+        try:
+            fecha, cita_id = paginacion.decodificar_cursor(cursor_token)
+        except ValueError as e:
+            return {"error": str(e)}
+        condiciones.append("(c.fecha_hora_inicio, c.id) < (?, ?)")
+        params.extend([fecha, cita_id])
+    params.append(limite + 1)
+
+    conn = get_db_connection()
+    try:
+        cursor = conn.execute(f"""
+            SELECT {COLUMNAS_CITA}
+            FROM citas c
+            JOIN medicos m ON c.medico_id = m.id
+            WHERE {" AND ".join(condiciones)}
+            ORDER BY c.fecha_hora_inicio DESC, c.id DESC
+            LIMIT ?
+        """, params)
+        citas = [dict(row) for row in cursor.fetchall()]
+    finally:
+        conn.close()
+
+    siguiente = None
+    if len(citas) > limite:
+        citas = citas[:limite]
+        siguiente = paginacion.codificar_cursor(str(citas[-1]['fecha_hora_inicio']), citas[-1]['id'])
+    return {"citas": citas, "siguiente": siguiente}
+
+
+# --- Búsqueda de horarios libres ---
+# Los instantes se manejan como minutos absolutos (ordinal del día * 1440 + minuto)
+# para que el barrido sea aritmética entera, sin objetos datetime por slot.
+
+def _a_minutos(dt, redondear_arriba=False):
+    minutos = dt.toordinal() * 1440 + dt.hour * 60 + dt.minute
+    if redondear_arriba and (dt.second or dt.microsecond):
+        minutos += 1
+    return minutos
+
+def _de_minutos(minutos):
+    return datetime.fromordinal(minutos // 1440) + timedelta(minutes=minutos % 1440)
+
+def _slots_libres_medico(horario, ocupadas, desde, hasta, limite_fin, duracion):
+    """
+    Generador de inicios libres (en minutos absolutos) para un médico, en orden.
+    Produce los slots que empiezan en [desde, hasta) y terminan antes de
+    'limite_fin'. Resta las citas ocupadas (lista ordenada de (inicio, fin))
+    a los turnos de trabajo en un solo barrido; los slots se alinean al
+    inicio del turno.
+    """
+    p = 0
+    n = len(ocupadas)
+    for dia in range(desde // 1440, (hasta - 1) // 1440 + 1):
+        base = dia * 1440
+        for inicio_turno, fin_turno in horario.dias[(dia + 6) % 7]:   # igual que date.weekday()
+            t0 = base + inicio_turno
+            t_fin = min(base + fin_turno, limite_fin)
+            t = t0
+            if t < desde:
+                t = t0 + -(-(desde - t0) // duracion) * duracion
+            while t < hasta and t + duracion <= t_fin:
+                # Descartar citas que ya terminaron antes de este slot
+                while p < n and ocupadas[p][1] <= t:
+                    p += 1
+                if p < n and ocupadas[p][0] < t + duracion:
+                    # Saltar al primer slot de la rejilla después de la cita
+                    t = t0 + -(-(ocupadas[p][1] - t0) // duracion) * duracion
+                    continue
+                yield t
+                t += duracion
+
+def _citas_ocupadas(cursor, medico_ids, desde, hasta):
+    """
+    Citas programadas que tocan [desde, hasta) agrupadas por médico y ordenadas.
+    Usa idx_citas_medico_programada con un rango acotado por ambos lados.
+    """
+    ocupadas = {medico_id: [] for medico_id in medico_ids}
+    inicio_min = _de_minutos(desde - DURACION_MAXIMA_MINUTOS)
+    fin = _de_minutos(hasta)
+    ids = list(medico_ids)
+    for i in range(0, len(ids), 500):
+        lote = ids[i:i + 500]
+        marcadores = ",".join("?" * len(lote))
+        cursor.execute(f"""
+            SELECT medico_id, fecha_hora_inicio, fecha_hora_fin FROM citas
+            WHERE estado = 'programada'
+            AND medico_id IN ({marcadores})
+            AND fecha_hora_inicio >= ? AND fecha_hora_inicio < ?
+            ORDER BY medico_id, fecha_hora_inicio
+        """, (*lote, inicio_min, fin))
+        for medico_id, inicio_str, fin_str in cursor.fetchall():
+            fin_cita = _a_minutos(datetime.fromisoformat(fin_str), redondear_arriba=True)
+            if fin_cita > desde:
+                ocupadas[medico_id].append((_a_minutos(datetime.fromisoformat(inicio_str)), fin_cita))
+    return ocupadas
+
+def buscar_horarios_libres(medico_id=None, especialidad=None, desde=None, hasta=None, duracion_minutos=30, limite=10):
+    """
+    Devuelve los primeros 'limite' horarios libres, ordenados por fecha,
+    de un médico, de una especialidad o de todos los médicos.
+
+    Fusiona el horario de trabajo compilado de cada médico con sus citas
+    programadas (resta de intervalos) y mezcla a todos los médicos con un
+    heap. La ventana de búsqueda empieza en 1 día y se duplica hasta llenar
+    el límite o llegar a 'hasta', así que los primeros resultados no
+    dependen del tamaño del horizonte.
+    """
+    # 1. Validar parámetros
+    try:
+        ahora = datetime.now()
+        desde_dt = datetime.fromisoformat(desde) if desde else ahora
+        desde_dt = max(desde_dt, ahora)
+        hasta_dt = datetime.fromisoformat(hasta) if hasta else desde_dt + timedelta(days=90)
+    except (TypeError, ValueError):
+        return {"error": "Formato de fecha inválido. Use AAAA-MM-DD o AAAA-MM-DDTHH:MM"}
+    try:
+        duracion = int(duracion_minutos)
+        limite = max(1, min(int(limite), 100))
+    except (TypeError, ValueError):
+        return {"error": "La duración y el límite deben ser números enteros."}
+
+    hasta_dt = min(hasta_dt, desde_dt + timedelta(days=HORIZONTE_MAXIMO_DIAS))
+    if hasta_dt <= desde_dt:
+        return {"error": "El rango de búsqueda está vacío."}
+    if not 0 < duracion <= DURACION_MAXIMA_MINUTOS:
+        return {"error": f"La duración debe estar entre 1 y {DURACION_MAXIMA_MINUTOS} minutos."}
+
+    # 2. Médicos candidatos y sus horarios compilados
+    if medico_id is not None:
+        conn = get_db_connection()
+        fila = conn.execute("SELECT * FROM medicos WHERE id = ?", (medico_id,)).fetchone()
+        conn.close()
+        medicos = [dict(fila)] if fila else []
+    else:
+        medicos = medico_service.get_medicos(especialidad_filter=especialidad)
+
+    horarios = {}
+    for medico in medicos:
+        try:
+            horario = horario_service.get_horario_medico(medico['id'], medico['horario_trabajo'])
+        except ValueError:
+            continue   # Un horario corrupto no debe romper la búsqueda de los demás
+        if horario and any(horario.dias):
+            horarios[medico['id']] = horario
+
+    if not horarios:
+        return {"error": "No se encontraron médicos con horario para esa búsqueda."}
+    datos_medico = {m['id']: m for m in medicos}
+
+    # 3. Barrido por ventanas crecientes
+    desde_min = _a_minutos(desde_dt, redondear_arriba=True)
+    hasta_min = _a_minutos(hasta_dt)
+    resultados = []
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        inicio_ventana = desde_min
+        ancho = 1440
+        while inicio_ventana < hasta_min and len(resultados) < limite:
+            fin_ventana = min(inicio_ventana + ancho, hasta_min)
+            ocupadas = _citas_ocupadas(cursor, horarios.keys(), inicio_ventana, fin_ventana + duracion)
+            generadores = [
+                zip(_slots_libres_medico(horario, ocupadas[mid], inicio_ventana, fin_ventana, hasta_min, duracion), repeat(mid))
+                for mid, horario in horarios.items()
+            ]
+            faltan = limite - len(resultados)
+            resultados.extend(islice(heapq.merge(*generadores), faltan))
+            inicio_ventana = fin_ventana
+            ancho *= 2
+    finally:
+        conn.close()
+
+    horarios_libres = []
+    for t, mid in resultados:
+        medico = datos_medico[mid]
+        horarios_libres.append({
+            "medico_id": mid,
+            "medico_nombre": medico['nombre_completo'],
+            "especialidad": medico['especialidad'],
+            "ubicacion": medico.get('ubicacion'),
+            "inicio": _de_minutos(t).strftime('%Y-%m-%dT%H:%M'),
+            "fin": _de_minutos(t + duracion).strftime('%Y-%m-%dT%H:%M'),
+        })
+    return {"horarios": horarios_libres}
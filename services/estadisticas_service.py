@@ -0,0 +1,163 @@
+import time
+from datetime import date, timedelta
+from controllers.database import get_db_connection, reconstruir_estadisticas_citas
+from controllers import metrics
+from services import horario_service
+
+log = metrics.get_logger(__name__)
+
+# Rango por defecto del dashboard: los últimos 30 días (incluido hoy)
+DIAS_POR_DEFECTO = 30
+# Rango máximo que se acepta en la API
+DIAS_MAXIMOS = 366
+MEDICOS_LIMITE = 20
+
+
+def _rango(desde, hasta, hoy):
+    """Valida 'AAAA-MM-DD' (o date) y devuelve (desde, hasta) como date."""
+    hasta = date.fromisoformat(hasta) if isinstance(hasta, str) else (hasta or hoy)
+    desde = date.fromisoformat(desde) if isinstance(desde, str) else (desde or hasta - timedelta(days=DIAS_POR_DEFECTO - 1))
+    if desde > hasta:
+        raise ValueError("'desde' debe ser anterior o igual a 'hasta'.")
+    if (hasta - desde).days + 1 > DIAS_MAXIMOS:
+        raise ValueError(f"El rango no puede pasar de {DIAS_MAXIMOS} días.")
+    return desde, hasta
+
+
+def _ocurrencias_dias_semana(desde, hasta):
+    """Cuántas veces cae cada día de la semana (0 = lunes) en [desde, hasta]."""
+    total = (hasta - desde).days + 1
+    semanas, resto = divmod(total, 7)
+    return [semanas + (1 if (dia - desde.weekday()) % 7 < resto else 0) for dia in range(7)]
+
+
+def capacidad_minutos(horario, ocurrencias):
+    """Minutos de trabajo de un horario compilado en un rango (ver _ocurrencias_dias_semana)."""
+    return sum(
+        veces * sum(fin - inicio for inicio, fin in horario.turnos(dia))
+        for dia, veces in enumerate(ocurrencias)
+    )
+
+
+def _tasa(parte, total):
+    return round(parte / total, 4) if total else None
+
+
+def get_estadisticas(desde=None, hasta=None, limite_medicos=MEDICOS_LIMITE, hoy=None):
+    """
+    Resumen de citas para el dashboard, leído de estadisticas_citas (una
+    fila por día y médico): el costo depende de los días y médicos del
+    rango, no del número de citas.
+      - resumen: totales, tasa de cancelación y de inasistencia
+      - por_dia: citas de cada día del rango
+      - medicos: ocupación contra horario_trabajo, de mayor a menor
+    Una cita 'programada' de un día ya pasado cuenta como inasistencia
+    (nunca se marcó como completada).
+    """
+    hoy = hoy or date.today()
+    try:
+        desde, hasta = _rango(desde, hasta, hoy)
+        limite_medicos = max(1, min(int(limite_medicos), 500))
+    except (TypeError, ValueError) as e:
+        return {"error": f"Parámetros inválidos: {e}"}
+
+    rango = (desde.isoformat(), hasta.isoformat())
+    conn = get_db_connection()
+    try:
+        por_dia = [dict(fila) for fila in conn.execute("""
+            SELECT dia, SUM(programadas) AS programadas, SUM(completadas) AS completadas,
+                   SUM(canceladas) AS canceladas, SUM(minutos_ocupados) AS minutos_ocupados
+            FROM estadisticas_citas
+            WHERE dia BETWEEN ? AND ?
+            GROUP BY dia
+            ORDER BY dia
+        """, rango)]
+        filas_medicos = conn.execute("""
+            SELECT e.medico_id, m.nombre_completo, m.especialidad, m.horario_trabajo,
+                   SUM(e.programadas) AS programadas, SUM(e.completadas) AS completadas,
+                   SUM(e.canceladas) AS canceladas, SUM(e.minutos_ocupados) AS minutos_ocupados,
+                   SUM(CASE WHEN e.dia < ? THEN e.programadas ELSE 0 END) AS inasistencias
+            FROM estadisticas_citas e
+            JOIN medicos m ON m.id = e.medico_id
+            WHERE e.dia BETWEEN ? AND ?
+            GROUP BY e.medico_id
+        """, (hoy.isoformat(),) + rango).fetchall()
+    finally:
+        conn.close()
+
+    ocurrencias = _ocurrencias_dias_semana(desde, hasta)
+    medicos = []
+    totales = {"programadas": 0, "completadas": 0, "canceladas": 0, "inasistencias": 0, "minutos_ocupados": 0}
+    for fila in filas_medicos:
+        for campo in totales:
+            totales[campo] += fila[campo]
+        try:
+            horario = horario_service.get_horario_medico(fila['medico_id'], fila['horario_trabajo'])
+        except ValueError:
+            horario = None
+        capacidad = capacidad_minutos(horario, ocurrencias) if horario else 0
+        medicos.append({
+            "medico_id": fila['medico_id'],
+            "nombre_completo": fila['nombre_completo'],
+            "especialidad": fila['especialidad'],
+            "citas": fila['programadas'] + fila['completadas'],
+            "canceladas": fila['canceladas'],
+            "inasistencias": fila['inasistencias'],
+            "minutos_ocupados": fila['minutos_ocupados'],
+            "minutos_disponibles": capacidad,
+            "ocupacion": _tasa(fila['minutos_ocupados'], capacidad),
+        })
+    medicos.sort(key=lambda m: (m['ocupacion'] or 0, m['citas']), reverse=True)
+
+    total = totales['programadas'] + totales['completadas'] + totales['canceladas']
+    resumen = dict(totales)
+    resumen.update({
+        "total": total,
+        "tasa_cancelacion": _tasa(totales['canceladas'], total),
+        # Sobre las citas que ya debieron ocurrir: completadas + no atendidas
+        "tasa_inasistencia": _tasa(totales['inasistencias'], totales['inasistencias'] + totales['completadas']),
+    })
+    return {
+        "desde": rango[0],
+        "hasta": rango[1],
+        "resumen": resumen,
+        "por_dia": por_dia,
+        "medicos": medicos[:limite_medicos],
+        "total_medicos": len(medicos),
+    }
+
+
+def citas_del_dia(dia=None):
+    """Citas no canceladas de un día (programadas + completadas), para el dashboard."""
+    conn = get_db_connection()
+    try:
+        fila = conn.execute(
+            "SELECT SUM(programadas + completadas) FROM estadisticas_citas WHERE dia = ?",
+            ((dia or date.today()).isoformat(),)
+        ).fetchone()
+        return fila[0] or 0
+    finally:
+        conn.close()
+
+
+def reconstruir():
+    """
+    Recalcula estadisticas_citas desde la tabla citas en una sola
+    transacción (las reservas esperan a que termine). Para llenar la tabla
+    en bases importadas antes de los triggers o corregirla a mano.
+    """
+    conn = get_db_connection()
+    inicio = time.perf_counter()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        filas = reconstruir_estadisticas_citas(conn.cursor())
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        log.exception("No se pudieron reconstruir las estadísticas de citas")
+        return {"error": f"No se pudieron reconstruir las estadísticas: {e}"}
+    finally:
+        conn.close()
+    segundos = time.perf_counter() - inicio
+    log.info("Estadísticas de citas reconstruidas: %s filas en %.2f s", filas, segundos)
+    return {"success": True, "filas": filas, "segundos": round(segundos, 3)}
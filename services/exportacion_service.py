@@ -0,0 +1,245 @@
+import csv
+import io
+import os
+from operator import itemgetter
+from datetime import date, datetime, timedelta, timezone
+from controllers.database import get_db_connection
+from controllers import metrics
+
+log = metrics.get_logger(__name__)
+
+# Filas por fetchmany: la memoria de una exportación es la de un lote, no la de la tabla
+TAMANO_LOTE = int(os.environ.get("EXPORTACION_LOTE", "1000"))
+
+FORMATOS_CITAS = ("csv", "ics")
+
+EXPORTACION_FILAS = metrics.contador(
+    "medagend_exportacion_filas_total", "Filas escritas en exportaciones CSV/iCalendar", ("tipo", "formato")
+)
+
+# Citas con médico y paciente; las condiciones y el orden los agrega _consulta_citas
+_SELECT_CITAS = """
+    SELECT c.id, c.fecha_hora_inicio, c.fecha_hora_fin, c.duracion_minutos, c.estado, c.notas_paciente,
+           c.medico_id, m.nombre_completo AS medico_nombre, m.especialidad AS medico_especialidad,
+           m.ubicacion AS medico_ubicacion, c.paciente_id, p.nombre_completo AS paciente_nombre
+    FROM citas c
+    JOIN medicos m ON m.id = c.medico_id
+    JOIN pacientes p ON p.id = c.paciente_id
+"""
+
+COLUMNAS_CSV_CITAS = (
+    "id", "fecha_hora_inicio", "fecha_hora_fin", "duracion_minutos", "estado",
+    "medico_id", "medico_nombre", "medico_especialidad", "medico_ubicacion",
+    "paciente_id", "paciente_nombre", "notas_paciente",
+)
+# El paciente no necesita sus propios datos en cada fila
+COLUMNAS_CSV_CITAS_PACIENTE = tuple(c for c in COLUMNAS_CSV_CITAS if c not in ("paciente_id", "paciente_nombre"))
+
+COLUMNAS_CSV_PACIENTES = ("id", "nombre_completo", "email", "telefono", "username")
+
+_ESTADO_ICS = {"programada": "CONFIRMED", "completada": "CONFIRMED", "cancelada": "CANCELLED"}
+
+
+def _filas(sql, params=(), tamano_lote=None):
+    """
+    Recorre una consulta con fetchmany, un lote a la vez. La conexión se
+    abre al pedir la primera fila y se cierra al terminar o si el cliente
+    corta la descarga (GeneratorExit).
+    """
+    tamano_lote = max(1, tamano_lote or TAMANO_LOTE)
+    conn = get_db_connection()
+    try:
+        cursor = conn.execute(sql, params)
+        while True:
+            lote = cursor.fetchmany(tamano_lote)
+            if not lote:
+                break
+            yield lote
+    finally:
+        conn.close()
+
+
+def _csv(lotes, columnas, tipo):
+    """Encabezado y un trozo de CSV por lote (solo el lote vive en memoria)."""
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer, lineterminator="\r\n")
+    escritor.writerow(columnas)
+    yield buffer.getvalue()
+    valores = itemgetter(*columnas)
+    for lote in lotes:
+        buffer.seek(0)
+        buffer.truncate()
+        escritor.writerows(map(valores, lote))
+        EXPORTACION_FILAS.inc(tipo, "csv", cantidad=len(lote))
+        yield buffer.getvalue()
+
+
+# --- iCalendar (RFC 5545) ---
+
+def _texto_ics(valor):
+    texto = str(valor or "")
+    return (texto.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,")
+            .replace("\r\n", "\\n").replace("\n", "\\n"))
+
+
+def _linea_ics(linea):
+    """Pliega la línea a 75 octetos (las continuaciones empiezan con un espacio)."""
+    if len(linea) <= 75 and linea.isascii():
+        return linea + "\r\n"
+    datos = linea.encode("utf-8")
+    if len(datos) <= 75:
+        return linea + "\r\n"
+    partes = []
+    inicio, maximo = 0, 75
+    while inicio < len(datos):
+        fin = min(len(datos), inicio + maximo)
+        # No partir un carácter UTF-8 de varios bytes
+        while fin < len(datos) and (datos[fin] & 0xC0) == 0x80:
+            fin -= 1
+        partes.append(datos[inicio:fin].decode("utf-8"))
+        inicio, maximo = fin, 74
+    return "\r\n ".join(partes) + "\r\n"
+
+
+def _fecha_ics(valor):
+    # Hora local del consultorio, sin zona (hora "flotante"), como se guarda en citas
+    texto = str(valor)
+    if len(texto) == 19 and texto[10] in " T":
+        # 'AAAA-MM-DD HH:MM:SS' (el formato de la base): sin parsear
+        return f"{texto[:4]}{texto[5:7]}{texto[8:10]}T{texto[11:13]}{texto[14:16]}{texto[17:19]}"
+    return datetime.fromisoformat(texto).strftime("%Y%m%dT%H%M%S")
+
+
+def _datos_medico_ics(cita):
+    """
+    Título ('Cita con ...') escapado y línea LOCATION ya plegada: son iguales
+    en todas las citas de un médico.
+    """
+    titulo = _texto_ics(f"Cita con {cita['medico_nombre']} ({cita['medico_especialidad']})")
+    ubicacion = _linea_ics(f"LOCATION:{_texto_ics(cita['medico_ubicacion'])}") if cita["medico_ubicacion"] else ""
+    return titulo, _linea_ics(f"SUMMARY:{titulo}"), ubicacion
+
+
+def _evento_ics(cita, sello, medicos, con_paciente):
+    medico = medicos.get(cita["medico_id"])
+    if medico is None:
+        medico = medicos[cita["medico_id"]] = _datos_medico_ics(cita)
+    titulo, resumen, ubicacion = medico
+    if con_paciente:
+        resumen = _linea_ics(f"SUMMARY:{_texto_ics(cita['paciente_nombre'])}: {titulo}")
+    fin = cita["fecha_hora_fin"] or (
+        datetime.fromisoformat(str(cita["fecha_hora_inicio"])) + timedelta(minutes=cita["duracion_minutos"])
+    )
+    descripcion = _linea_ics(f"DESCRIPTION:{_texto_ics(cita['notas_paciente'])}") if cita["notas_paciente"] else ""
+    return (
+        f"BEGIN:VEVENT\r\n"
+        f"UID:cita-{cita['id']}@medagend\r\n"
+        f"DTSTAMP:{sello}\r\n"
+        f"DTSTART:{_fecha_ics(cita['fecha_hora_inicio'])}\r\n"
+        f"DTEND:{_fecha_ics(fin)}\r\n"
+        f"{resumen}"
+        f"STATUS:{_ESTADO_ICS.get(cita['estado'], 'TENTATIVE')}\r\n"
+        f"{ubicacion}{descripcion}"
+        f"END:VEVENT\r\n"
+    )
+
+
+def _ics(lotes, nombre_calendario, con_paciente):
+    sello = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    # medico_id -> datos de _datos_medico_ics: tantas entradas como médicos, no como citas
+    medicos = {}
+    yield "".join(_linea_ics(linea) for linea in (
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        "PRODID:-//MedAgend//Citas//ES",
+        "CALSCALE:GREGORIAN",
+        f"X-WR-CALNAME:{_texto_ics(nombre_calendario)}",
+    ))
+    for lote in lotes:
+        yield "".join(_evento_ics(cita, sello, medicos, con_paciente) for cita in lote)
+        EXPORTACION_FILAS.inc("citas", "ics", cantidad=len(lote))
+    yield _linea_ics("END:VCALENDAR")
+
+
+# --- Exportaciones ---
+
+def _consulta_citas(paciente_id=None, medico_id=None, desde=None, hasta=None):
+    """
+    SQL y parámetros de las citas a exportar, con un orden que sale de un
+    índice (sin ordenar en memoria):
+      - de un paciente: idx_citas_paciente_inicio
+      - de un médico: UNIQUE(medico_id, fecha_hora_inicio)
+      - todas: por id
+    """
+    condiciones, params = [], []
+    if paciente_id is not None:
+        condiciones.append("c.paciente_id = ?")
+        params.append(int(paciente_id))
+        orden = "c.paciente_id, c.fecha_hora_inicio"
+    elif medico_id is not None:
+        condiciones.append("c.medico_id = ?")
+        params.append(int(medico_id))
+        orden = "c.medico_id, c.fecha_hora_inicio"
+    else:
+        orden = "c.id"
+    if desde:
+        condiciones.append("c.fecha_hora_inicio >= ?")
+        params.append(date.fromisoformat(desde).isoformat() if isinstance(desde, str) else desde.isoformat())
+    if hasta:
+        # 'hasta' incluye el día completo
+        fin = (date.fromisoformat(hasta) if isinstance(hasta, str) else hasta) + timedelta(days=1)
+        condiciones.append("c.fecha_hora_inicio < ?")
+        params.append(fin.isoformat())
+    donde = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+    return f"{_SELECT_CITAS} {donde} ORDER BY {orden}", params
+
+
+def exportar_citas(formato, paciente_id=None, medico_id=None, desde=None, hasta=None, tamano_lote=None):
+    """
+    Exporta citas como CSV o iCalendar sin cargarlas en memoria.
+    Sin 'paciente_id' exporta las de toda la clínica (admin), opcionalmente
+    de un médico; 'desde' y 'hasta' (AAAA-MM-DD) acotan por fecha.
+    Devuelve {"success": True, "contenido": generador de str, "mimetype",
+    "nombre_archivo"} o {"error": ...}. La consulta corre al recorrer
+    'contenido', no al llamar a esta función.
+    """
+    if formato not in FORMATOS_CITAS:
+        return {"error": f"Formato no soportado: '{formato}'. Use {' o '.join(FORMATOS_CITAS)}."}
+    try:
+        sql, params = _consulta_citas(paciente_id, medico_id, desde, hasta)
+    except (TypeError, ValueError) as e:
+        return {"error": f"Parámetros inválidos: {e}"}
+
+    lotes = _filas(sql, params, tamano_lote)
+    prefijo = "mis_citas" if paciente_id is not None else "citas"
+    if formato == "csv":
+        columnas = COLUMNAS_CSV_CITAS_PACIENTE if paciente_id is not None else COLUMNAS_CSV_CITAS
+        contenido, mimetype = _csv(lotes, columnas, "citas"), "text/csv"
+    else:
+        nombre = "Mis citas - MedAgend" if paciente_id is not None else "Citas - MedAgend"
+        contenido, mimetype = _ics(lotes, nombre, con_paciente=paciente_id is None), "text/calendar"
+    return {
+        "success": True,
+        "contenido": contenido,
+        "mimetype": mimetype,
+        "nombre_archivo": f"{prefijo}_{date.today().isoformat()}.{formato}",
+    }
+
+
+def exportar_pacientes(tamano_lote=None):
+    """
+    Padrón de pacientes en CSV, en orden alfabético (idx_pacientes_nombre).
+    Mismo formato de respuesta que exportar_citas.
+    """
+    lotes = _filas("""
+        SELECT p.id, p.nombre_completo, p.email, p.telefono, u.username
+        FROM pacientes p
+        JOIN usuarios u ON p.usuario_id = u.id
+        ORDER BY p.nombre_completo, p.id
+    """, (), tamano_lote)
+    return {
+        "success": True,
+        "contenido": _csv(lotes, COLUMNAS_CSV_PACIENTES, "pacientes"),
+        "mimetype": "text/csv",
+        "nombre_archivo": f"pacientes_{date.today().isoformat()}.csv",
+    }
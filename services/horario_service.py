@@ -0,0 +1,165 @@
+import json
+import threading
+from controllers.database import get_db_connection
+from services.normalizacion import normalizar_texto
+
+# Índice 0 = lunes, igual que datetime.weekday(); no depende del locale
+DIAS_SEMANA = ('lunes', 'martes', 'miércoles', 'jueves', 'viernes', 'sábado', 'domingo')
+
+_ALIAS_DIAS = {}
+for _i, _nombres in enumerate((
+    ('lunes', 'lun', 'monday', 'mon'),
+    ('martes', 'mar', 'tuesday', 'tue'),
+    ('miercoles', 'mie', 'wednesday', 'wed'),
+    ('jueves', 'jue', 'thursday', 'thu'),
+    ('viernes', 'vie', 'friday', 'fri'),
+    ('sabado', 'sab', 'saturday', 'sat'),
+    ('domingo', 'dom', 'sunday', 'sun'),
+)):
+    for _nombre in _nombres:
+        _ALIAS_DIAS[_nombre] = _i
+
+
+def _minutos(hora_str):
+    horas, minutos = hora_str.strip().split(':')
+    total = int(horas) * 60 + int(minutos)
+    if not 0 <= total <= 24 * 60 or not 0 <= int(minutos) < 60:
+        raise ValueError(f"Hora inválida: '{hora_str}'")
+    return total
+
+
+def _formato_hora(minutos):
+    return f"{minutos // 60:02d}:{minutos % 60:02d}"
+
+
+class HorarioMedico:
+    """
+    Horario de trabajo compilado de un médico.
+    'dias' es una tupla de 7 elementos (lunes..domingo); cada uno es una
+    tupla ordenada de turnos (inicio, fin) en minutos desde medianoche.
+    """
+    __slots__ = ('dias', 'crudo')
+
+    def __init__(self, dias, crudo=None):
+        self.dias = dias
+        self.crudo = crudo
+
+    def turnos(self, dia_semana):
+        """Turnos del día indicado (0 = lunes, como datetime.weekday())."""
+        return self.dias[dia_semana]
+
+    def trabaja(self, dia_semana):
+        return bool(self.dias[dia_semana])
+
+    def contiene(self, inicio, fin):
+        """
+        True si el intervalo [inicio, fin) cae completo dentro de un turno.
+        """
+        if fin.date() != inicio.date() and not (fin.hour == 0 and fin.minute == 0):
+            return False
+        desde = inicio.hour * 60 + inicio.minute
+        hasta = desde + int((fin - inicio).total_seconds() // 60)
+        for inicio_turno, fin_turno in self.dias[inicio.weekday()]:
+            if inicio_turno <= desde and hasta <= fin_turno:
+                return True
+        return False
+
+    def items(self):
+        """Pares (día, ['HH:MM-HH:MM', ...]) de los días trabajados, para mostrar."""
+        return [
+            (DIAS_SEMANA[i], [f"{_formato_hora(a)}-{_formato_hora(b)}" for a, b in turnos])
+            for i, turnos in enumerate(self.dias) if turnos
+        ]
+
+    def como_dict(self):
+        return dict(self.items())
+
+
+def compilar_horario(horario_json):
+    """
+    Convierte el JSON de 'horario_trabajo' en un HorarioMedico.
+    Acepta días en español (con o sin acento) o en inglés.
+    Lanza ValueError si el formato es inválido.
+    """
+    if not horario_json:
+        return HorarioMedico(((),) * 7, horario_json)
+
+    try:
+        horario = json.loads(horario_json) if isinstance(horario_json, str) else horario_json
+    except json.JSONDecodeError:
+        raise ValueError("El formato del horario JSON es inválido.")
+    if not isinstance(horario, dict):
+        raise ValueError("El horario debe ser un objeto JSON con los días como claves.")
+
+    dias = [[] for _ in range(7)]
+    for dia, turnos in horario.items():
+        indice = _ALIAS_DIAS.get(normalizar_texto(dia))
+        if indice is None:
+            raise ValueError(f"Día desconocido en el horario: '{dia}'")
+        if isinstance(turnos, str):
+            turnos = [turnos]
+        for turno in turnos:
+            try:
+                inicio_str, fin_str = turno.split('-')
+                inicio, fin = _minutos(inicio_str), _minutos(fin_str)
+            except (ValueError, AttributeError):
+                raise ValueError(f"Turno inválido: '{turno}' (use 'HH:MM-HH:MM')")
+            if fin <= inicio:
+                raise ValueError(f"Turno inválido: '{turno}' (el fin debe ser posterior al inicio)")
+            dias[indice].append((inicio, fin))
+
+    # Ordenar y fusionar turnos traslapados o contiguos
+    compilados = []
+    for turnos in dias:
+        fusionados = []
+        for inicio, fin in sorted(turnos):
+            if fusionados and inicio <= fusionados[-1][1]:
+                fusionados[-1] = (fusionados[-1][0], max(fusionados[-1][1], fin))
+            else:
+                fusionados.append((inicio, fin))
+        compilados.append(tuple(fusionados))
+
+    return HorarioMedico(tuple(compilados), horario_json if isinstance(horario_json, str) else None)
+
+
+# --- Caché en memoria: medico_id -> HorarioMedico ---
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def get_horario_medico(medico_id, horario_json=None):
+    """
+    Devuelve el horario compilado de un médico, compilándolo solo una vez.
+    El caché se valida siempre contra 'horario_trabajo': se usa 'horario_json'
+    si se pasa (ej. ya se leyó la fila) o se lee la columna de la base, así
+    que un cambio hecho por otro worker o proceso se ve en la siguiente llamada.
+    Devuelve None si el médico no existe.
+    """
+    if horario_json is None:
+        conn = get_db_connection()
+        fila = conn.execute("SELECT horario_trabajo FROM medicos WHERE id = ?", (medico_id,)).fetchone()
+        conn.close()
+        if fila is None:
+            return None
+        horario_json = fila['horario_trabajo']
+
+    horario = _cache.get(medico_id)
+    if horario is not None and horario.crudo == horario_json:
+        return horario
+
+    horario = compilar_horario(horario_json)
+    with _cache_lock:
+        _cache[medico_id] = horario
+    return horario
+
+
+def invalidar_horario(medico_id=None):
+    """
+    Descarta el horario compilado de un médico (o de todos si es None).
+    Solo libera memoria: get_horario_medico ya recompila si la fila cambió.
+    """
+    with _cache_lock:
+        if medico_id is None:
+            _cache.clear()
+        else:
+            _cache.pop(medico_id, None)
@@ -0,0 +1,331 @@
+import csv
+import json
+import os
+import sqlite3
+import time
+from bisect import bisect_left, insort
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from itertools import islice
+from werkzeug.security import generate_password_hash
+from controllers.database import get_db_connection
+from controllers import cache
+from services import cita_service, horario_service, medico_service
+
+# Filas por transacción (y por executemany)
+TAMANO_LOTE = 1000
+
+# Errores de fila que se guardan en el reporte (el resto solo se cuentan)
+MAX_ERRORES_EN_REPORTE = 100
+
+ESTADOS_CITA = ('programada', 'cancelada', 'completada')
+
+# --- 1. Lectura: CSV o JSONL, fila por fila ---
+
+def leer_filas(ruta):
+    """
+    Genera (numero_de_linea, fila) de un archivo .csv (con encabezados) o
+    .jsonl (un objeto por línea) sin cargarlo completo en memoria.
+    Si una línea no se puede leer, 'fila' es la excepción.
+    """
+    if ruta.lower().endswith(('.jsonl', '.ndjson')):
+        with open(ruta, encoding='utf-8') as archivo:
+            for numero, linea in enumerate(archivo, 1):
+                if not linea.strip():
+                    continue
+                try:
+                    fila = json.loads(linea)
+                except json.JSONDecodeError as e:
+                    fila = ValueError(f"JSON inválido: {e.msg}")
+                else:
+                    if not isinstance(fila, dict):
+                        fila = ValueError("Cada línea debe ser un objeto JSON.")
+                yield numero, fila
+    elif ruta.lower().endswith('.csv'):
+        with open(ruta, encoding='utf-8-sig', newline='') as archivo:
+            lector = csv.DictReader(archivo)
+            for fila in lector:
+                # La línea 1 es el encabezado
+                yield lector.line_num, fila
+    else:
+        raise ValueError("Formato no soportado: use .csv o .jsonl")
+
+# --- 2. Validación: mismas reglas que los servicios ---
+
+def _texto(fila, campo, requerido=True):
+    valor = fila.get(campo)
+    valor = str(valor).strip() if valor is not None else ''
+    if requerido and not valor:
+        raise ValueError(f"Falta el campo '{campo}'.")
+    return valor or None
+
+def _entero(fila, campo, por_defecto=None):
+    valor = fila.get(campo)
+    if valor is None or valor == '':
+        if por_defecto is None:
+            raise ValueError(f"Falta el campo '{campo}'.")
+        return por_defecto
+    try:
+        return int(valor)
+    except (TypeError, ValueError):
+        raise ValueError(f"'{campo}' debe ser un número entero.")
+
+def _validar_medico(fila, estado):
+    horario = fila.get('horario_trabajo') or medico_service.HORARIO_POR_DEFECTO
+    if isinstance(horario, dict):
+        horario = json.dumps(horario, ensure_ascii=False)
+    # Mismo chequeo que crear_medico
+    horario_service.compilar_horario(horario)
+    nombre = _texto(fila, 'nombre_completo')
+    especialidad = _texto(fila, 'especialidad')
+    ubicacion = _texto(fila, 'ubicacion', requerido=False)
+    return (nombre, especialidad, horario, ubicacion)
+
+def _validar_paciente(fila, estado):
+    # Duplicados dentro del mismo archivo (los de la base se revisan por lote)
+    usernames = estado.setdefault('usernames', set())
+    emails = estado.setdefault('emails', set())
+    username = _texto(fila, 'username')
+    password = _texto(fila, 'password')
+    nombre = _texto(fila, 'nombre_completo')
+    email = _texto(fila, 'email')
+    telefono = _texto(fila, 'telefono', requerido=False)
+    if username in usernames:
+        raise ValueError("El nombre de usuario está repetido en el archivo.")
+    if email in emails:
+        raise ValueError("El email está repetido en el archivo.")
+    usernames.add(username)
+    emails.add(email)
+    # Lista: la contraseña se reemplaza por su hash más adelante
+    return [username, password, nombre, email, telefono]
+
+def _validar_cita(fila, estado):
+    paciente_id = _entero(fila, 'paciente_id')
+    medico_id = _entero(fila, 'medico_id')
+    duracion = _entero(fila, 'duracion_minutos', por_defecto=30)
+    estado_cita = (_texto(fila, 'estado', requerido=False) or 'programada').lower()
+    notas = _texto(fila, 'notas_paciente', requerido=False) or ''
+    fecha = _texto(fila, 'fecha_hora_inicio')
+    try:
+        inicio = datetime.fromisoformat(fecha)
+    except ValueError:
+        raise ValueError("Formato de fecha y hora inválido. Use AAAA-MM-DDTHH:MM")
+    if estado_cita not in ESTADOS_CITA:
+        raise ValueError(f"Estado inválido: {estado_cita}.")
+    fin = inicio + timedelta(minutes=duracion)
+
+    # Se permiten fechas pasadas (historial); las vivas deben respetar el
+    # horario del médico y no traslaparse, igual que en agendar_nueva_cita.
+    if estado_cita == 'programada':
+        error = cita_service.validar_horario_cita(medico_id, inicio, duracion)
+        if error:
+            raise ValueError(error)
+        # Citas vivas ya aceptadas en esta corrida, por médico: [(inicio, fin)] ordenadas
+        intervalos = estado.setdefault('aceptadas', {}).setdefault(medico_id, [])
+        i = bisect_left(intervalos, (inicio, fin))
+        if (i > 0 and intervalos[i - 1][1] > inicio) or (i < len(intervalos) and intervalos[i][0] < fin):
+            raise ValueError("Se traslapa con otra cita del mismo archivo.")
+        conflicto_id = cita_service.buscar_conflicto(estado['cursor'], medico_id, inicio, fin)
+        if conflicto_id is not None:
+            raise ValueError(f"El médico ya tiene una cita en ese horario (ID Cita: {conflicto_id}).")
+        insort(intervalos, (inicio, fin))
+    elif not 0 < duracion <= cita_service.DURACION_MAXIMA_MINUTOS:
+        raise ValueError(f"La duración debe estar entre 1 y {cita_service.DURACION_MAXIMA_MINUTOS} minutos.")
+
+    return (paciente_id, medico_id, inicio, duracion, fin, estado_cita, notas)
+
+def _validar(validador, filas, reporte, estado):
+    """
+    Pasa cada fila por el validador. Las filas inválidas se registran en el
+    reporte y se descartan; el resto sigue por la tubería como (numero, valores).
+    """
+    for numero, fila in filas:
+        reporte['leidas'] += 1
+        try:
+            if isinstance(fila, Exception):
+                raise fila
+            yield numero, validador(fila, estado)
+        except ValueError as e:
+            _registrar_error(reporte, numero, str(e))
+
+def _registrar_error(reporte, numero, mensaje):
+    reporte['errores'] += 1
+    if len(reporte['detalle_errores']) < MAX_ERRORES_EN_REPORTE:
+        reporte['detalle_errores'].append({"linea": numero, "error": mensaje})
+    if reporte['_al_error']:
+        reporte['_al_error'](numero, mensaje)
+
+# --- 3. Hash de contraseñas en paralelo ---
+
+def _hashear_lotes(lotes, procesos):
+    """
+    Reemplaza la contraseña de cada fila por su hash, repartiendo el trabajo
+    en un pool de procesos. Mientras se inserta un lote, el siguiente ya se
+    está hasheando.
+    """
+    procesos = procesos or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=procesos) as pool:
+        def enviar(lote):
+            # map() reparte el lote en bloques y devuelve los hashes en orden
+            bloque = max(1, len(lote) // (procesos * 4))
+            return lote, pool.map(generate_password_hash, [fila[1] for _, fila in lote], chunksize=bloque)
+
+        en_curso = None
+        for lote in lotes:
+            siguiente = enviar(lote)
+            if en_curso is not None:
+                yield _completar_hashes(*en_curso)
+            en_curso = siguiente
+        if en_curso is not None:
+            yield _completar_hashes(*en_curso)
+
+def _completar_hashes(lote, hashes):
+    for (_, fila), password_hash in zip(lote, hashes):
+        fila[1] = password_hash
+    return lote
+
+# --- 4. Inserción por lotes ---
+
+def _ids_insertados(cursor, cantidad):
+    # Dentro de la transacción nadie más escribe: los ids AUTOINCREMENT son consecutivos
+    ultimo = cursor.execute("SELECT last_insert_rowid()").fetchone()[0]
+    return range(ultimo - cantidad + 1, ultimo + 1)
+
+def _insertar_medicos(cursor, filas):
+    # especialidad_norm y medicos_fts los llenan los triggers de medicos
+    cursor.executemany(
+        "INSERT INTO medicos (nombre_completo, especialidad, horario_trabajo, ubicacion) VALUES (?, ?, ?, ?)",
+        filas
+    )
+
+def _insertar_pacientes(cursor, filas):
+    # Mismos mensajes que crear_paciente para duplicados ya existentes en la base
+    marcas = ",".join("?" * len(filas))
+    existentes = cursor.execute(
+        f"SELECT username FROM usuarios WHERE username IN ({marcas})", [f[0] for f in filas]
+    ).fetchone()
+    if existentes:
+        raise sqlite3.IntegrityError("El nombre de usuario ya existe.")
+    existentes = cursor.execute(
+        f"SELECT email FROM pacientes WHERE email IN ({marcas})", [f[3] for f in filas]
+    ).fetchone()
+    if existentes:
+        raise sqlite3.IntegrityError("El email ya está registrado.")
+
+    cursor.executemany(
+        "INSERT INTO usuarios (username, password_hash, role) VALUES (?, ?, 'paciente')",
+        [(username, password_hash) for username, password_hash, *_ in filas]
+    )
+    cursor.executemany(
+        "INSERT INTO pacientes (usuario_id, nombre_completo, email, telefono) VALUES (?, ?, ?, ?)",
+        [(usuario_id, nombre, email, telefono)
+         for usuario_id, (_, _, nombre, email, telefono) in zip(_ids_insertados(cursor, len(filas)), filas)]
+    )
+
+def _insertar_citas(cursor, filas):
+    cursor.executemany(
+        """
+        INSERT INTO citas (paciente_id, medico_id, fecha_hora_inicio, duracion_minutos, fecha_hora_fin, estado, notas_paciente)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+        filas
+    )
+
+_TIPOS = {
+    "medicos": (_validar_medico, _insertar_medicos),
+    "pacientes": (_validar_paciente, _insertar_pacientes),
+    "citas": (_validar_cita, _insertar_citas),
+}
+TIPOS = tuple(_TIPOS)
+
+def _insertar_lote(conn, insertar, lote, reporte):
+    """
+    Inserta un lote en una sola transacción. Si falla (ej. un duplicado o un
+    id inexistente), se reintenta fila por fila con SAVEPOINT para importar
+    las válidas y reportar solo las que fallan.
+    """
+    cursor = conn.cursor()
+    try:
+        insertar(cursor, [fila for _, fila in lote])
+        conn.commit()
+        reporte['importadas'] += len(lote)
+        return
+    except sqlite3.Error:
+        conn.rollback()
+
+    for numero, fila in lote:
+        cursor.execute("SAVEPOINT fila")
+        try:
+            insertar(cursor, [fila])
+            cursor.execute("RELEASE fila")
+            reporte['importadas'] += 1
+        except sqlite3.Error as e:
+            cursor.execute("ROLLBACK TO fila")
+            cursor.execute("RELEASE fila")
+            _registrar_error(reporte, numero, _mensaje_integridad(e))
+    conn.commit()
+
+def _mensaje_integridad(e):
+    mensaje = str(e)
+    if 'FOREIGN KEY' in mensaje:
+        return "El paciente o el médico no existe."
+    if 'UNIQUE constraint failed: citas' in mensaje:
+        return "El médico ya tiene una cita a esa hora."
+    return mensaje
+
+def _en_lotes(filas, tamano):
+    filas = iter(filas)
+    while True:
+        lote = list(islice(filas, tamano))
+        if not lote:
+            return
+        yield lote
+
+def importar(tipo, ruta, tamano_lote=TAMANO_LOTE, procesos=None, al_error=None):
+    """
+    Importa médicos, pacientes o citas desde un CSV o JSONL.
+
+    Las filas pasan por una tubería de generadores (lectura -> validación
+    -> lotes -> hash de contraseñas) y se insertan con executemany, un lote
+    por transacción. Una fila inválida no detiene la importación: se
+    reporta con su número de línea y se sigue con la siguiente.
+    'al_error(linea, mensaje)' se llama por cada fila rechazada.
+
+    Devuelve el reporte: leidas, importadas, errores, detalle_errores,
+    segundos y filas_por_segundo, o {"error": ...} si no se pudo empezar.
+    """
+    if tipo not in _TIPOS:
+        return {"error": f"Tipo inválido: {tipo}. Use uno de: {', '.join(TIPOS)}."}
+    if not os.path.isfile(ruta):
+        return {"error": f"No existe el archivo: {ruta}"}
+
+    if not ruta.lower().endswith(('.csv', '.jsonl', '.ndjson')):
+        return {"error": "Formato no soportado: use .csv o .jsonl"}
+
+    validador, insertar = _TIPOS[tipo]
+    reporte = {
+        "tipo": tipo, "leidas": 0, "importadas": 0, "errores": 0, "detalle_errores": [],
+        "_al_error": al_error,
+    }
+    inicio = time.perf_counter()
+
+    conn = get_db_connection()
+    try:
+        # La validación usa la misma conexión: ve los lotes ya insertados
+        estado = {"cursor": conn.cursor()}
+        lotes = _en_lotes(_validar(validador, leer_filas(ruta), reporte, estado), tamano_lote)
+        if tipo == "pacientes":
+            lotes = _hashear_lotes(lotes, procesos)
+        for lote in lotes:
+            _insertar_lote(conn, insertar, lote, reporte)
+    finally:
+        conn.close()
+
+    # Lo importado cambia directorios y agendas
+    cache.invalidar("medicos", "agenda")
+
+    segundos = time.perf_counter() - inicio
+    del reporte['_al_error']
+    reporte['segundos'] = round(segundos, 3)
+    reporte['filas_por_segundo'] = round(reporte['leidas'] / segundos, 1) if segundos else None
+    return reporte
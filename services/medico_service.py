@@ -1,59 +1,178 @@
-from controllers.database import get_db_connection
+from controllers.database import get_db_connection, busqueda_fts_disponible, get_contadores
+from controllers import cache, metrics
+from services import horario_service, paginacion
+from services.normalizacion import normalizar_texto
 import json
+import re
 import sqlite3
 
-def get_medicos(especialidad_filter=None):
+log = metrics.get_logger(__name__)
+
+# Horario que se usa cuando no se indica uno (L-V, 9-5 con descanso)
+HORARIO_POR_DEFECTO = json.dumps({
+    "lunes": ["09:00-13:00", "14:00-17:00"],
+    "martes": ["09:00-13:00", "14:00-17:00"],
+    "miercoles": ["09:00-13:00", "14:00-17:00"],
+    "jueves": ["09:00-13:00", "14:00-17:00"],
+    "viernes": ["09:00-13:00", "14:00-17:00"]
+})
+
+# Columnas que se devuelven de un médico (sin las claves internas de búsqueda)
+COLUMNAS_MEDICO = "m.id, m.nombre_completo, m.especialidad, m.horario_trabajo, m.ubicacion"
+
+# Peso de cada columna del índice en el ranking: nombre, especialidad, ubicación
+PESOS_BM25 = (2.0, 4.0, 1.0)
+
+def get_medicos(especialidad_filter=None, limite=-1):
     """
     Obtiene una lista de todos los médicos.
-    Si se provee 'especialidad_filter', filtra por esa especialidad.
+    Si se provee 'especialidad_filter', filtra por esa especialidad
+    sin importar mayúsculas ni acentos ("cardiologia" == "CARDIOLOGÍA").
+    'limite' acota cuántos se devuelven (-1 = todos).
     """
     conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
-        query = "SELECT * FROM medicos"
-        params = []
-        
-        if especialidad_filter:
-            # Usamos LOWER() para que no importe si el usuario escribe
-            # "cardiologo" o "Cardiología".
-            query += " WHERE LOWER(especialidad) LIKE LOWER(?)"
-            params.append(f"%{especialidad_filter}%")
-            
-        cursor.execute(query, params)
+        if not especialidad_filter:
+            cursor.execute(f"SELECT {COLUMNAS_MEDICO} FROM medicos m LIMIT ?", (limite,))
+            medicos = cursor.fetchall()
+            conn.close()
+            return [dict(row) for row in medicos]
+
+        # 1. Coincidencia exacta con la clave normalizada (usa el índice)
+        cursor.execute(
+            f"SELECT {COLUMNAS_MEDICO} FROM medicos m WHERE m.especialidad_norm = ? LIMIT ?",
+            (normalizar_texto(especialidad_filter), limite)
+        )
         medicos = cursor.fetchall()
         conn.close()
+        if medicos:
+            return [dict(row) for row in medicos]
+
+        # 2. Coincidencia parcial ("cardio", "pediatra") con el índice de búsqueda
+        return buscar_medicos(especialidad_filter, limite=limite, columna="especialidad")
         
-        return [dict(row) for row in medicos]
-        
-    except Exception as e:
+    except Exception:
         conn.close()
-        print(f"ERROR EN get_medicos: {e}")
+        log.exception("Error en get_medicos")
         # Devolvemos una lista vacía en lugar de crashear
         return []
 
+def contar_medicos():
+    """Número total de médicos registrados (contador mantenido por triggers, sin COUNT(*))."""
+    return get_contadores("medicos_total")["medicos_total"][0]
+
+def listar_medicos(cursor_token=None, limite=paginacion.LIMITE_POR_DEFECTO, busqueda=None):
+    """
+    Página de médicos ordenada por (nombre_completo, id) para el panel de
+    administración, paginada por keyset. 'busqueda' filtra por nombre,
+    especialidad o ubicación.
+    Devuelve {"medicos": [...], "siguiente": token o None} o {"error": ...}.
+    """
+    limite = paginacion.normalizar_limite(limite)
+    condiciones, params = [], []
+    if busqueda:
+        patron = paginacion.patron_like(busqueda.strip())
+        condiciones.append(
+            "(t.nombre_completo LIKE ? ESCAPE '\\' OR t.especialidad LIKE ? ESCAPE '\\' OR t.ubicacion LIKE ? ESCAPE '\\')"
+        )
+        params.extend([patron, patron, patron])
+
+    conn = get_db_connection()
+    try:
+        medicos, siguiente = paginacion.paginar(
+            conn.cursor(),
+            "SELECT t.id, t.nombre_completo, t.especialidad, t.horario_trabajo, t.ubicacion FROM medicos t",
+            condiciones, params, cursor_token, limite
+        )
+        return {"medicos": medicos, "siguiente": siguiente}
+    except ValueError as e:
+        return {"error": str(e)}
+    finally:
+        conn.close()
+
+def _raiz(palabra):
+    # "cardiologo" y "cardiologia" comparten "cardiolo"; "pediatra" -> "pediat"
+    return palabra[:-2] if len(palabra) > 5 else palabra
+
+def buscar_medicos(texto, limite=20, columna=None):
+    """
+    Búsqueda de médicos por nombre, especialidad o ubicación, ordenada por
+    relevancia. No distingue mayúsculas ni acentos y acepta fragmentos
+    ("cardio", "turing", "piso 2"). Si 'columna' se indica, solo busca en
+    ella ('nombre', 'especialidad' o 'ubicacion'). limite=-1 no limita.
+    Devuelve una lista de diccionarios (vacía si no hay resultados).
+    """
+    palabras = re.findall(r"\w+", normalizar_texto(texto))
+    if not palabras:
+        return []
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        # El índice por trigramas necesita al menos 3 letras por término
+        largas = [p for p in palabras if len(p) >= 3]
+        if largas and busqueda_fts_disponible(cursor):
+            # Primero la palabra completa y, si no hay nada, su raíz
+            for terminos in (largas, [_raiz(p) for p in largas]):
+                consulta = " AND ".join('"' + t + '"' for t in terminos)
+                if columna:
+                    consulta = f"{columna} : ({consulta})"
+                cursor.execute(f"""
+                    SELECT {COLUMNAS_MEDICO}
+                    FROM medicos_fts
+                    JOIN medicos m ON m.id = medicos_fts.rowid
+                    WHERE medicos_fts MATCH ?
+                    ORDER BY bm25(medicos_fts, ?, ?, ?)
+                    LIMIT ?
+                """, (consulta, *PESOS_BM25, limite))
+                medicos = cursor.fetchall()
+                if medicos:
+                    return [dict(row) for row in medicos]
+            return []
+
+        # Sin FTS5 o con términos muy cortos: prefijo de la especialidad normalizada
+        prefijo = " ".join(palabras)
+        cursor.execute(f"""
+            SELECT {COLUMNAS_MEDICO} FROM medicos m
+            WHERE m.especialidad_norm >= ? AND m.especialidad_norm < ?
+            ORDER BY m.especialidad_norm
+            LIMIT ?
+        """, (prefijo, prefijo + "\uffff", limite))
+        return [dict(row) for row in cursor.fetchall()]
+
+    except sqlite3.OperationalError:
+        log.exception("Error en buscar_medicos")
+        return []
+    finally:
+        conn.close()
+
 def crear_medico(nombre_completo, especialidad, horario_json, ubicacion): # <-- AÑADIDO 'ubicacion'
     """
     Registra un nuevo médico en la base de datos.
     'horario_json' debe ser un string JSON válido.
     """
+    # Validar que el horario sea JSON y que los turnos tengan formato válido
+    try:
+        horario_service.compilar_horario(horario_json)
+    except ValueError as e:
+        return {"error": str(e)}
+    
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    # Validar que el horario sea JSON
-    try:
-        json.loads(horario_json)
-    except json.JSONDecodeError:
-        return {"error": "El formato del horario JSON es inválido."}
-    
     try:
         cursor.execute(
             # --- ¡CONSULTA ACTUALIZADA! ---
             "INSERT INTO medicos (nombre_completo, especialidad, horario_trabajo, ubicacion) VALUES (?, ?, ?, ?)",
             (nombre_completo, especialidad, horario_json, ubicacion)
         )
+        # especialidad_norm y medicos_fts los llenan los triggers de medicos
+        medico_id = cursor.lastrowid
         conn.commit()
-        return {"success": True, "id_medico": cursor.lastrowid}
+        cache.invalidar("medicos")
+        return {"success": True, "id_medico": medico_id}
         
     except sqlite3.IntegrityError:
         conn.rollback()
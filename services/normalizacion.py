@@ -0,0 +1,11 @@
+import unicodedata
+
+def normalizar_texto(texto):
+    """
+    Pasa un texto a minúsculas y le quita los acentos,
+    ej. 'Miércoles' -> 'miercoles', 'CARDIOLOGÍA' -> 'cardiologia'.
+    """
+    if not texto:
+        return ""
+    descompuesto = unicodedata.normalize('NFKD', str(texto).casefold())
+    return "".join(c for c in descompuesto if not unicodedata.combining(c)).strip()
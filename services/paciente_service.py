@@ -1,4 +1,5 @@
-from controllers.database import get_db_connection
+from controllers.database import get_db_connection, get_contadores
+from services import paginacion
 
 def get_pacientes():
     """
@@ -22,4 +23,41 @@ def get_pacientes():
     pacientes = cursor.fetchall()
     conn.close()
     
-    return [dict(row) for row in pacientes]
\ No newline at end of file
+    return [dict(row) for row in pacientes]
+
+def contar_pacientes():
+    """Número total de pacientes registrados (contador mantenido por triggers, sin COUNT(*))."""
+    return get_contadores("pacientes_total")["pacientes_total"][0]
+
+def listar_pacientes(cursor_token=None, limite=paginacion.LIMITE_POR_DEFECTO, busqueda=None):
+    """
+    Página de pacientes ordenada por (nombre_completo, id), paginada por
+    keyset: el costo de cada página no depende de cuántas haya antes.
+    'busqueda' filtra por nombre, email o username.
+    Devuelve {"pacientes": [...], "siguiente": token o None} o {"error": ...}.
+    """
+    limite = paginacion.normalizar_limite(limite)
+    condiciones, params = [], []
+    if busqueda:
+        patron = paginacion.patron_like(busqueda.strip())
+        condiciones.append(
+            "(t.nombre_completo LIKE ? ESCAPE '\\' OR t.email LIKE ? ESCAPE '\\' OR u.username LIKE ? ESCAPE '\\')"
+        )
+        params.extend([patron, patron, patron])
+
+    conn = get_db_connection()
+    try:
+        pacientes, siguiente = paginacion.paginar(
+            conn.cursor(),
+            """
+            SELECT t.id, t.nombre_completo, t.email, t.telefono, u.username
+            FROM pacientes t
+            JOIN usuarios u ON t.usuario_id = u.id
+            """,
+            condiciones, params, cursor_token, limite
+        )
+        return {"pacientes": pacientes, "siguiente": siguiente}
+    except ValueError as e:
+        return {"error": str(e)}
+    finally:
+        conn.close()
@@ -0,0 +1,68 @@
+import base64
+import json
+
+# Tamaño de página por defecto y máximo para los listados
+LIMITE_POR_DEFECTO = 50
+LIMITE_MAXIMO = 200
+
+def codificar_cursor(nombre, id_):
+    """
+    Convierte la última fila de una página, (nombre_completo, id), en un
+    token opaco para pedir la página siguiente. Sirve para cualquier clave
+    de texto + id (ej. (fecha_hora_inicio, id) en el historial de citas).
+    """
+    crudo = json.dumps([nombre, id_], ensure_ascii=False).encode("utf-8")
+    return base64.urlsafe_b64encode(crudo).decode("ascii")
+
+def decodificar_cursor(token):
+    """
+    Devuelve (nombre_completo, id) de un token de codificar_cursor().
+    Lanza ValueError si el token no es válido.
+    """
+    try:
+        nombre, id_ = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+    except Exception:
+        raise ValueError("Cursor de paginación inválido.")
+    if not isinstance(nombre, str) or not isinstance(id_, int):
+        raise ValueError("Cursor de paginación inválido.")
+    return nombre, id_
+
+def normalizar_limite(limite):
+    """Acota el tamaño de página pedido a [1, LIMITE_MAXIMO]."""
+    try:
+        limite = int(limite)
+    except (TypeError, ValueError):
+        return LIMITE_POR_DEFECTO
+    return max(1, min(limite, LIMITE_MAXIMO))
+
+def patron_like(texto):
+    """Patrón '%texto%' para LIKE ... ESCAPE '\\' con los comodines escapados."""
+    escapado = texto.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escapado}%"
+
+def paginar(cursor, sql_base, condiciones, params, token, limite):
+    """
+    Ejecuta una consulta paginada por keyset sobre (nombre_completo, id).
+
+    'sql_base' es el SELECT ... FROM ... con alias de tabla 't'. Se pide una
+    fila de más para saber si hay página siguiente. Devuelve (filas, siguiente).
+    """
+    condiciones = list(condiciones)
+    params = list(params)
+    if token:
+        # Comparación de filas: usa el índice (nombre_completo, id) sin OFFSET
+        condiciones.append("(t.nombre_completo, t.id) > (?, ?)")
+        params.extend(decodificar_cursor(token))
+
+    sql = sql_base
+    if condiciones:
+        sql += " WHERE " + " AND ".join(condiciones)
+    sql += " ORDER BY t.nombre_completo, t.id LIMIT ?"
+    params.append(limite + 1)
+
+    filas = [dict(row) for row in cursor.execute(sql, params).fetchall()]
+    siguiente = None
+    if len(filas) > limite:
+        filas = filas[:limite]
+        siguiente = codificar_cursor(filas[-1]["nombre_completo"], filas[-1]["id"])
+    return filas, siguiente